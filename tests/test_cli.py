@@ -0,0 +1,76 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+SUBCOMMAND_MODULES = {
+    "zigpy_cli.database",
+    "zigpy_cli.ota",
+    "zigpy_cli.pcap",
+    "zigpy_cli.radio",
+}
+
+# Runs the CLI and prints the modules it imported to stderr
+RUN_CLI = """
+import json, sys
+from zigpy_cli.__main__ import cli
+
+try:
+    cli(sys.argv[1:])
+except SystemExit:
+    pass
+
+print(json.dumps(sorted(sys.modules)), file=sys.stderr)
+"""
+
+
+def imported_modules(*args):
+    proc = subprocess.run(
+        [sys.executable, "-c", RUN_CLI, *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    return proc.stdout, set(json.loads(proc.stderr.splitlines()[-1]))
+
+
+def test_help_imports_no_subcommands():
+    output, modules = imported_modules("--help")
+
+    for command in ["db", "ota", "pcap", "radio"]:
+        assert command in output
+
+    assert not modules & SUBCOMMAND_MODULES
+    assert "coloredlogs" not in modules
+    assert "zigpy" not in modules
+
+
+def test_fix_fcs_imports(tmp_path):
+    # An empty little endian IEEE 802.15.4 capture
+    (tmp_path / "input.pcap").write_bytes(
+        bytes.fromhex("d4c3b2a1020004000000000000000000ffff0000c3000000")
+    )
+
+    _, modules = imported_modules(
+        "pcap", "fix-fcs", str(tmp_path / "input.pcap"), str(tmp_path / "fixed.pcap")
+    )
+
+    assert (tmp_path / "fixed.pcap").read_bytes() == (
+        tmp_path / "input.pcap"
+    ).read_bytes()
+
+    assert modules & SUBCOMMAND_MODULES == {"zigpy_cli.pcap"}
+    assert not any(m == "scapy" or m.startswith("scapy.") for m in modules)
+    assert "zigpy" not in modules
+
+
+@pytest.mark.parametrize("args", [["radio", "--help"], ["radio", "znp", "--help"]])
+def test_radio_imports(args):
+    _, modules = imported_modules(*args)
+
+    assert modules & SUBCOMMAND_MODULES == {"zigpy_cli.radio"}
+    assert "scapy" not in modules
+    assert "zigpy.appdb" not in modules
+    assert "zigpy_znp" not in modules
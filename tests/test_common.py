@@ -1,6 +1,8 @@
+import concurrent.futures
+
 import pytest
 
-from zigpy_cli.common import HEX_OR_DEC_INT
+from zigpy_cli.common import HEX_OR_DEC_INT, parallel_map
 
 
 @pytest.mark.parametrize(
@@ -14,3 +16,15 @@ from zigpy_cli.common import HEX_OR_DEC_INT
 def test_hex_or_dec_int(unparsed, parsed):
     assert HEX_OR_DEC_INT.convert(unparsed, None, None) == parsed
     assert HEX_OR_DEC_INT.convert(parsed, None, None) == parsed
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_parallel_map_order(jobs):
+    results = parallel_map(
+        lambda x: x * 2,
+        range(100),
+        jobs=jobs,
+        executor_cls=concurrent.futures.ThreadPoolExecutor,
+    )
+
+    assert list(results) == [x * 2 for x in range(100)]
@@ -0,0 +1,563 @@
+import asyncio
+import itertools
+import json
+import logging
+import pathlib
+import sqlite3
+import subprocess
+import sys
+from unittest import mock
+
+import click
+import pytest
+import zigpy.appdb
+from click.testing import CliRunner
+
+import zigpy_cli.database
+from zigpy_cli.__main__ import cli
+from zigpy_cli.common import map_file
+from zigpy_cli.database import sqlite3_iter_statements, sqlite3_split_statements
+from zigpy_cli.sqlite_recovery import SKIPPED_ROW, DamagedDatabase
+
+DEVICES = [
+    ("00:0d:6f:00:0a:90:69:e7", 0x1234),
+    ("00:15:8d:00:02:5e:f9:ff", 0x5678),
+]
+
+
+def make_zigpy_database(path):
+    """
+    Creates a zigpy database with the current schema and a few devices.
+    """
+
+    schema = (
+        pathlib.Path(zigpy.appdb.__file__).parent
+        / "appdb_schemas"
+        / f"schema_v{zigpy.appdb.DB_VERSION}.sql"
+    )
+    v = f"_v{zigpy.appdb.DB_VERSION}"
+
+    with sqlite3.connect(path) as conn:
+        conn.executescript(schema.read_text())
+
+        for ieee, nwk in DEVICES:
+            conn.execute(f"INSERT INTO devices{v} VALUES (?, ?, 2, 0)", (ieee, nwk))
+            conn.execute(f"INSERT INTO endpoints{v} VALUES (?, 1, 260, 0, 1)", (ieee,))
+            conn.execute(
+                f"INSERT INTO attributes_cache{v}"
+                f" (ieee, endpoint_id, cluster_type, cluster_id, attr_id, value,"
+                f"  last_updated)"
+                f" VALUES (?, 1, 0, 0, 4, ?, 0)",
+                (ieee, b"Manufacturer;\nName"),
+            )
+
+    conn.close()
+
+
+def dump_like_recover(path):
+    """
+    Dumps a database in the same order and format as `sqlite3 .recover`.
+    """
+
+    conn = sqlite3.connect(path)
+    schema = conn.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL"
+    ).fetchall()
+
+    yield "BEGIN;\n"
+    yield "PRAGMA writable_schema = on;\n"
+
+    for type_, name, sql in schema:
+        if name.startswith("sqlite_"):
+            continue
+
+        if type_ == "table" or (type_ == "index" and "UNIQUE" in sql):
+            yield f"{sql};\n"
+
+    for type_, table, _ in schema:
+        if type_ != "table":
+            continue
+
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+        quoted = ", ".join(f"quote({c})" for c in columns)
+        names = ", ".join(f'"{c}"' for c in ["_rowid_", *columns])
+
+        for values in conn.execute(f'SELECT quote(_rowid_), {quoted} FROM "{table}"'):
+            yield f'INSERT INTO "{table}"({names}) VALUES({", ".join(values)});\n'
+
+    for type_, _, sql in schema:
+        if type_ != "table" and "UNIQUE" not in sql:
+            yield f"{sql};\n"
+
+    yield "PRAGMA writable_schema = off;\n"
+    yield "COMMIT;\n"
+
+    conn.close()
+
+
+def test_sqlite3_iter_statements():
+    lines = [
+        "BEGIN;\n",
+        "INSERT INTO t VALUES('a;\n",
+        "b;');  INSERT INTO t VALUES(1);\n",
+        "CREATE TABLE t2(\n",
+        "  a INTEGER\n",
+        ");\n",
+        "COMMIT;",
+    ]
+
+    assert list(sqlite3_iter_statements(iter(lines))) == [
+        "BEGIN;",
+        "INSERT INTO t VALUES('a;\nb;');",
+        "INSERT INTO t VALUES(1);",
+        "CREATE TABLE t2(\n  a INTEGER\n);",
+        "COMMIT;",
+    ]
+
+    assert sqlite3_split_statements("".join(lines)) == list(
+        sqlite3_iter_statements(lines)
+    )
+
+
+def test_sqlite3_iter_statements_quoting(monkeypatch):
+    lines = [
+        "INSERT INTO \"a;b\" VALUES('it''s;', [c;d], `e;f`); -- comment;\n",
+        "/* comment; */ CREATE TRIGGER t AFTER INSERT ON a BEGIN\n",
+        "  DELETE FROM b; DELETE FROM c;\n",
+        "END;\n",
+        "INSERT INTO t VALUES('" + ";" * 100000 + "');\n",
+    ]
+
+    complete_statement = mock.Mock(wraps=sqlite3.complete_statement)
+    monkeypatch.setattr(sqlite3, "complete_statement", complete_statement)
+
+    assert list(sqlite3_iter_statements(lines)) == [
+        "INSERT INTO \"a;b\" VALUES('it''s;', [c;d], `e;f`);",
+        "-- comment;\n/* comment; */ CREATE TRIGGER t AFTER INSERT ON a BEGIN\n"
+        "  DELETE FROM b; DELETE FROM c;\nEND;",
+        "INSERT INTO t VALUES('" + ";" * 100000 + "');",
+    ]
+
+    # Semicolons in strings and comments are not checked, only those in the trigger
+    assert complete_statement.call_count == 5
+
+
+def test_sqlite3_iter_statements_incomplete(caplog):
+    assert list(sqlite3_iter_statements(["SELECT 1; SELECT 'a;"])) == ["SELECT 1;"]
+    assert "Incomplete data remains" in caplog.text
+
+
+@pytest.fixture
+def zigpy_database(tmp_path, monkeypatch):
+    path = tmp_path / "zigbee.db"
+    make_zigpy_database(path)
+
+    monkeypatch.setattr(zigpy_cli.database, "sqlite3_recover", dump_like_recover)
+
+    return path
+
+
+@pytest.mark.parametrize("batch_size", [1, 1000])
+def test_recover(zigpy_database, tmp_path, monkeypatch, caplog, batch_size):
+    real_recover = zigpy_cli.database.sqlite3_recover
+
+    def recover_with_duplicate(path):
+        for line in real_recover(path):
+            yield line
+
+            # Rows violating a unique constraint are skipped
+            if line.startswith('INSERT INTO "devices_v') and "VALUES(1," in line:
+                yield line.replace("VALUES(1,", "VALUES(100,")
+
+    monkeypatch.setattr(zigpy_cli.database, "sqlite3_recover", recover_with_duplicate)
+
+    output = tmp_path / "recovered.db"
+    result = CliRunner().invoke(
+        cli,
+        [
+            "db",
+            "recover",
+            "--backend",
+            "sqlite3",
+            "--batch-size",
+            str(batch_size),
+            str(zigpy_database),
+            str(output),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    assert caplog.text.count("Skipping INSERT") == 1
+
+    with sqlite3.connect(output) as conn:
+        v = f"_v{zigpy.appdb.DB_VERSION}"
+
+        assert conn.execute("PRAGMA user_version").fetchone() == (
+            zigpy.appdb.DB_VERSION,
+        )
+        assert conn.execute(f"SELECT ieee, nwk FROM devices{v}").fetchall() == DEVICES
+        assert conn.execute(f"SELECT value FROM attributes_cache{v}").fetchall() == [
+            (b"Manufacturer;\nName",)
+        ] * len(DEVICES)
+
+    conn.close()
+
+
+def test_recover_sqlite3_failure(zigpy_database, tmp_path, monkeypatch):
+    def failing_recover(path):
+        yield from itertools.islice(dump_like_recover(path), 10)
+        raise subprocess.CalledProcessError(1, ["sqlite3", str(path), ".recover"])
+
+    monkeypatch.setattr(zigpy_cli.database, "sqlite3_recover", failing_recover)
+
+    output = tmp_path / "recovered.db"
+    result = CliRunner().invoke(
+        cli, ["db", "recover", "--backend", "sqlite3", str(zigpy_database), str(output)]
+    )
+    assert isinstance(result.exception, subprocess.CalledProcessError)
+
+    # Nothing is left behind, not even the temporary database
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["zigbee.db"]
+
+
+def add_attributes(path, count):
+    v = f"_v{zigpy.appdb.DB_VERSION}"
+
+    with sqlite3.connect(path) as conn:
+        # Values larger than a page are stored in overflow pages
+        conn.executemany(
+            f"INSERT INTO attributes_cache{v}"
+            f" (ieee, endpoint_id, cluster_type, cluster_id, attr_id, value,"
+            f"  last_updated)"
+            f" VALUES (?, 2, 0, ?, ?, ?, ?)",
+            [
+                (DEVICES[0][0], i // 100, i % 100, bytes([i % 256]) * (i % 5000), i)
+                for i in range(count)
+            ],
+        )
+
+        # Deleted rows are on the freelist and must not be recovered
+        conn.execute(f"DELETE FROM attributes_cache{v} WHERE cluster_id = 3")
+
+    conn.close()
+
+
+def dump_tables(path):
+    conn = sqlite3.connect(path)
+    tables = [
+        name
+        for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master"
+            " WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )
+    ]
+    dump = {
+        table: conn.execute(f'SELECT _rowid_, * FROM "{table}" ORDER BY 1').fetchall()
+        for table in tables
+    }
+    conn.close()
+
+    return dump
+
+
+def recover_native(input_path, output_path):
+    result = CliRunner().invoke(
+        cli, ["db", "recover", str(input_path), str(output_path)]
+    )
+    assert result.exit_code == 0, result.output
+
+
+def test_recover_native(tmp_path):
+    make_zigpy_database(tmp_path / "zigbee.db")
+    add_attributes(tmp_path / "zigbee.db", 2000)
+
+    with (tmp_path / "zigbee.db").open("rb") as f, map_file(f) as view:
+        damaged_db = DamagedDatabase(view)
+        assert damaged_db.freelist_pages()
+        assert damaged_db.user_version == zigpy.appdb.DB_VERSION
+
+    recover_native(tmp_path / "zigbee.db", tmp_path / "recovered.db")
+
+    assert dump_tables(tmp_path / "recovered.db") == dump_tables(tmp_path / "zigbee.db")
+
+    with sqlite3.connect(tmp_path / "recovered.db") as conn:
+        assert conn.execute("PRAGMA integrity_check").fetchall() == [("ok",)]
+
+    conn.close()
+
+
+@pytest.mark.parametrize("analyze", [False, True])
+def test_recover_native_damaged(tmp_path, caplog, analyze):
+    path = tmp_path / "zigbee.db"
+    make_zigpy_database(path)
+    add_attributes(path, 2000)
+
+    if analyze:
+        # Rows of `sqlite_stat1` have as many columns as `group_members`
+        with sqlite3.connect(path) as conn:
+            conn.execute("ANALYZE")
+
+        conn.close()
+
+    expected = dump_tables(path)
+    attributes = f"attributes_cache_v{zigpy.appdb.DB_VERSION}"
+
+    with sqlite3.connect(path) as conn:
+        (page_size,) = conn.execute("PRAGMA page_size").fetchone()
+        (rootpage,) = conn.execute(
+            "SELECT rootpage FROM sqlite_master WHERE name = ?", (attributes,)
+        ).fetchone()
+
+    conn.close()
+
+    # Destroy the root page of the attribute cache: its leaf pages are orphaned
+    data = bytearray(path.read_bytes())
+    data[(rootpage - 1) * page_size : rootpage * page_size] = b"\xff" * page_size
+    path.write_bytes(data)
+
+    with pytest.raises(sqlite3.DatabaseError):
+        with sqlite3.connect(path) as conn:
+            conn.execute(f"SELECT * FROM {attributes}").fetchall()
+
+    conn.close()
+
+    recover_native(path, tmp_path / "recovered.db")
+    assert f"Skipping page {rootpage}" in caplog.text
+
+    recovered = dump_tables(tmp_path / "recovered.db")
+
+    # Every row of the attribute cache is on a leaf page and can still be recovered
+    assert recovered == expected
+
+
+def test_recover_native_wal(tmp_path):
+    path = tmp_path / "zigbee.db"
+    make_zigpy_database(path)
+
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA wal_autocheckpoint=0")
+
+    v = f"_v{zigpy.appdb.DB_VERSION}"
+    conn.execute(
+        f"INSERT INTO devices{v} VALUES (?, ?, 2, 0)", ("00:11:22:33:44:55:66:77", 1)
+    )
+    conn.execute(f"DELETE FROM attributes_cache{v}")
+
+    # Copy the database while its changes are only in the write-ahead log
+    copy_path = tmp_path / "copy.db"
+    copy_path.write_bytes(path.read_bytes())
+    wal = (tmp_path / "zigbee.db-wal").read_bytes()
+    expected = dump_tables(path)
+    conn.close()
+
+    # The main file alone does not have the new device
+    with copy_path.open("rb") as f, map_file(f) as view:
+        damaged_db = DamagedDatabase(view)
+        (rootpage,) = [
+            e.rootpage for e in damaged_db.read_schema() if e.name == f"devices{v}"
+        ]
+        assert len(list(damaged_db.iter_table_rows(rootpage))) == len(DEVICES)
+
+    # A partially written frame is not part of any transaction
+    (tmp_path / "copy.db-wal").write_bytes(wal + wal[32:100])
+    recover_native(copy_path, tmp_path / "recovered.db")
+
+    assert len(expected[f"devices{v}"]) == len(DEVICES) + 1
+    assert not expected[f"attributes_cache{v}"]
+    assert dump_tables(tmp_path / "recovered.db") == expected
+
+
+def test_verify(tmp_path):
+    make_zigpy_database(tmp_path / "zigbee.db")
+    before = (tmp_path / "zigbee.db").read_bytes()
+
+    report = asyncio.run(zigpy_cli.database.test_database(tmp_path / "zigbee.db"))
+
+    assert report.integrity_errors == []
+    assert report.foreign_key_errors == 0
+    assert sorted(str(d.ieee) for d in report.devices) == [ieee for ieee, _ in DEVICES]
+    assert report.endpoints == len(DEVICES)
+    assert report.attributes == len(DEVICES)
+
+    # The database is not migrated in place
+    assert (tmp_path / "zigbee.db").read_bytes() == before
+
+    result = CliRunner().invoke(cli, ["db", "verify", str(tmp_path / "zigbee.db")])
+    assert result.exit_code == 0, result.output
+
+
+def test_verify_without_radio_library():
+    code = "import sys, zigpy_cli.database; print('zigpy_znp' in sys.modules)"
+    output = subprocess.check_output([sys.executable, "-c", code], text=True)
+
+    assert output.strip() == "False"
+
+
+def test_get_obsolete_tables():
+    table_versions = {
+        "devices": "",
+        "devices_v9": "_v9",
+        "devices_v10": "_v10",
+        "devices_v11": "_v11",
+        "attributes": "",
+        "attributes_cache_v10": "_v10",
+        "attributes_cache_v11": "_v11",
+        "sqlite_sequence": "",
+        "addon_state": "",
+        "addon_state_v3": "_v3",
+    }
+
+    # Tables newer than the user_version are kept after a downgrade
+    assert zigpy_cli.database.get_obsolete_tables(table_versions, 10) == [
+        "attributes",
+        "devices",
+        "devices_v9",
+    ]
+    assert zigpy_cli.database.get_obsolete_tables(table_versions, 11) == [
+        "attributes",
+        "attributes_cache_v10",
+        "devices",
+        "devices_v10",
+        "devices_v9",
+    ]
+
+
+@pytest.mark.parametrize(
+    "table_version, error",
+    [
+        (zigpy.appdb.DB_VERSION, "but the maximum table version is"),
+        (zigpy.appdb.DB_VERSION + 1, "but zigpy only supports up to"),
+    ],
+)
+def test_optimize_refuses(tmp_path, table_version, error):
+    path = tmp_path / "zigbee.db"
+    make_zigpy_database(path)
+
+    with sqlite3.connect(path) as conn:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS devices_v{table_version} (ieee)")
+        conn.execute(f"PRAGMA user_version={zigpy.appdb.DB_VERSION + 1}")
+
+    conn.close()
+    before = dump_tables(path)
+
+    result = CliRunner().invoke(cli, ["db", "optimize", str(path)])
+    assert result.exit_code == 1
+    assert error in result.output
+    assert dump_tables(path) == before
+
+
+@pytest.mark.parametrize("dry_run", [False, True])
+def test_optimize(tmp_path, dry_run):
+    path = tmp_path / "zigbee.db"
+    make_zigpy_database(path)
+
+    v = zigpy.appdb.DB_VERSION
+    orphan = "11:22:33:44:55:66:77:88"
+
+    with sqlite3.connect(path) as conn:
+        conn.execute(f"CREATE TABLE devices_v{v - 1} (ieee, nwk)")
+        conn.execute("CREATE TABLE addon_state (key, value)")
+        conn.execute("INSERT INTO addon_state VALUES ('enabled', 1)")
+        conn.execute(
+            f"INSERT INTO routes_v{v} VALUES (?, 1, 0, 0, 0, 0, 0, 1)", (orphan,)
+        )
+        conn.execute(f"INSERT INTO endpoints_v{v} VALUES (?, 1, 260, 0, 1)", (orphan,))
+        conn.execute(f"INSERT INTO clusters_v{v} VALUES (?, 1, 0, 6)", (orphan,))
+
+    conn.close()
+    before = dump_tables(path)
+
+    args = ["db", "optimize", str(path)] + (["--dry-run"] if dry_run else [])
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert f"endpoints_v{v}" in result.output
+
+    after = dump_tables(path)
+
+    if dry_run:
+        assert after == before
+        return
+
+    assert f"devices_v{v - 1}" not in after
+    assert after["addon_state"] == before["addon_state"]
+    assert after[f"routes_v{v}"] == []
+    assert after[f"endpoints_v{v}"] == before[f"endpoints_v{v}"][:-1]
+    assert after[f"clusters_v{v}"] == []
+    assert after[f"devices_v{v}"] == before[f"devices_v{v}"]
+
+    report = asyncio.run(zigpy_cli.database.test_database(path))
+    assert report.foreign_key_errors == 0
+    assert len(report.devices) == len(DEVICES)
+
+
+def test_recovery_log_handler():
+    handler = zigpy_cli.database.RecoveryLogHandler()
+    logger = logging.getLogger("zigpy_cli.database")
+    logger.addHandler(handler)
+
+    try:
+        logger.info("Not collected")
+        logger.warning("Skipping %s", "row", extra=SKIPPED_ROW)
+        logger.error("Failed")
+    finally:
+        logger.removeHandler(handler)
+
+    assert handler.warnings == ["Skipping row", "Failed"]
+    assert handler.warning_count == 2
+    assert handler.skipped_rows == 1
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_recover_many(tmp_path, jobs):
+    for name in ["site1", "site2"]:
+        (tmp_path / "fleet" / name).mkdir(parents=True)
+        make_zigpy_database(tmp_path / "fleet" / name / "zigbee.db")
+
+    (tmp_path / "fleet" / "site3").mkdir()
+    (tmp_path / "fleet" / "site3" / "zigbee.db").write_bytes(b"garbage" * 1000)
+
+    output_dir = tmp_path / "recovered"
+    result = CliRunner().invoke(
+        cli,
+        [
+            "db",
+            "recover-many",
+            "--jobs",
+            str(jobs),
+            "--output-dir",
+            str(output_dir),
+            str(tmp_path / "fleet"),
+        ],
+    )
+    assert result.exit_code == 1
+    assert "Failed to recover 1 of 3 databases" in result.output
+
+    summary = json.loads((output_dir / "summary.json").read_text())
+    assert (summary["recovered"], summary["failed"]) == (2, 1)
+
+    site1, site2, site3 = summary["databases"]
+
+    for site in [site1, site2]:
+        assert site["error"] is None
+        assert site["devices"] == len(DEVICES)
+        assert site["skipped_rows"] == 0
+        assert dump_tables(site["output"]) == dump_tables(site["input"])
+
+    assert site2["output"] == str(output_dir / "site2" / "zigbee.db")
+    assert "does not have an SQLite header" in site3["error"]
+    assert not (output_dir / "site3" / "zigbee.db").exists()
+
+
+def test_find_databases(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "zigbee.db").touch()
+    (tmp_path / "a" / "notes.txt").touch()
+    (tmp_path / "b.db").touch()
+
+    assert zigpy_cli.database.find_databases(
+        [str(tmp_path / "a"), str(tmp_path / "*.db"), str(tmp_path / "b.db")]
+    ) == [tmp_path / "a" / "zigbee.db", tmp_path / "b.db"]
+
+    with pytest.raises(click.BadParameter):
+        zigpy_cli.database.find_databases([str(tmp_path / "missing.db")])
@@ -0,0 +1,100 @@
+import io
+import json
+
+import click
+import pytest
+from click.testing import CliRunner
+
+from zigpy_cli.__main__ import cli
+from zigpy_cli.fleet import FleetRadio, read_inventory
+
+
+def test_read_inventory():
+    inventory = io.StringIO(
+        "name,radio,port,baudrate,database\n"
+        "kitchen,znp,/dev/ttyUSB0,115200,/data/kitchen.db\n"
+        ",ezsp,socket://192.168.1.5:6638,,\n"
+    )
+
+    assert read_inventory(inventory) == [
+        FleetRadio(
+            name="kitchen",
+            radio="znp",
+            port="/dev/ttyUSB0",
+            baudrate=115200,
+            database="/data/kitchen.db",
+        ),
+        FleetRadio(
+            name="socket_192.168.1.5_6638",
+            radio="ezsp",
+            port="socket://192.168.1.5:6638",
+        ),
+    ]
+
+
+@pytest.mark.parametrize(
+    "inventory, error",
+    [
+        ("radio,baudrate\nznp,115200\n", "missing columns: port"),
+        ("radio,port\nfoo,/dev/ttyUSB0\n", "Line 2: 'foo' is not a radio type"),
+        ("radio,port,baudrate\nznp,/dev/ttyUSB0,fast\n", "'fast' is not a valid"),
+        ("radio,port\nznp,/dev/ttyUSB0\nezsp,/dev/ttyUSB0\n", "Line 3: radio name"),
+        ("name,radio,port\na,znp,/dev/a\nA,znp,/dev/b\n", "'A' is not unique"),
+        ("name,radio,port\nSummary,znp,/dev/ttyUSB0\n", "'Summary' is reserved"),
+        ("name,radio,port\n../x,znp,/dev/ttyUSB0\n", "'../x' is not a valid"),
+        ("name,radio,port\na\\b,znp,/dev/ttyUSB0\n", "is not a valid file name"),
+        ("name,radio,port\n..,znp,/dev/ttyUSB0\n", "'..' is not a valid"),
+        ("radio,port\nznp,///\n", "'' is not a valid file name"),
+    ],
+)
+def test_read_inventory_invalid(inventory, error):
+    with pytest.raises(click.BadParameter, match=error):
+        read_inventory(io.StringIO(inventory))
+
+
+@pytest.mark.parametrize("command", [["backup"], ["info"], ["energy-scan", "-n", "2"]])
+def test_fleet(tmp_path, command):
+    inventory = tmp_path / "inventory.csv"
+    inventory.write_text(
+        "name,radio,port\n"
+        "small,sim,sim://?devices=2&seed=1\n"
+        "large,sim,sim://?devices=20&seed=2\n"
+        "slow,sim,sim://?latency=10\n"
+    )
+
+    output_dir = tmp_path / "output"
+    result = CliRunner().invoke(
+        cli,
+        ["fleet", "--jobs", "2", "--timeout", "0.5", str(inventory), str(output_dir)]
+        + command,
+    )
+
+    assert result.exit_code == 1
+    assert "Failed on 1 of 3 radios" in result.output
+
+    summary = json.loads((output_dir / "summary.json").read_text())
+    assert summary["succeeded"] == 2
+    assert summary["failed"] == 1
+    assert [radio["error"] for radio in summary["radios"]] == [
+        None,
+        None,
+        "Timed out after 0.5s",
+    ]
+
+    # The slow radio does not produce any output
+    assert sorted(p.name for p in output_dir.iterdir()) == [
+        "large.json",
+        "small.json",
+        "summary.json",
+    ]
+
+    small = json.loads((output_dir / "small.json").read_text())
+    large = json.loads((output_dir / "large.json").read_text())
+
+    if command == ["backup"]:
+        assert small["coordinator_ieee"] != large["coordinator_ieee"]
+    elif command == ["info"]:
+        assert small["network_info"]["pan_id"] != large["network_info"]["pan_id"]
+    else:
+        assert small["scans"] == 2
+        assert len(small["channels"]) == 16
@@ -0,0 +1,254 @@
+import asyncio
+import time
+import types
+
+import pytest
+import zigpy.device
+import zigpy.exceptions
+import zigpy.serial
+import zigpy.types as t
+import zigpy.zcl.foundation as foundation
+import zigpy.zdo.types as zdo_t
+from click.testing import CliRunner
+from zigpy.zcl.clusters.general import Basic
+
+from zigpy_cli.__main__ import cli
+from zigpy_cli.metrics import PENDING_REQUEST_MAX_AGE, LatencyHistogram, RadioMetrics
+from zigpy_cli.radio import create_app
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(50) is None
+
+    for latency in [0.0005, 0.003, 0.003, 0.004, 0.040, 30.0]:
+        histogram.add(latency)
+
+    summary = histogram.as_dict()
+    assert summary["count"] == 6
+    assert summary["max_ms"] == 30000.0
+    assert summary["p50_ms"] == 5
+    assert summary["p95_ms"] == 30000.0
+    assert summary["buckets"]["<=1ms"] == 1
+    assert summary["buckets"]["<=5ms"] == 3
+    assert summary["buckets"]["<=50ms"] == 1
+    assert summary["buckets"][">10000ms"] == 1
+
+
+class FakeApp:
+    def __init__(self):
+        self.received = []
+        self.fail = False
+
+    async def send_packet(self, packet):
+        if self.fail:
+            raise zigpy.exceptions.DeliveryError("Failed")
+
+    async def request(self, *, device, sequence, **kwargs):
+        await self.send_packet(sequence)
+
+    def packet_received(self, packet):
+        self.received.append(packet)
+
+
+def make_packet(nwk, tsn, *, zdo=False):
+    if zdo:
+        data = bytes([tsn]) + zdo_t.Status.SUCCESS.serialize()
+    else:
+        data = foundation.ZCLHeader.general(
+            tsn=tsn,
+            command_id=foundation.GeneralCommand.Default_Response,
+            direction=foundation.Direction.Server_to_Client,
+        ).serialize()
+
+    return t.ZigbeePacket(
+        src=t.AddrModeAddress(addr_mode=t.AddrMode.NWK, address=t.NWK(nwk)),
+        src_ep=0 if zdo else 1,
+        profile_id=0 if zdo else 260,
+        # Radio libraries set the APS counter, which is unrelated to the request TSN
+        tsn=0xAA,
+        data=t.SerializableBytes(data),
+    )
+
+
+def test_radio_metrics_requests():
+    asyncio.run(check_radio_metrics_requests())
+
+
+async def check_radio_metrics_requests():
+    app = FakeApp()
+    metrics = RadioMetrics()
+    metrics.instrument_app(app)()
+
+    device = types.SimpleNamespace(nwk=t.NWK(0x1234))
+
+    # Answered
+    await app.request(device=device, sequence=1, expect_reply=True)
+    app.packet_received(make_packet(0x1234, 1, zdo=True))
+
+    # Sent twice before being answered
+    await app.request(device=device, sequence=2)
+    await app.request(device=device, sequence=2, force_route_discovery=True)
+    app.packet_received(make_packet(0x1234, 2))
+
+    # Never answered
+    await app.request(device=device, sequence=3)
+
+    # Not delivered
+    app.fail = True
+
+    with pytest.raises(zigpy.exceptions.DeliveryError):
+        await app.request(device=device, sequence=4)
+
+    # Unsolicited
+    app.packet_received(make_packet(0x5678, 1))
+
+    summary = metrics.as_dict()
+    assert summary["frames"] == {"sent": 5, "received": 3, "send_errors": 1}
+    assert summary["requests"] == {"count": 5, "retries": 1, "timeouts": 0}
+    assert summary["send_latency"]["count"] == 4
+    assert summary["response_latency"]["count"] == 2
+    assert len(app.received) == 3
+
+    # Requests that are never answered do not accumulate
+    now = time.perf_counter()
+    metrics._expire_pending(now + PENDING_REQUEST_MAX_AGE)
+    assert not metrics._pending
+
+
+def test_radio_metrics_timeouts():
+    asyncio.run(check_radio_metrics_timeouts())
+
+
+async def check_radio_metrics_timeouts():
+    app = create_app("sim", "sim://?devices=2&latency=0", baudrate=None, database=None)
+    metrics = RadioMetrics()
+    remove = metrics.instrument_app(app)
+
+    await app.connect()
+    _, sim_device, *_ = app._network.values()
+    device = app.add_device(sim_device.ieee, sim_device.nwk)
+    device.node_desc = zdo_t.NodeDescriptor(logical_type=zdo_t.LogicalType.Router)
+    device.add_endpoint(1).add_input_cluster(Basic.cluster_id)
+
+    def zcl_request(command_id, sequence, payload=b""):
+        hdr = foundation.ZCLHeader.general(tsn=sequence, command_id=command_id)
+
+        return device.request(
+            profile=260,
+            cluster=Basic.cluster_id,
+            src_ep=1,
+            dst_ep=1,
+            sequence=sequence,
+            data=hdr.serialize() + payload,
+            timeout=0.1,
+            retries=1,
+            retry_delay=0,
+        )
+
+    try:
+        await zcl_request(foundation.GeneralCommand.Read_Attributes, 10, b"\x00\x00")
+
+        # The simulated radio only answers attribute reads
+        with pytest.raises(asyncio.TimeoutError):
+            await zcl_request(foundation.GeneralCommand.Discover_Commands_Received, 11)
+    finally:
+        remove()
+        await app.disconnect()
+
+    # zigpy may also send ZDO requests of its own, every answered one is matched
+    summary = metrics.as_dict()
+    assert summary["requests"]["retries"] == 1
+    assert summary["requests"]["timeouts"] == 1
+    assert summary["response_latency"]["count"] == summary["requests"]["count"] - 2
+
+
+def test_radio_metrics_overlapping(monkeypatch):
+    async def request(device, *args, **kwargs):
+        raise asyncio.TimeoutError()
+
+    monkeypatch.setattr(zigpy.device.Device, "request", request)
+
+    apps = [FakeApp(), FakeApp()]
+    metrics = [RadioMetrics(), RadioMetrics()]
+    removes = [m.instrument_app(app) for m, app in zip(metrics, apps)]
+
+    async def send(app):
+        device = types.SimpleNamespace(application=app)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await zigpy.device.Device.request(device)
+
+    # Timeouts are only counted for the devices of each application
+    asyncio.run(send(apps[0]))
+    asyncio.run(send(apps[1]))
+    asyncio.run(send(apps[1]))
+    assert [m.timeouts for m in metrics] == [1, 2]
+
+    # Instrumentation can be removed in any order
+    removes[0]()
+    asyncio.run(send(apps[1]))
+    assert [m.timeouts for m in metrics] == [1, 3]
+
+    removes[0]()
+    removes[1]()
+    assert zigpy.device.Device.request is request
+
+
+def test_radio_metrics_serial():
+    asyncio.run(check_radio_metrics_serial())
+
+
+async def check_radio_metrics_serial():
+    async def echo(reader, writer):
+        while data := await reader.read(100):
+            writer.write(data)
+
+        writer.close()
+
+    server = await asyncio.start_server(echo, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    metrics = RadioMetrics()
+    remove_hook = metrics.install_serial_hook()
+
+    received = asyncio.Queue()
+
+    class Protocol(zigpy.serial.SerialProtocol):
+        def data_received(self, data):
+            received.put_nowait(data)
+
+    try:
+        transport, protocol = await zigpy.serial.create_serial_connection(
+            asyncio.get_running_loop(), Protocol, f"socket://127.0.0.1:{port}"
+        )
+    finally:
+        remove_hook()
+
+    transport.write(b"hello")
+    assert await asyncio.wait_for(received.get(), 5) == b"hello"
+
+    transport.write(b"!")
+    assert await asyncio.wait_for(received.get(), 5) == b"!"
+
+    protocol.close()
+    server.close()
+    await server.wait_closed()
+
+    assert metrics.as_dict()["serial"] == {
+        "bytes_sent": 6,
+        "bytes_received": 6,
+        "writes": 2,
+        "reads": 2,
+    }
+
+
+def test_radio_metrics_cli():
+    result = CliRunner().invoke(
+        cli, ["radio", "--metrics", "sim", "sim://", "benchmark", "-n", "5"]
+    )
+
+    assert result.exit_code == 0, result.output
+    assert "Radio metrics:" in result.stderr
+    assert " - frames sent: " in result.stderr
+    assert " - response latency: count=" in result.stderr
@@ -0,0 +1,628 @@
+import gzip
+import io
+import json
+import pathlib
+import struct
+from unittest import mock
+
+import pytest
+import zigpy.types as t
+import zigpy.zcl.foundation as foundation
+from click.testing import CliRunner
+from cryptography.hazmat.primitives.ciphers.aead import AESCCM
+from scapy.layers.dot15d4 import Dot15d4Data, Dot15d4FCS
+from scapy.layers.inet import IP, UDP
+from scapy.layers.l2 import Ether
+from scapy.layers.zigbee import ZigbeeAppDataPayload, ZigbeeNWK, ZigbeeSecurityHeader
+from scapy.utils import wrpcap
+from zigpy.ota.image import (
+    ElementTagId,
+    OTAImage,
+    OTAImageHeader,
+    SubElement,
+    parse_ota_image,
+)
+from zigpy.zcl.clusters.general import Ota
+
+import zigpy_cli.ota
+from zigpy_cli.__main__ import cli
+from zigpy_cli.ota import (
+    OTAImageAssembler,
+    extract_ota_images_native,
+    extract_ota_images_tshark,
+    iter_tshark_ota_packets,
+    parse_ota_image_view,
+    parse_tshark_int,
+)
+
+
+def test_assembler_merges_chunks():
+    assembler = OTAImageAssembler()
+
+    assert assembler.add_chunk(4, b"efgh") == []
+    assert assembler.add_chunk(0, b"abcd") == []
+    assert assembler.add_chunk(12, b"mn") == []
+
+    # Adjacent and overlapping chunks are merged
+    assert assembler.intervals == [(0, 8), (12, 14)]
+    assert assembler.size == 14
+
+    assert assembler.add_chunk(6, b"ghijkl") == []
+    assert assembler.intervals == [(0, 14)]
+    assert assembler.missing_ranges(14) == []
+    assert assembler.assemble(14, fill_byte=0xAB) == b"abcdefghijklmn"
+
+
+def test_assembler_conflicts():
+    assembler = OTAImageAssembler()
+    assembler.add_chunk(0, b"abcd")
+    assembler.add_chunk(8, b"ijkl")
+
+    assert assembler.add_chunk(2, b"cXefghiY") == [(2, b"cd", b"cX"), (8, b"ij", b"iY")]
+
+    # The most recent chunk wins
+    assert assembler.assemble(12, fill_byte=0xAB) == b"abcXefghiYkl"
+
+
+def test_assembler_missing_ranges():
+    assembler = OTAImageAssembler()
+    assembler.add_chunk(2, b"cd")
+    assembler.add_chunk(7, b"h")
+
+    assert assembler.missing_ranges(10) == [(0, 2), (4, 3), (8, 2)]
+    assert assembler.missing_ranges(5) == [(0, 2), (4, 1)]
+    assert assembler.assemble(10, fill_byte=0xAB) == b"\xab\xabcd\xab\xab\xabh\xab\xab"
+
+    # Data beyond the image size is dropped
+    assert assembler.assemble(3, fill_byte=0xAB) == b"\xab\xabc"
+
+
+def test_assembler_merge():
+    first = OTAImageAssembler()
+    first.add_chunk(0, b"abcd")
+
+    second = OTAImageAssembler()
+    second.add_chunk(2, b"cdef")
+    second.add_chunk(10, b"k")
+
+    assert first.merge(second) == []
+    assert first.intervals == [(0, 6), (10, 11)]
+    assert first.assemble(11, fill_byte=0x00) == b"abcdef\x00\x00\x00\x00k"
+
+
+def make_zigbee_nonce(source, frame_counter, security_control):
+    # Zigbee specification 4.5.2.2, every field is little endian
+    return struct.pack("<QIB", source, frame_counter, security_control)
+
+
+def test_zigbee_nonce_known_answer():
+    # Zigbee specification Annex C.6.1, the CCM* test vector with security level 6
+    key = bytes(range(0xC0, 0xD0))
+    nonce = make_zigbee_nonce(0xA7A6A5A4A3A2A1A0, 0x00010203, 0x06)
+    assert nonce == bytes.fromhex("A0A1A2A3A4A5A6A7 03020100 06")
+
+    ciphertext = AESCCM(key, tag_length=8).encrypt(
+        nonce, bytes(range(0x08, 0x1E)), bytes(range(0x00, 0x08))
+    )
+    assert ciphertext[:-8] == bytes.fromhex(
+        "1A55A36ABB6C610D066B3375649CEF10D4664ECAD854"
+    )
+
+
+def make_ota_packet(command_id, payload, *, key, frame_counter):
+    hdr = foundation.ZCLHeader.cluster(
+        tsn=frame_counter & 0xFF,
+        command_id=command_id,
+        direction=foundation.Direction.Server_to_Client,
+    )
+    aps = ZigbeeAppDataPayload(
+        frame_control=0,
+        delivery_mode=0,
+        aps_frametype=0,
+        dst_endpoint=1,
+        cluster=Ota.cluster_id,
+        profile=0x0104,
+        src_endpoint=1,
+        counter=1,
+    )
+    plaintext = bytes(aps) + hdr.serialize() + payload.serialize()
+
+    nwk = ZigbeeNWK(
+        frametype=0,
+        flags="security",
+        destination=0x1234,
+        source=0x0000,
+        radius=30,
+        seqnum=frame_counter & 0xFF,
+    )
+    source = 0x0011223344556677
+    aux_header = ZigbeeSecurityHeader(
+        nwk_seclevel=0,
+        key_type=1,
+        extended_nonce=1,
+        fc=frame_counter,
+        source=source,
+        key_seqnum=0,
+    )
+
+    # The frame is secured with level 5 (ENC-MIC-32), which is zeroed over the air.
+    # The nonce and MIC are built from the fields, independently of the receiver.
+    security_control = 0b101 | 1 << 3 | 1 << 5
+    aux_fields = struct.pack("<BIQB", security_control, frame_counter, source, 0)
+    assert bytes(aux_header) == bytes([security_control & ~0b111]) + aux_fields[1:]
+
+    ciphertext = AESCCM(key.serialize(), tag_length=4).encrypt(
+        make_zigbee_nonce(source, frame_counter, security_control),
+        plaintext,
+        bytes(nwk) + aux_fields,
+    )
+
+    aux_header.data = ciphertext
+
+    return (
+        Dot15d4FCS(
+            fcf_frametype=1,
+            fcf_panidcompress=1,
+            fcf_destaddrmode=2,
+            fcf_srcaddrmode=2,
+            seqnum=frame_counter & 0xFF,
+        )
+        / Dot15d4Data(dest_panid=0xABCD, dest_addr=0x1234, src_addr=0x0000)
+        / nwk
+        / aux_header
+    )
+
+
+def test_extract_ota_images_native(tmp_path):
+    key = t.KeyData.convert("11:22:33:44:55:66:77:88:99:AA:BB:CC:DD:EE:FF:00")
+    wrong_key = t.KeyData.convert("00:00:00:00:00:00:00:00:00:00:00:00:00:00:00:00")
+    image = dict(manufacturer_code=0x115F, image_type=0x298B, file_version=5)
+
+    query_rsp = Ota.ClientCommandDefs.query_next_image_response
+    block_rsp = Ota.ClientCommandDefs.image_block_response
+
+    packets = [
+        make_ota_packet(
+            query_rsp.id,
+            query_rsp.schema(status=foundation.Status.SUCCESS, image_size=8, **image),
+            key=key,
+            frame_counter=1,
+        ),
+        make_ota_packet(
+            block_rsp.id,
+            block_rsp.schema(
+                status=foundation.Status.SUCCESS,
+                file_offset=0,
+                image_data=b"abcd",
+                **image,
+            ),
+            key=key,
+            frame_counter=2,
+        ),
+        # Packets encrypted with an unknown key are ignored
+        make_ota_packet(
+            block_rsp.id,
+            block_rsp.schema(
+                status=foundation.Status.SUCCESS,
+                file_offset=4,
+                image_data=b"efgh",
+                **image,
+            ),
+            key=wrong_key,
+            frame_counter=3,
+        ),
+    ]
+
+    wrpcap(str(tmp_path / "ota.pcap"), packets)
+
+    sizes, images = extract_ota_images_native(tmp_path / "ota.pcap", keys=[key])
+
+    assert sizes == {(5, 0x298B, 0x115F): 8}
+    assert images[(5, 0x298B, 0x115F)].intervals == [(0, 4)]
+    assert images[(5, 0x298B, 0x115F)].data == b"abcd"
+
+
+def test_extract_ota_images_native_no_zigbee(tmp_path, caplog):
+    wrpcap(str(tmp_path / "ether.pcap"), [Ether() / IP() / UDP()] * 3)
+
+    sizes, images = extract_ota_images_native(tmp_path / "ether.pcap", keys=[])
+
+    assert sizes == {}
+    assert images == {}
+    assert "None of the 3 packets" in caplog.text
+    assert "--backend tshark" in caplog.text
+
+
+def test_reconstruct_from_pcaps_jobs(tmp_path):
+    key = t.KeyData.convert("11:22:33:44:55:66:77:88:99:AA:BB:CC:DD:EE:FF:00")
+    image = dict(manufacturer_code=0x115F, image_type=0x298B, file_version=5)
+
+    query_rsp = Ota.ClientCommandDefs.query_next_image_response
+    block_rsp = Ota.ClientCommandDefs.image_block_response
+
+    def block(offset, data):
+        return make_ota_packet(
+            block_rsp.id,
+            block_rsp.schema(
+                status=foundation.Status.SUCCESS,
+                file_offset=offset,
+                image_data=data,
+                **image,
+            ),
+            key=key,
+            frame_counter=10 + offset,
+        )
+
+    # Each capture has half of the image's blocks
+    wrpcap(
+        str(tmp_path / "1.pcap"),
+        [
+            make_ota_packet(
+                query_rsp.id,
+                query_rsp.schema(
+                    status=foundation.Status.SUCCESS, image_size=16, **image
+                ),
+                key=key,
+                frame_counter=1,
+            ),
+            block(0, b"abcd"),
+            block(8, b"ijkl"),
+        ],
+    )
+    wrpcap(str(tmp_path / "2.pcap"), [block(12, b"mnop"), block(4, b"efgh")])
+
+    outputs = {}
+
+    for jobs in (1, 2):
+        output_root = tmp_path / f"jobs{jobs}"
+        result = CliRunner().invoke(
+            cli,
+            [
+                "ota",
+                "reconstruct-from-pcaps",
+                "--add-network-key",
+                str(key),
+                "--output-root",
+                str(output_root),
+                "--jobs",
+                str(jobs),
+                str(tmp_path / "1.pcap"),
+                str(tmp_path / "2.pcap"),
+            ],
+        )
+        assert result.exit_code == 0, result.output
+
+        outputs[jobs] = {p.name: p.read_bytes() for p in output_root.iterdir()}
+
+    assert outputs[2] == outputs[1]
+    assert outputs[1] == {"ota_t0x298b_m0x115f_v0x00000005.ota": b"abcdefghijklmnop"}
+
+
+@pytest.mark.parametrize(
+    "text, value",
+    [("0", 0), ("4096", 4096), ("0x00001000", 0x1000), ("0X1a", 0x1A)],
+)
+def test_parse_tshark_int(text, value):
+    assert parse_tshark_int(text) == value
+
+
+def fake_tshark(monkeypatch, output, returncode=0):
+    commands = []
+
+    class FakePopen:
+        def __init__(self, command, **kwargs):
+            commands.append(command)
+            self.stdout = io.StringIO(output)
+            self.returncode = returncode
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+    monkeypatch.setattr(zigpy_cli.ota.subprocess, "Popen", FakePopen)
+
+    return commands
+
+
+def test_iter_tshark_ota_packets(monkeypatch, caplog):
+    commands = fake_tshark(
+        monkeypatch,
+        # Query next image response, with fields in hex
+        "0x00\t0x00000005\t0x0001\t0x1000\t0x0000000a\t\t\n"
+        # Image block responses, with fields in decimal and repeated fields
+        "0\t5\t1\t4096\t\t0\t61:62:63:64\n"
+        "0,0\t5,5\t1\t4096\t\t4,8\t65:66:67:68,00:00\n"
+        # Failed responses do not have the other fields
+        "0x95\t\t\t\t\t\t\n" "\t\t\t\t\t\t\n",
+    )
+
+    packets = list(iter_tshark_ota_packets(pathlib.Path("ota.pcap"), "keys"))
+
+    assert commands[0][:5] == [
+        "tshark",
+        "-o",
+        "uat:zigbee_pc_keys:keys",
+        "-r",
+        "ota.pcap",
+    ]
+    assert commands[0].count("-e") == len(zigpy_cli.ota.TSHARK_OTA_FIELDS)
+    assert packets[2] == {
+        "status": "0",
+        "file_version": "5",
+        "image_type": "1",
+        "manufacturer_code": "4096",
+        "image_size": "",
+        "file_offset": "4",
+        "image_data": "65:66:67:68",
+    }
+    assert packets[4]["status"] == ""
+    assert "tshark exited" not in caplog.text
+
+    ota_sizes, ota_images = extract_ota_images_tshark(pathlib.Path("ota.pcap"), "keys")
+    assert ota_sizes == {(5, 1, 0x1000): 10}
+    assert ota_images[(5, 1, 0x1000)].intervals == [(0, 8)]
+
+
+def test_iter_tshark_ota_packets_failure(monkeypatch, caplog):
+    fake_tshark(monkeypatch, "0\t5\t1\t4096\t\t0\t61:62\n", returncode=2)
+
+    # Packets read before tshark failed are kept, the failure is logged
+    packets = list(iter_tshark_ota_packets(pathlib.Path("ota.pcap"), "keys"))
+
+    assert len(packets) == 1
+    assert "tshark exited with code 2 for ota.pcap" in caplog.text
+
+
+def make_ota_image(file_version, manufacturer_id, data):
+    subelement = SubElement(tag_id=ElementTagId.UPGRADE_IMAGE, data=data)
+    header = OTAImageHeader(
+        upgrade_file_id=OTAImageHeader.MAGIC_VALUE,
+        header_version=256,
+        header_length=56,
+        field_control=0,
+        manufacturer_id=manufacturer_id,
+        image_type=0x1234,
+        file_version=file_version,
+        stack_version=2,
+        header_string="zigpy-cli test".ljust(32, "\x00"),
+        image_size=56 + 6 + len(data),
+    )
+
+    return OTAImage(header=header, subelements=[subelement]).serialize()
+
+
+def test_generate_index_cache(tmp_path, monkeypatch):
+    for i in range(3):
+        image = make_ota_image(i, 0x1000 + i, bytes([i]) * 100)
+        (tmp_path / f"{i}.ota").write_bytes(image)
+
+    index = tmp_path / "index.json"
+    args = [
+        "ota",
+        "generate-index",
+        "--cache",
+        str(tmp_path / "cache.db"),
+        "--output",
+        str(index),
+        *[str(tmp_path / f"{i}.ota") for i in range(3)],
+    ]
+
+    assert CliRunner().invoke(cli, args).exit_code == 0
+    first = index.read_text()
+
+    # Unchanged images are not parsed again
+    parse = mock.Mock(wraps=zigpy_cli.ota.parse_ota_index_metadata)
+    monkeypatch.setattr(zigpy_cli.ota, "parse_ota_index_metadata", parse)
+
+    assert CliRunner().invoke(cli, args).exit_code == 0
+    assert index.read_text() == first
+    assert parse.call_count == 0
+
+    (tmp_path / "1.ota").write_bytes(make_ota_image(5, 0x1001, b"new"))
+
+    assert CliRunner().invoke(cli, args).exit_code == 0
+    assert parse.call_count == 1
+    assert [e["file_version"] for e in json.loads(index.read_text())] == [0, 5, 2]
+
+
+def make_hue_sbl_image(data):
+    header = OTAImageHeader(
+        upgrade_file_id=OTAImageHeader.MAGIC_VALUE,
+        header_version=256,
+        header_length=56,
+        field_control=0,
+        manufacturer_id=4107,
+        image_type=0x0100,
+        file_version=1,
+        stack_version=2,
+        header_string="zigpy-cli test".ljust(32, "\x00"),
+        image_size=56 + len(data),
+    )
+
+    return header.serialize() + data
+
+
+@pytest.mark.parametrize(
+    "contents",
+    [
+        make_ota_image(1, 0x1000, b"firmware"),
+        make_ota_image(1, 0x1000, b"firmware") + b"trailing",
+        make_hue_sbl_image(b"\x2a\x00\x01firmware"),
+        # Containers are parsed by zigpy
+        b"NGIS"
+        + b"\x00" * 12
+        + (24).to_bytes(4, "little")
+        + (70).to_bytes(4, "little")
+        + make_ota_image(1, 0x1000, b"firmware")
+        + b"\x00",
+    ],
+)
+def test_parse_ota_image_view(contents):
+    assert parse_ota_image_view(memoryview(contents)) == parse_ota_image(contents)
+
+
+@pytest.mark.parametrize(
+    "contents,firmware",
+    [
+        (make_ota_image(1, 0x1000, b"firmware"), b"firmware"),
+        (make_hue_sbl_image(b"\x2a\x00\x01firmware"), b"\x2a\x00\x01firmware"),
+    ],
+)
+def test_dump_firmware(tmp_path, contents, firmware):
+    (tmp_path / "image.ota").write_bytes(contents)
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "ota",
+            "dump-firmware",
+            str(tmp_path / "image.ota"),
+            str(tmp_path / "firmware.bin"),
+        ],
+    )
+
+    assert result.exit_code == 0
+    assert (tmp_path / "firmware.bin").read_bytes() == firmware
+
+
+def test_generate_index_update(tmp_path, monkeypatch):
+    for i in range(3):
+        image = make_ota_image(i, 0x1000 + i, bytes([i]) * 100)
+        (tmp_path / f"{i}.ota").write_bytes(image)
+
+    index = tmp_path / "index.json"
+    args = ["ota", "generate-index", "--update", str(index)]
+
+    result = CliRunner().invoke(
+        cli, args + [str(tmp_path / f"{i}.ota") for i in (0, 1)]
+    )
+    assert result.exit_code == 0
+
+    entries = json.loads(index.read_text())
+    assert [e["file_version"] for e in entries] == [0, 1]
+
+    # Edits to existing entries are kept
+    entries[0]["changelog"] = "Fixed things"
+    index.write_text(json.dumps(entries))
+
+    parse = mock.Mock(wraps=zigpy_cli.ota.parse_ota_index_metadata)
+    monkeypatch.setattr(zigpy_cli.ota, "parse_ota_index_metadata", parse)
+    read_key = mock.Mock(wraps=zigpy_cli.ota.read_ota_index_key)
+    monkeypatch.setattr(zigpy_cli.ota, "read_ota_index_key", read_key)
+
+    result = CliRunner().invoke(
+        cli, args + [str(tmp_path / f"{i}.ota") for i in (0, 2)]
+    )
+    assert result.exit_code == 0
+
+    # Only the new image is read and the missing one is dropped
+    assert read_key.mock_calls == [mock.call(tmp_path / "2.ota")]
+    assert parse.mock_calls == [mock.call(tmp_path / "2.ota")]
+
+    entries = json.loads(index.read_text())
+    assert [e["file_version"] for e in entries] == [0, 2]
+    assert entries[0]["changelog"] == "Fixed things"
+
+    # Without a cache, images are matched by their header and checksum
+    (tmp_path / "index.json.cache").unlink()
+    entries[1]["file_version"] = 3
+    index.write_text(json.dumps(entries))
+    parse.reset_mock()
+
+    result = CliRunner().invoke(
+        cli, args + [str(tmp_path / f"{i}.ota") for i in (0, 2)]
+    )
+    assert result.exit_code == 0
+
+    assert parse.mock_calls == [mock.call(tmp_path / "2.ota")]
+
+    entries = json.loads(index.read_text())
+    assert [e["file_version"] for e in entries] == [0, 2]
+    assert entries[0]["changelog"] == "Fixed things"
+
+
+def test_generate_index_update_keeps_urls(tmp_path):
+    for i in range(2):
+        image = make_ota_image(i, 0x1000, bytes([i]) * 100)
+        (tmp_path / f"{i}.ota").write_bytes(image)
+
+    index = tmp_path / "index.json"
+    args = ["ota", "generate-index", "--update", str(index)]
+
+    result = CliRunner().invoke(
+        cli,
+        [*args, "--ota-url-root", "https://example.com/ota", str(tmp_path / "0.ota")],
+    )
+    assert result.exit_code == 0, result.output
+
+    result = CliRunner().invoke(
+        cli, [*args, str(tmp_path / "0.ota"), str(tmp_path / "1.ota")]
+    )
+    assert result.exit_code == 0, result.output
+
+    entries = json.loads(index.read_text())
+    assert [e["binary_url"] for e in entries] == [
+        "https://example.com/ota/0.ota",
+        None,
+    ]
+
+    # Only URLs of new images are derived from `--ota-url-root`
+    (tmp_path / "2.ota").write_bytes(make_ota_image(2, 0x1000, b"\x02" * 100))
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            *args,
+            "--ota-url-root",
+            "https://mirror.example.com/",
+            *[str(tmp_path / f"{i}.ota") for i in range(3)],
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    entries = json.loads(index.read_text())
+    assert [e["binary_url"] for e in entries] == [
+        "https://example.com/ota/0.ota",
+        None,
+        "https://mirror.example.com/2.ota",
+    ]
+
+
+def test_generate_index_sharded(tmp_path):
+    for i in range(4):
+        image = make_ota_image(i, 0x1000 + i % 2, bytes([i]) * 100)
+        (tmp_path / f"{i}.ota").write_bytes(image)
+
+    shard_dir = tmp_path / "index"
+    shard_dir.mkdir()
+    (shard_dir / "1234.json.gz").write_bytes(b"stale")
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "ota",
+            "generate-index",
+            "--shard-dir",
+            str(shard_dir),
+            "--compact",
+            "--gzip",
+            *[str(tmp_path / f"{i}.ota") for i in range(4)],
+        ],
+    )
+    assert result.exit_code == 0
+
+    manifest = json.loads((shard_dir / "index.json").read_text())
+    assert [(m["manufacturer_id"], m["images"]) for m in manifest] == [
+        (0x1000, 2),
+        (0x1001, 2),
+    ]
+    assert sorted(p.name for p in shard_dir.iterdir()) == [
+        "4096.json.gz",
+        "4097.json.gz",
+        "index.json",
+    ]
+
+    shard = json.loads(gzip.decompress((shard_dir / "4097.json.gz").read_bytes()))
+    assert [e["file_version"] for e in shard] == [1, 3]
@@ -0,0 +1,136 @@
+import os
+import struct
+
+import pytest
+from click.testing import CliRunner
+from scapy.layers.dot15d4 import Dot15d4FCS
+from scapy.utils import PcapNgWriter, rdpcap, wrpcap
+
+from zigpy_cli.pcap import ieee802154_fcs, pcap
+
+
+def make_frames(count):
+    frames = []
+
+    for i in range(count):
+        frame = bytearray(bytes(Dot15d4FCS(seqnum=i & 0xFF) / os.urandom(i % 40)))
+        frame[-2:] = b"\x00\x00"  # invalid FCS
+        frames.append(Dot15d4FCS(bytes(frame)))
+
+    return frames
+
+
+def assert_fcs_valid(path):
+    packets = rdpcap(str(path))
+    assert len(packets) == 100
+
+    for packet in packets:
+        raw = bytes(packet)
+        assert raw[-2:] == Dot15d4FCS().compute_fcs(raw[:-2])
+
+
+@pytest.mark.parametrize("length", [0, 1, 2, 16, 127])
+def test_ieee802154_fcs(length):
+    data = os.urandom(length)
+    assert ieee802154_fcs(data) == Dot15d4FCS().compute_fcs(data)
+
+
+@pytest.mark.parametrize("pcapng", [False, True])
+def test_fix_fcs(tmp_path, pcapng):
+    frames = make_frames(100)
+
+    if pcapng:
+        with PcapNgWriter(str(tmp_path / "input.pcap")) as writer:
+            for frame in frames:
+                writer.write(frame)
+    else:
+        wrpcap(str(tmp_path / "input.pcap"), frames)
+
+    result = CliRunner().invoke(
+        pcap, ["fix-fcs", str(tmp_path / "input.pcap"), str(tmp_path / "fixed.pcap")]
+    )
+    assert result.exit_code == 0, result.output
+
+    assert_fcs_valid(tmp_path / "fixed.pcap")
+
+
+def test_fix_fcs_big_endian(tmp_path):
+    frames = [bytes(frame) for frame in make_frames(100)]
+    data = struct.pack(">IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 195)
+
+    for frame in frames:
+        data += struct.pack(">IIII", 0, 0, len(frame), len(frame)) + frame
+
+    (tmp_path / "input.pcap").write_bytes(data)
+
+    result = CliRunner().invoke(
+        pcap, ["fix-fcs", str(tmp_path / "input.pcap"), str(tmp_path / "fixed.pcap")]
+    )
+    assert result.exit_code == 0, result.output
+
+    assert_fcs_valid(tmp_path / "fixed.pcap")
+
+
+def pcapng_block(endian, block_type, body):
+    body += b"\x00" * (-len(body) % 4)
+    length = struct.pack(f"{endian}I", 12 + len(body))
+
+    return struct.pack(f"{endian}I", block_type) + length + body + length
+
+
+def make_pcapng(endian, frames):
+    data = pcapng_block(
+        endian, 0x0A0D0D0A, struct.pack(f"{endian}IHHq", 0x1A2B3C4D, 1, 0, -1)
+    )
+    data += pcapng_block(endian, 1, struct.pack(f"{endian}HHI", 195, 0, 0))
+
+    for frame in frames:
+        data += pcapng_block(
+            endian,
+            6,
+            struct.pack(f"{endian}IIIII", 0, 0, 0, len(frame), len(frame)) + frame,
+        )
+
+    return data
+
+
+def test_fix_fcs_pcapng_big_endian(tmp_path):
+    frames = [bytes(frame) for frame in make_frames(100)]
+    (tmp_path / "input.pcap").write_bytes(make_pcapng(">", frames))
+
+    result = CliRunner().invoke(
+        pcap, ["fix-fcs", str(tmp_path / "input.pcap"), str(tmp_path / "fixed.pcap")]
+    )
+    assert result.exit_code == 0, result.output
+
+    assert_fcs_valid(tmp_path / "fixed.pcap")
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+@pytest.mark.parametrize(
+    "length, error",
+    [
+        (0, "Invalid pcapng block length 0"),
+        (30, "Invalid pcapng block length 30"),
+        (28, "lengths 28 and"),
+        (2**31, "Capture is truncated"),
+    ],
+)
+def test_fix_fcs_pcapng_invalid_length(endian, length, error):
+    data = bytearray(make_pcapng(endian, [bytes(frame) for frame in make_frames(3)]))
+
+    # Corrupt the length of the first packet block, following two 28 and 20 byte blocks
+    struct.pack_into(f"{endian}I", data, 48 + 4, length)
+
+    result = CliRunner().invoke(pcap, ["fix-fcs", "-", "-"], input=bytes(data))
+    assert result.exit_code == 1
+    assert error in result.output
+
+
+def test_fix_fcs_truncated(tmp_path):
+    wrpcap(str(tmp_path / "input.pcap"), make_frames(100))
+    data = (tmp_path / "input.pcap").read_bytes()
+
+    result = CliRunner().invoke(pcap, ["fix-fcs", "-", "-"], input=data[:-3])
+    assert result.exit_code == 1
+    assert "Capture is truncated" in result.output
@@ -0,0 +1,106 @@
+import json
+import pstats
+
+import pytest
+from click.testing import CliRunner
+
+import zigpy_cli.profiling
+from zigpy_cli.__main__ import cli
+from zigpy_cli.profiling import enable_spans, trace_iter, trace_span
+
+
+@pytest.fixture
+def spans(monkeypatch):
+    monkeypatch.setattr(zigpy_cli.profiling, "SPANS", None)
+
+    return enable_spans()
+
+
+def test_trace_span(spans):
+    for _ in range(3):
+        with trace_span("outer"):
+            with trace_span("inner"):
+                pass
+
+    with pytest.raises(ZeroDivisionError):
+        with trace_span("failing"):
+            1 / 0
+
+    assert list(spans) == ["inner", "outer", "failing"]
+    assert spans["outer"].count == 3
+    assert spans["outer"].total >= spans["inner"].total
+    assert spans["failing"].count == 1
+
+
+def test_trace_iter(spans):
+    assert list(trace_iter("numbers", range(5))) == [0, 1, 2, 3, 4]
+    assert spans["numbers"].count == 1
+
+    # Iterables that are not exhausted are still recorded
+    closed = []
+
+    def generate():
+        try:
+            yield from range(5)
+        finally:
+            closed.append(True)
+
+    iterator = trace_iter("partial", generate())
+    assert next(iterator) == 0
+    iterator.close()
+
+    assert closed == [True]
+    assert spans["partial"].count == 1
+
+
+def test_trace_disabled(monkeypatch):
+    monkeypatch.setattr(zigpy_cli.profiling, "SPANS", None)
+
+    with trace_span("span"):
+        pass
+
+    assert list(trace_iter("iter", range(3))) == [0, 1, 2]
+    assert zigpy_cli.profiling.SPANS is None
+
+
+def test_trace_timing_output(tmp_path):
+    result = CliRunner().invoke(
+        cli,
+        [
+            "--trace-timing-output",
+            str(tmp_path / "timing.json"),
+            "--profile",
+            "cprofile",
+            "--profile-output",
+            str(tmp_path / "profile.prof"),
+            "radio",
+            "sim",
+            "sim://",
+            "backup",
+            str(tmp_path / "backup.json"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    timing = json.loads((tmp_path / "timing.json").read_text())
+    assert [span["name"] for span in timing["spans"]] == [
+        "radio.connect",
+        "radio.create_backup",
+        "radio.shutdown",
+    ]
+    assert all(span["count"] == 1 for span in timing["spans"])
+
+    # Tracing is disabled again once the command finishes
+    assert zigpy_cli.profiling.SPANS is None
+
+    stats = pstats.Stats(str(tmp_path / "profile.prof"))
+    assert any(name == "create_backup" for _, _, name in stats.stats)
+
+
+def test_profile_output_requires_profile(tmp_path):
+    result = CliRunner().invoke(
+        cli, ["--profile-output", str(tmp_path / "profile.prof"), "radio", "--help"]
+    )
+
+    assert result.exit_code == 2
+    assert "--profile-output requires --profile" in result.output
@@ -0,0 +1,503 @@
+from __future__ import annotations
+
+import asyncio
+import csv
+import importlib.machinery
+import io
+import json
+import sys
+import types
+
+import click
+import pytest
+import zigpy.application
+import zigpy.exceptions
+import zigpy.state
+import zigpy.types
+import zigpy.zdo.types as zdo_t
+from click.testing import CliRunner
+
+import zigpy_cli.radio
+from zigpy_cli.__main__ import cli
+
+COORDINATOR_IEEE = zigpy.types.EUI64.convert("00:11:22:33:44:55:66:77")
+
+
+def make_neighbor(ieee, nwk, device_type):
+    return zdo_t.Neighbor(
+        extended_pan_id=zigpy.types.ExtendedPanId.convert("aa:bb:cc:dd:ee:ff:00:11"),
+        ieee=zigpy.types.EUI64.convert(ieee),
+        nwk=zigpy.types.NWK(nwk),
+        device_type=device_type,
+        rx_on_when_idle=zdo_t.Neighbor.RxOnWhenIdle.On,
+        relationship=zdo_t.Neighbor.Relationship.Sibling,
+        reserved1=0,
+        permit_joining=zdo_t.Neighbor.PermitJoins.NotAccepting,
+        reserved2=0,
+        depth=1,
+        lqi=200,
+    )
+
+
+class FakeApplication(zigpy.application.ControllerApplication):
+    calls: list[str] = []
+
+    # Neighbor and routing tables by NWK address, devices that are missing never reply
+    tables: dict[int, tuple[list, list]] = {}
+
+    # Number of requests each device ignores before replying
+    ignored_requests: dict[int, int] = {}
+
+    # Errors raised when sending a request to a device, by NWK address
+    failing_requests: dict[int, Exception] = {}
+
+    # Devices known to zigpy when the radio is disconnected
+    known_devices: list = []
+
+    async def connect(self):
+        self.calls.append("connect")
+
+    async def disconnect(self):
+        self.calls.append("disconnect")
+        self.known_devices.extend(self.devices)
+
+    async def load_network_info(self, *, load_devices=False):
+        self.calls.append("load_network_info")
+        self.state.network_info = zigpy.state.NetworkInfo(
+            pan_id=0x1234, channel=15, channel_mask=zigpy.types.Channels.ALL_CHANNELS
+        )
+        self.state.node_info = zigpy.state.NodeInfo(nwk=0x0000, ieee=COORDINATOR_IEEE)
+
+    async def start_network(self):
+        self.calls.append("start_network")
+        coordinator = self.add_device(
+            self.state.node_info.ieee, self.state.node_info.nwk
+        )
+        coordinator.add_endpoint(1)
+
+    async def energy_scan(self, channels, duration_exp, count):
+        self.calls.append("energy_scan")
+        return {channel: 100 for channel in channels}
+
+    async def add_endpoint(self, descriptor):
+        pass
+
+    async def force_remove(self, dev):
+        pass
+
+    async def permit_ncp(self, time_s=60):
+        pass
+
+    async def permit_with_link_key(self, node, link_key, time_s=60):
+        pass
+
+    async def reset_network_info(self):
+        pass
+
+    async def send_packet(self, packet):
+        nwk = packet.dst.address
+
+        if nwk in self.failing_requests:
+            raise self.failing_requests[nwk]
+
+        if self.ignored_requests.get(nwk, 0) > 0:
+            self.ignored_requests[nwk] -= 1
+            return
+
+        if nwk not in self.tables:
+            return
+
+        neighbors, routes = self.tables[nwk]
+        tsn, start_index = packet.data.serialize()[:2]
+
+        # Tables are sent two entries at a time
+        if packet.cluster_id == zdo_t.ZDOCmd.Mgmt_Lqi_req:
+            rsp = zdo_t.Neighbors(
+                Entries=len(neighbors),
+                StartIndex=start_index,
+                NeighborTableList=neighbors[start_index : start_index + 2],
+            )
+        elif packet.cluster_id == zdo_t.ZDOCmd.Mgmt_Rtg_req:
+            rsp = zdo_t.Routes(
+                Entries=len(routes),
+                StartIndex=start_index,
+                RoutingTableList=routes[start_index : start_index + 2],
+            )
+        else:
+            return
+
+        data = bytes([tsn]) + zdo_t.Status.SUCCESS.serialize() + rsp.serialize()
+
+        asyncio.get_running_loop().call_soon(
+            self.packet_received,
+            zigpy.types.ZigbeePacket(
+                src=zigpy.types.AddrModeAddress(
+                    addr_mode=zigpy.types.AddrMode.NWK, address=nwk
+                ),
+                src_ep=0,
+                dst=zigpy.types.AddrModeAddress(
+                    addr_mode=zigpy.types.AddrMode.NWK, address=0x0000
+                ),
+                dst_ep=0,
+                tsn=tsn,
+                profile_id=0,
+                cluster_id=packet.cluster_id | 0x8000,
+                data=zigpy.types.SerializableBytes(data),
+            ),
+        )
+
+    async def write_network_info(self, *, network_info, node_info):
+        pass
+
+
+@pytest.fixture
+def fake_radio(monkeypatch):
+    name = "fake_radio.zigbee.application"
+    module = types.ModuleType(name)
+    module.__spec__ = importlib.machinery.ModuleSpec(name, None)
+    module.ControllerApplication = FakeApplication
+
+    monkeypatch.setitem(zigpy_cli.radio.RADIO_TO_PACKAGE, "znp", "fake_radio")
+    monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.setattr(FakeApplication, "calls", [])
+    monkeypatch.setattr(FakeApplication, "tables", {})
+    monkeypatch.setattr(FakeApplication, "ignored_requests", {})
+    monkeypatch.setattr(FakeApplication, "failing_requests", {})
+    monkeypatch.setattr(FakeApplication, "known_devices", [])
+
+    return FakeApplication
+
+
+def test_batch(fake_radio, tmp_path):
+    (tmp_path / "script.txt").write_text(
+        "info\n"
+        "\n"
+        "# Comments are ignored\n"
+        "energy-scan --num-scans 0\n"
+        "info  # the radio is only connected once\n"
+    )
+
+    result = CliRunner().invoke(
+        cli, ["radio", "znp", "/dev/null", "batch", str(tmp_path / "script.txt")]
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output.count("PAN ID:                0x1234") == 2
+    assert "Channel energy" in result.output
+
+    assert fake_radio.calls == [
+        "connect",
+        "load_network_info",
+        # The network is started on the existing connection
+        "load_network_info",
+        "start_network",
+        "energy_scan",
+        "load_network_info",
+        "disconnect",
+    ]
+
+
+def test_batch_invalid(fake_radio, tmp_path):
+    (tmp_path / "script.txt").write_text("info\nbackup --unknown-option\n")
+
+    result = CliRunner().invoke(
+        cli, ["radio", "znp", "/dev/null", "batch", str(tmp_path / "script.txt")]
+    )
+    assert result.exit_code == 2
+    assert "--unknown-option" in result.output
+
+    # Nothing runs if any line is invalid
+    assert "connect" not in fake_radio.calls
+
+    (tmp_path / "script.txt").write_text("info\nbatch script.txt\n")
+
+    result = CliRunner().invoke(
+        cli, ["radio", "znp", "/dev/null", "batch", str(tmp_path / "script.txt")]
+    )
+    assert result.exit_code == 2
+    assert "Line 2: 'batch' is not a radio command" in result.output
+
+
+def test_topology(fake_radio, tmp_path):
+    router = zdo_t.Neighbor.DeviceType.Router
+    end_device = zdo_t.Neighbor.DeviceType.EndDevice
+    route = zdo_t.Route(
+        DstNWK=0x2222,
+        RouteStatus=zdo_t.RouteStatus.Active,
+        MemoryConstrained=0,
+        ManyToOne=0,
+        RouteRecordRequired=0,
+        Reserved=0,
+        NextHop=0x1111,
+    )
+
+    fake_radio.tables = {
+        0x0000: (
+            [
+                make_neighbor("00:00:00:00:00:00:11:11", 0x1111, router),
+                make_neighbor("00:00:00:00:00:00:33:33", 0x3333, end_device),
+                make_neighbor("ff:ff:ff:ff:ff:ff:ff:ff", 0xFFFF, router),
+            ],
+            [route],
+        ),
+        0x1111: (
+            [
+                make_neighbor(str(COORDINATOR_IEEE), 0x0000, router),
+                make_neighbor("00:00:00:00:00:00:22:22", 0x2222, router),
+            ],
+            [],
+        ),
+        # 0x2222 only reports a router that never replies
+        0x2222: ([make_neighbor("00:00:00:00:00:00:44:44", 0x4444, router)], []),
+    }
+
+    # The first request to 0x1111 is retried
+    fake_radio.ignored_requests = {0x1111: 1}
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "radio",
+            "znp",
+            "/dev/null",
+            "topology",
+            "--timeout",
+            "0.1",
+            "--retries",
+            "1",
+            str(tmp_path / "topology.jsonl"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    records = [
+        json.loads(line)
+        for line in (tmp_path / "topology.jsonl").read_text().splitlines()
+    ]
+    by_nwk = {record["nwk"]: record for record in records}
+
+    assert sorted(by_nwk) == ["0x0000", "0x1111", "0x2222", "0x4444"]
+
+    assert [n["nwk"] for n in by_nwk["0x0000"]["neighbors"]] == ["0x1111", "0x3333"]
+    assert by_nwk["0x0000"]["routes"] == [
+        {
+            "destination": "0x2222",
+            "status": "Active",
+            "next_hop": "0x1111",
+            "many_to_one": False,
+            "memory_constrained": False,
+            "route_record_required": False,
+        }
+    ]
+    assert by_nwk["0x0000"]["errors"] == {}
+    assert by_nwk["0x1111"]["errors"] == {}
+    assert len(by_nwk["0x1111"]["neighbors"]) == 2
+
+    assert by_nwk["0x4444"]["neighbors"] is None
+    assert by_nwk["0x4444"]["errors"] == {
+        "neighbors": "No response after 2 attempts",
+        "routes": "No response after 2 attempts",
+    }
+
+    # Routers that were discovered by the scan are not added to zigpy
+    assert fake_radio.known_devices == [COORDINATOR_IEEE]
+
+
+def test_topology_request_error(fake_radio, tmp_path):
+    router = zdo_t.Neighbor.DeviceType.Router
+
+    fake_radio.tables = {
+        0x0000: (
+            [
+                make_neighbor("00:00:00:00:00:00:11:11", 0x1111, router),
+                make_neighbor("00:00:00:00:00:00:22:22", 0x2222, router),
+            ],
+            [],
+        ),
+        0x2222: ([], []),
+    }
+    fake_radio.failing_requests = {
+        0x1111: zigpy.exceptions.ControllerException("Radio failed")
+    }
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "radio",
+            "znp",
+            "/dev/null",
+            "topology",
+            "--timeout",
+            "0.1",
+            str(tmp_path / "topology.jsonl"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    records = [
+        json.loads(line)
+        for line in (tmp_path / "topology.jsonl").read_text().splitlines()
+    ]
+    by_nwk = {record["nwk"]: record for record in records}
+
+    # A router failing with an error other than a timeout does not stop the scan
+    assert sorted(by_nwk) == ["0x0000", "0x1111", "0x2222"]
+    assert by_nwk["0x2222"]["errors"] == {}
+    assert by_nwk["0x1111"]["neighbors"] is None
+    assert by_nwk["0x1111"]["errors"] == {
+        "neighbors": "Request failed: ControllerException('Radio failed')",
+        "routes": "Request failed: ControllerException('Radio failed')",
+    }
+
+
+def test_summarize_latencies():
+    summary = zigpy_cli.radio.summarize_latencies(
+        [i / 1000 for i in range(100, 0, -1)], errors=5, elapsed=2.0
+    )
+
+    assert summary == {
+        "requests": 105,
+        "errors": 5,
+        "min_ms": 1.0,
+        "mean_ms": 50.5,
+        "p50_ms": 50.0,
+        "p95_ms": 95.0,
+        "p99_ms": 99.0,
+        "max_ms": 100.0,
+        "requests_per_second": 50.0,
+    }
+
+    assert (
+        zigpy_cli.radio.summarize_latencies([], errors=1, elapsed=1.0)["p50_ms"] is None
+    )
+
+
+@pytest.mark.parametrize("request_type", ["zdo", "zcl"])
+def test_benchmark(request_type):
+    result = CliRunner().invoke(
+        cli,
+        [
+            "radio",
+            "sim",
+            "sim://?devices=10&seed=3",
+            "benchmark",
+            "--requests",
+            "10",
+            "--concurrency",
+            "4",
+            "--request",
+            request_type,
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    report = json.loads(result.stdout)
+    assert report["network_info_read"]["requests"] == 10
+    assert report["unicast"]
+
+    for summary in [*report["unicast"].values(), report["throughput"]]:
+        assert summary["requests"] == 10
+        assert summary["errors"] == 0
+        assert summary["p50_ms"] <= summary["p99_ms"]
+
+    assert report["throughput"]["concurrency"] == 4
+
+
+def test_benchmark_network_info_read(fake_radio):
+    result = CliRunner().invoke(
+        cli, ["radio", "znp", "/dev/null", "benchmark", "--requests", "3"]
+    )
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.stdout)["network_info_read"]["requests"] == 3
+
+    # Every request reads the network settings from the radio, even without a watchdog
+    assert fake_radio.calls.count("load_network_info") == 1 + 3
+
+
+def test_benchmark_unknown_device():
+    result = CliRunner().invoke(
+        cli,
+        [
+            "radio",
+            "sim",
+            "sim://",
+            "benchmark",
+            "--device",
+            "11:22:33:44:55:66:77:88",
+        ],
+    )
+    assert result.exit_code == 1
+    assert "Unknown device" in result.output
+
+
+def test_channel_energy_stats():
+    stats = zigpy_cli.radio.ChannelEnergyStats(window=3)
+
+    for energy in [10.0, 300.0, -5.0, 20.0, 30.0]:
+        stats.add(energy)
+
+    assert stats.histogram[0] == 1
+    assert stats.histogram[255] == 1
+    assert sum(stats.histogram) == 5
+    assert stats.as_dict() == {
+        "energy": 30.0,
+        "window_mean": 15.0,
+        "min": -5.0,
+        "mean": 71.0,
+        "max": 300.0,
+        "p50": 20,
+        "p95": 255,
+        "p99": 255,
+    }
+
+
+def test_parse_channels():
+    assert zigpy_cli.radio.parse_channels(None, None, "11,15,20-22") == (
+        zigpy.types.Channels.from_channel_list([11, 15, 20, 21, 22])
+    )
+
+    with pytest.raises(click.BadParameter):
+        zigpy_cli.radio.parse_channels(None, None, "11,abc")
+
+    with pytest.raises(click.BadParameter):
+        zigpy_cli.radio.parse_channels(None, None, "10")
+
+
+@pytest.mark.parametrize("output_format", ["jsonl", "csv"])
+def test_energy_scan_streaming(output_format):
+    result = CliRunner().invoke(
+        cli,
+        [
+            "radio",
+            "sim",
+            "sim://",
+            "energy-scan",
+            "--num-scans",
+            "9",
+            "--channels",
+            "15,20,25",
+            "--duration-exp",
+            "1",
+            "--window",
+            "4",
+            "--format",
+            output_format,
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    if output_format == "jsonl":
+        records = [json.loads(line) for line in result.stdout.splitlines()]
+        assert [r["scan"] for r in records] == list(range(10))
+        assert records[-1]["current_channel"] == 15
+
+        channels = records[-1]["channels"]
+    else:
+        rows = list(csv.DictReader(io.StringIO(result.stdout)))
+        assert len(rows) == 10 * 3
+
+        channels = {row["channel"]: row for row in rows if row["scan"] == "9"}
+
+    assert sorted(channels) == ["15", "20", "25"]
+
+    for stats in channels.values():
+        assert float(stats["min"]) <= float(stats["p50"]) <= float(stats["max"])
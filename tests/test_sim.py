@@ -0,0 +1,113 @@
+import json
+
+import pytest
+import zigpy.application
+from click.testing import CliRunner
+
+from zigpy_cli.__main__ import cli
+
+
+def run_batch(tmp_path, port, script, *args):
+    (tmp_path / "script.txt").write_text(script)
+
+    result = CliRunner().invoke(
+        cli, [*args, "radio", "sim", port, "batch", str(tmp_path / "script.txt")]
+    )
+    assert result.exit_code == 0, result.output
+
+    return result
+
+
+@pytest.mark.parametrize("devices", [0, 10, 100, 1000])
+def test_backup_restore_scaling(tmp_path, devices, record_property):
+    backup_path = tmp_path / "backup.json"
+    restored_path = tmp_path / "restored.json"
+
+    run_batch(
+        tmp_path,
+        f"sim://?devices={devices}&seed=1",
+        f"backup {backup_path}\n",
+        "--trace-timing-output",
+        str(tmp_path / "backup_timing.json"),
+    )
+
+    # A different network is replaced by the backup and backed up again
+    run_batch(
+        tmp_path,
+        "sim://?devices=5&seed=2",
+        f"restore {backup_path}\nbackup {restored_path}\n",
+        "--trace-timing-output",
+        str(tmp_path / "restore_timing.json"),
+    )
+
+    backup = json.loads(backup_path.read_text())
+    restored = json.loads(restored_path.read_text())
+
+    assert len(backup["devices"]) == devices
+    assert restored["devices"] == backup["devices"]
+    assert restored["pan_id"] == backup["pan_id"]
+    assert restored["network_key"]["key"] == backup["network_key"]["key"]
+    assert (
+        restored["network_key"]["frame_counter"]
+        > backup["network_key"]["frame_counter"]
+    )
+
+    # Reported in the JUnit XML report, to track how both scale with network size
+    for name, span_name in [
+        ("backup", "radio.create_backup"),
+        ("restore", "radio.restore_backup"),
+    ]:
+        timing = json.loads((tmp_path / f"{name}_timing.json").read_text())
+        spans = {span["name"]: span["total_s"] for span in timing["spans"]}
+
+        record_property(f"{name}_s", spans[span_name])
+
+
+def test_change_channel(tmp_path, monkeypatch):
+    monkeypatch.setattr(zigpy.application, "CHANNEL_CHANGE_BROADCAST_DELAY_S", 0)
+    monkeypatch.setattr(zigpy.application, "CHANNEL_CHANGE_SETTINGS_RELOAD_DELAY_S", 0)
+
+    result = run_batch(tmp_path, "sim://", "info\nchange-channel -c 25\ninfo\n")
+    channels = [
+        line.split()[-1]
+        for line in result.stdout.splitlines()
+        if line.startswith("Channel:")
+    ]
+    update_ids = [
+        line.split()[-1]
+        for line in result.stdout.splitlines()
+        if line.startswith("NWK update ID:")
+    ]
+
+    assert channels == ["15", "25"]
+    assert update_ids == ["0", "1"]
+
+
+def test_reset_form(tmp_path):
+    result = run_batch(tmp_path, "sim://", "info\nreset\nform\ninfo\n")
+    pan_ids = [
+        line.split()[-1]
+        for line in result.stdout.splitlines()
+        if line.startswith("PAN ID:")
+    ]
+
+    assert len(pan_ids) == 2
+    assert pan_ids[0] != pan_ids[1]
+
+
+def test_permit():
+    result = CliRunner().invoke(
+        cli, ["radio", "sim", "sim://?devices=3", "permit", "--join-time", "0"]
+    )
+
+    assert result.exit_code == 0, result.output
+
+
+def test_energy_scan_text():
+    result = CliRunner().invoke(
+        cli, ["radio", "sim", "sim://", "energy-scan", "--num-scans", "0"]
+    )
+
+    assert result.exit_code == 0, result.output
+    assert "Channel energy (mean of 1 / 5):" in result.stdout
+    assert " - [15 ]" in result.stdout
@@ -1,5 +1 @@
-import zigpy_cli.database  # noqa: F401
-import zigpy_cli.ota  # noqa: F401
-import zigpy_cli.pcap  # noqa: F401
-import zigpy_cli.radio  # noqa: F401
 from zigpy_cli.cli import cli  # noqa: F401
@@ -2,12 +2,14 @@ from __future__ import annotations
 
 import asyncio
 import functools
+import importlib
 import logging
+import pathlib
 
 import click
-import coloredlogs
 
 from zigpy_cli.const import LOG_LEVELS
+from zigpy_cli.profiling import start_profile, start_spans
 
 LOGGER = logging.getLogger(__name__)
 ROOT_LOGGER = logging.getLogger()
@@ -16,15 +18,105 @@ ROOT_LOGGER = logging.getLogger()
 def click_coroutine(cmd):
     @functools.wraps(cmd)
     def inner(*args, **kwargs):
-        loop = asyncio.get_event_loop()
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            # `asyncio.run` leaves no current event loop once it finishes
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+
         return loop.run_until_complete(cmd(*args, **kwargs))
 
     return inner
 
 
-@click.group()
+class LazyGroup(click.Group):
+    """
+    A group whose subcommands are only imported once they are invoked. Each module
+    registers its subcommand with the group when it is imported.
+    """
+
+    def __init__(self, *args, lazy_subcommands: dict[str, str], **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands
+
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        return sorted({*super().list_commands(ctx), *self.lazy_subcommands})
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> click.Command | None:
+        if cmd_name not in self.commands and cmd_name in self.lazy_subcommands:
+            importlib.import_module(self.lazy_subcommands[cmd_name])
+
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(
+        self, ctx: click.Context, formatter: click.HelpFormatter
+    ) -> None:
+        # Listing commands should not import them, so ones that have not been loaded
+        # are listed without their help text
+        rows = [
+            (
+                (name, self.commands[name].get_short_help_str(formatter.width))
+                if name in self.commands
+                else (name, "")
+            )
+            for name in self.list_commands(ctx)
+        ]
+
+        with formatter.section("Commands"):
+            formatter.write_dl(rows)
+
+
+@click.group(
+    cls=LazyGroup,
+    lazy_subcommands={
+        "db": "zigpy_cli.database",
+        "fleet": "zigpy_cli.fleet",
+        "ota": "zigpy_cli.ota",
+        "pcap": "zigpy_cli.pcap",
+        "radio": "zigpy_cli.radio",
+    },
+)
 @click.option("-v", "--verbose", count=True, required=False)
-def cli(verbose):
+@click.option(
+    "--profile",
+    type=click.Choice(["cprofile", "tracemalloc"]),
+    default=None,
+    help="Run the command under a profiler",
+)
+@click.option(
+    "--profile-output",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="Write the profile to a file instead of summarizing it",
+)
+@click.option(
+    "--trace-timing",
+    is_flag=True,
+    default=False,
+    help="Print the time spent in each phase of the command",
+)
+@click.option(
+    "--trace-timing-output",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="Write the time spent in each phase of the command as JSON",
+)
+@click.pass_context
+def cli(
+    ctx,
+    verbose,
+    profile=None,
+    profile_output=None,
+    trace_timing=False,
+    trace_timing_output=None,
+):
+    if profile_output is not None and profile is None:
+        raise click.UsageError("--profile-output requires --profile", ctx=ctx)
+
+    # Imported here, it is slow to import and not needed for `--help`
+    import coloredlogs
+
     # Setup logging
     log_level = LOG_LEVELS[min(verbose, len(LOG_LEVELS) - 1)]
 
@@ -45,3 +137,10 @@ def cli(verbose):
         level_styles=level_styles,
         logger=ROOT_LOGGER,
     )
+
+    # Results are reported once the command and its cleanup have finished
+    if trace_timing or trace_timing_output is not None:
+        ctx.call_on_close(start_spans(trace_timing_output))
+
+    if profile is not None:
+        ctx.call_on_close(start_profile(profile, profile_output))
@@ -1,5 +1,16 @@
+from __future__ import annotations
+
+import concurrent.futures
+import contextlib
+import io
+import mmap
+import typing
+
 import click
 
+T = typing.TypeVar("T")
+R = typing.TypeVar("R")
+
 
 class HexOrDecIntParamType(click.ParamType):
     name = "integer"
@@ -18,3 +29,47 @@ class HexOrDecIntParamType(click.ParamType):
 
 
 HEX_OR_DEC_INT = HexOrDecIntParamType()
+
+
+def parallel_map(
+    func: typing.Callable[[T], R],
+    items: typing.Iterable[T],
+    *,
+    jobs: int,
+    executor_cls: type[
+        concurrent.futures.Executor
+    ] = concurrent.futures.ProcessPoolExecutor,
+) -> typing.Iterator[R]:
+    """
+    Maps `func` over `items` with up to `jobs` workers, yielding results in order.
+    """
+
+    if jobs == 1:
+        yield from map(func, items)
+        return
+
+    with executor_cls(max_workers=jobs) as executor:
+        yield from executor.map(func, items)
+
+
+@contextlib.contextmanager
+def map_file(file: typing.BinaryIO) -> typing.Iterator[memoryview]:
+    """
+    Memory-maps an open file read-only. Streams that cannot be mapped, like pipes, are
+    read into memory instead.
+    """
+
+    try:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        # Empty files cannot be mapped either
+        yield memoryview(file.read())
+        return
+
+    with mapped:
+        view = memoryview(mapped)
+
+        try:
+            yield view
+        finally:
+            view.release()
@@ -14,6 +14,8 @@ RADIO_TO_PACKAGE = {
     "zboss": "zigpy_zboss",
     "zigate": "zigpy_zigate",
     "znp": "zigpy_znp",
+    # A simulated radio for testing and benchmarking, it is part of zigpy-cli
+    "sim": "zigpy_cli.sim",
 }
 
 
@@ -77,6 +79,14 @@ RADIO_LOGGING_CONFIGS = {
             "zigpy_znp": TRACE,
         },
     ],
+    "sim": [
+        {
+            "zigpy_cli.sim": logging.INFO,
+        },
+        {
+            "zigpy_cli.sim": logging.DEBUG,
+        },
+    ],
 }
 
 RADIO_TO_PYPI = {name: mod.replace("_", "-") for name, mod in RADIO_TO_PACKAGE.items()}
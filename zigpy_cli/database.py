@@ -1,65 +1,201 @@
 from __future__ import annotations
 
 import asyncio
+import collections
+import contextlib
+import dataclasses
+import functools
+import glob
+import itertools
+import json
 import logging
+import os
 import pathlib
 import re
 import sqlite3
 import subprocess
 import tempfile
+import time
+import typing
 
 import click
 import zigpy.appdb
-from zigpy_znp.zigbee.application import ControllerApplication
+import zigpy.application
+import zigpy.device
 
 from zigpy_cli.cli import cli
+from zigpy_cli.common import map_file, parallel_map
+from zigpy_cli.profiling import trace_iter, trace_span
+from zigpy_cli.sqlite_recovery import (
+    INTERNAL_TABLE_COLUMNS,
+    SKIPPED_ROW,
+    CorruptDatabaseError,
+    DamagedDatabase,
+)
 
 LOGGER = logging.getLogger(__name__)
+ROOT_LOGGER = logging.getLogger()
 DB_V_REGEX = re.compile(r"(?:_v\d+)?$")
 
+# Semicolons and the tokens starting strings, identifiers and comments, which end with
+# the corresponding closing token
+SQL_TOKEN_REGEX = re.compile(r"[;'\"`\[]|--|/\*")
+SQL_TOKEN_CLOSING = {"'": "'", '"': '"', "`": "`", "[": "]", "--": "\n", "/*": "*/"}
+
+# Tables created by every zigpy schema version, without their version suffix. Other
+# tables may belong to add-ons or users and are never dropped.
+ZIGPY_TABLES = frozenset(
+    {
+        "attributes",
+        "attributes_cache",
+        "clusters",
+        "devices",
+        "endpoints",
+        "group_members",
+        "groups",
+        "in_clusters",
+        "neighbors",
+        "network_backups",
+        "node_descriptors",
+        "ota_query_cache",
+        "out_clusters",
+        "output_clusters",
+        "relays",
+        "routes",
+        "unsupported_attributes",
+    }
+)
+
+# Recovered rows are inserted in batches no larger than this, to bound the SQL length
+RECOVER_BATCH_MAX_BYTES = 16 * 1024 * 1024
+
+# Warnings beyond this many are only counted in batch recovery summaries
+RECOVER_SUMMARY_MAX_WARNINGS = 100
+
 
 @cli.group()
 def db():
     pass
 
 
-def sqlite3_split_statements(sql: str) -> list[str]:
+def sqlite3_iter_statements(lines: typing.Iterable[str]) -> typing.Iterator[str]:
     """
-    Splits SQL into a list of statements.
+    Splits lines of SQL into statements as soon as each one is complete.
     """
 
-    statements = []
-    statement = ""
+    parts: list[str] = []
+    closing = None
+
+    for line in lines:
+        start = 0
+        pos = 0
+
+        # Every line is scanned once, `complete_statement` is only needed to confirm
+        # semicolons outside of strings and comments, which may still be in a trigger
+        while True:
+            if closing is not None:
+                end = line.find(closing, pos)
+
+                if end == -1:
+                    break
 
-    chunks = sql.strip().split(";")
-    chunks_with_delimiter = [s + ";" for s in chunks[:-1]] + [chunks[-1]]
+                pos = end + len(closing)
+                closing = None
+                continue
+
+            match = SQL_TOKEN_REGEX.search(line, pos)
+
+            if match is None:
+                break
 
-    for chunk in chunks_with_delimiter:
-        statement += chunk
+            pos = match.end()
+
+            if match.group() != ";":
+                closing = SQL_TOKEN_CLOSING[match.group()]
+                continue
 
-        if sqlite3.complete_statement(statement):
-            statements.append(statement.strip())
-            statement = ""
+            parts.append(line[start:pos])
+            start = pos
+            statement = "".join(parts)
+
+            if sqlite3.complete_statement(statement):
+                yield statement.strip()
+                parts.clear()
+            else:
+                parts[:] = [statement]
+
+        parts.append(line[start:])
+
+    statement = "".join(parts).strip()
 
     if statement:
         LOGGER.warning("Incomplete data remains after splitting SQL: %r", statement)
 
-    return statements
 
+def sqlite3_split_statements(sql: str) -> list[str]:
+    """
+    Splits SQL into a list of statements.
+    """
+
+    return list(sqlite3_iter_statements(sql.strip().splitlines(keepends=True)))
+
+
+def sqlite3_recover(path: pathlib.Path) -> typing.Iterator[str]:
+    """
+    Recovers the contents of an SQLite database as valid SQL, streamed line by line.
+    """
+
+    with subprocess.Popen(
+        ["sqlite3", str(path), ".recover"], stdout=subprocess.PIPE, encoding="utf-8"
+    ) as proc:
+        assert proc.stdout is not None
+        yield from proc.stdout
 
-def sqlite3_recover(path: pathlib.Path) -> str:
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def sqlite3_insert_batch(cursor, statements: list[str]) -> None:
     """
-    Recovers the contents of an SQLite database as valid SQL.
+    Executes `INSERT` statements for the same table and columns as a single multi-row
+    `INSERT`. If any row violates a constraint, rows are inserted one at a time and
+    the failing ones are skipped.
     """
 
-    return subprocess.check_output(["sqlite3", str(path), ".recover"]).decode("utf-8")
+    if len(statements) == 1:
+        batch = statements[0]
+    else:
+        prefix, _, _ = statements[0].partition(" VALUES(")
+        values = ",".join(s[len(prefix) + 7 :].rstrip(";") for s in statements)
+        batch = f"{prefix} VALUES{values};"
+
+    with trace_span("db.insert"):
+        cursor.execute("SAVEPOINT recover_batch")
+
+        try:
+            cursor.execute(batch)
+        except sqlite3.IntegrityError:
+            cursor.execute("ROLLBACK TO recover_batch")
+
+            for statement in statements:
+                try:
+                    cursor.execute(statement)
+                except sqlite3.IntegrityError as e:
+                    LOGGER.warning("Skipping %s: %r", statement, e, extra=SKIPPED_ROW)
+
+        cursor.execute("RELEASE recover_batch")
 
 
 def get_table_versions(cursor) -> dict[str, str]:
-    tables = {}
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
 
-    for (name,) in cursor:
+    return get_table_name_versions(name for (name,) in cursor)
+
+
+def get_table_name_versions(names: typing.Iterable[str]) -> dict[str, str]:
+    tables = {}
+
+    for name in names:
         # The regex will always return a match
         match = DB_V_REGEX.search(name)
         assert match is not None
@@ -69,123 +205,918 @@ def get_table_versions(cursor) -> dict[str, str]:
     return tables
 
 
-async def test_database(path: pathlib.Path):
+async def _no_radio(self, *args, **kwargs):
+    raise NotImplementedError("No radio is available")
+
+
+async def _disconnect(self) -> None:
+    pass
+
+
+# A controller application without a radio, which is enough for zigpy to load a database
+DatabaseOnlyApplication = type(
+    "DatabaseOnlyApplication",
+    (zigpy.application.ControllerApplication,),
+    {
+        **{
+            name: _no_radio
+            for name in zigpy.application.ControllerApplication.__abstractmethods__
+        },
+        "disconnect": _disconnect,
+    },
+)
+
+
+@dataclasses.dataclass
+class DatabaseReport:
+    integrity_errors: list[str]
+    foreign_key_errors: int
+    devices: list[zigpy.device.Device]
+    endpoints: int
+    attributes: int
+    load_time: float
+
+    @property
+    def uninitialized_devices(self) -> list[zigpy.device.Device]:
+        return [d for d in self.devices if not d.is_initialized]
+
+
+async def test_database(path: pathlib.Path) -> DatabaseReport:
     """
-    Opens the zigpy database with zigpy and attempts to load its contents.
+    Checks the integrity of a zigpy database and loads its contents with zigpy, without
+    starting a radio.
     """
 
     with tempfile.TemporaryDirectory() as dir_name:
-        dir_path = pathlib.Path(dir_name)
-        db_file = dir_path / "zigbee.db"
-        db_file.write_bytes(path.read_bytes())
-
-        app = await ControllerApplication.new(
-            {"database_path": str(db_file), "device": {"path": "/dev/null"}},
-            auto_form=False,
-            start_radio=False,
+        db_file = pathlib.Path(dir_name) / "zigbee.db"
+
+        # Loading the database migrates it, so zigpy gets a copy made with the online
+        # backup API instead of the original
+        source = sqlite3.connect(f"{path.absolute().as_uri()}?mode=ro", uri=True)
+        copy = sqlite3.connect(db_file)
+
+        try:
+            integrity_errors = [
+                row
+                for (row,) in source.execute("PRAGMA integrity_check")
+                if row != "ok"
+            ]
+            foreign_key_errors = len(
+                source.execute("PRAGMA foreign_key_check").fetchall()
+            )
+            source.backup(copy)
+        finally:
+            source.close()
+            copy.close()
+
+        app = DatabaseOnlyApplication(
+            {"database_path": str(db_file), "device": {"path": "/dev/null"}}
+        )
+        start = time.monotonic()
+
+        # `ControllerApplication.new` would leave the database open if loading fails
+        try:
+            await app._load_db()
+        finally:
+            await app.shutdown()
+
+        load_time = time.monotonic() - start
+
+        conn = sqlite3.connect(db_file)
+
+        try:
+            (attributes,) = conn.execute(
+                f"SELECT COUNT(*) FROM attributes_cache_v{zigpy.appdb.DB_VERSION}"
+            ).fetchone()
+        finally:
+            conn.close()
+
+    devices = list(app.devices.values())
+
+    return DatabaseReport(
+        integrity_errors=integrity_errors,
+        foreign_key_errors=foreign_key_errors,
+        devices=devices,
+        endpoints=sum(
+            len(d.non_zdo_endpoints)
+            for d in devices
+            if isinstance(d, zigpy.device.Device)
+        ),
+        attributes=attributes,
+        load_time=load_time,
+    )
+
+
+def log_database_report(report: DatabaseReport) -> None:
+    for error in report.integrity_errors:
+        LOGGER.warning("Integrity check failed: %s", error)
+
+    if report.foreign_key_errors:
+        LOGGER.warning("%d rows violate foreign keys", report.foreign_key_errors)
+
+    LOGGER.info(
+        "Loaded %d devices (%d uninitialized), %d endpoints and %d cached attributes"
+        " in %0.2fs",
+        len(report.devices),
+        len(report.uninitialized_devices),
+        report.endpoints,
+        report.attributes,
+        report.load_time,
+    )
+
+    for device in report.devices:
+        LOGGER.info("%s", device)
+
+
+def sqlite3_insert_rows(
+    cursor,
+    table: str,
+    columns: list[str],
+    rows: typing.Iterable[tuple],
+    *,
+    batch_size: int,
+) -> None:
+    """
+    Inserts rows with a parameterized `INSERT` in batches of `batch_size`. If any row
+    in a batch violates a constraint, its rows are inserted one at a time and the
+    failing ones are skipped.
+    """
+
+    names = ", ".join(quote_identifier(c) for c in columns)
+    placeholders = ", ".join("?" for _ in columns)
+    statement = f"INSERT INTO {quote_identifier(table)}({names}) VALUES({placeholders})"
+
+    # Reading rows is not part of the insert span, they are often decoded lazily
+    rows = iter(rows)
+
+    while batch := list(itertools.islice(rows, batch_size)):
+        with trace_span("db.insert"):
+            cursor.execute("SAVEPOINT recover_batch")
+
+            try:
+                cursor.executemany(statement, batch)
+            except sqlite3.IntegrityError:
+                cursor.execute("ROLLBACK TO recover_batch")
+
+                for row in batch:
+                    try:
+                        cursor.execute(statement, row)
+                    except sqlite3.IntegrityError as e:
+                        LOGGER.warning(
+                            "Skipping %s row %r: %r", table, row, e, extra=SKIPPED_ROW
+                        )
+
+            cursor.execute("RELEASE recover_batch")
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def get_record_columns(cursor, table: str) -> tuple[list[str], list[int], int | None]:
+    """
+    Finds the columns of a table as they are stored in its records. Returns the column
+    names, the indices of the columns that can be inserted, and the index of the
+    column aliasing the rowid, if any.
+    """
+
+    cursor.execute(f"PRAGMA table_xinfo({quote_identifier(table)})")
+    columns = cursor.fetchall()
+
+    # Virtual generated columns are not stored in records
+    stored = [column for column in columns if column[6] != 2]
+    insertable = [i for i, column in enumerate(stored) if column[6] == 0]
+    primary_keys = [i for i, column in enumerate(stored) if column[5] > 0]
+
+    if len(primary_keys) == 1 and stored[primary_keys[0]][2].upper() == "INTEGER":
+        rowid_alias = primary_keys[0]
+    else:
+        rowid_alias = None
+
+    return [column[1] for column in stored], insertable, rowid_alias
+
+
+def recover_native(damaged_db: DamagedDatabase, cursor, *, batch_size: int) -> None:
+    """
+    Recovers the rows of every table directly from the pages of a damaged database.
+    """
+
+    full_schema = damaged_db.read_schema()
+    schema = [
+        entry
+        for entry in full_schema
+        if entry.sql is not None and not entry.name.startswith("sqlite_")
+    ]
+
+    # Like `.recover`, create tables and unique indexes before inserting any data so
+    # that invalid rows are skipped, and everything else afterwards
+    early_schema = [
+        entry
+        for entry in schema
+        if entry.type == "table"
+        or (entry.type == "index" and "UNIQUE" in entry.sql.upper())
+    ]
+    late_schema = [entry for entry in schema if entry not in early_schema]
+
+    cursor.execute("BEGIN")
+
+    tables = {}
+
+    for entry in early_schema:
+        LOGGER.debug("Schema: %s", entry.sql)
+
+        try:
+            cursor.execute(entry.sql)
+        except sqlite3.Error as e:
+            LOGGER.warning("Skipping %s %s: %r", entry.type, entry.name, e)
+            continue
+
+        if entry.type == "table":
+            tables[entry.name] = (
+                entry.rootpage,
+                *get_record_columns(cursor, entry.name),
+            )
+
+    def make_row(table, rowid, values):
+        _, columns, insertable, rowid_alias = tables[table]
+
+        if len(values) > len(columns):
+            LOGGER.warning(
+                "Skipping %s row %d with too many columns",
+                table,
+                rowid,
+                extra=SKIPPED_ROW,
+            )
+            return None
+
+        # Columns added with `ALTER TABLE` are missing from older records
+        values = values + [None] * (len(columns) - len(values))
+
+        if rowid_alias is not None and values[rowid_alias] is None:
+            values[rowid_alias] = rowid
+
+        return (rowid, *[values[i] for i in insertable])
+
+    for table, (rootpage, columns, insertable, _) in tables.items():
+        LOGGER.info("Recovering %s", table)
+
+        rows = (
+            make_row(table, rowid, values)
+            for rowid, values in trace_iter(
+                "db.read_pages", damaged_db.iter_table_rows(rootpage)
+            )
+        )
+        sqlite3_insert_rows(
+            cursor,
+            table,
+            ["_rowid_", *[columns[i] for i in insertable]],
+            (row for row in rows if row is not None),
+            batch_size=batch_size,
+        )
+
+    # Internal tables like `sqlite_stat1`, indexes and tables that were skipped are
+    # not copied, but their pages still belong to a b-tree
+    for entry in full_schema:
+        if entry.rootpage > 0 and entry.name not in tables:
+            damaged_db.mark_btree_pages(entry.rootpage)
+
+    # Rows on pages that are no longer part of any b-tree can only be assigned to a
+    # table by their number of columns, which must not match any other table
+    column_counts = {table: len(info[1]) for table, info in tables.items()}
+    column_counts.update(
+        (entry.name, INTERNAL_TABLE_COLUMNS[entry.name])
+        for entry in full_schema
+        if entry.name in INTERNAL_TABLE_COLUMNS
+    )
+    orphaned_rows = collections.defaultdict(list)
+
+    for pgno, rowid, values in damaged_db.iter_orphaned_rows():
+        candidates = [
+            table for table, count in column_counts.items() if count == len(values)
+        ]
+
+        if len(candidates) != 1 or candidates[0] not in tables:
+            LOGGER.warning(
+                "Skipping orphaned row %d on page %d: cannot determine its table",
+                rowid,
+                pgno,
+                extra=SKIPPED_ROW,
+            )
+            continue
+
+        row = make_row(candidates[0], rowid, values)
+
+        if row is not None:
+            orphaned_rows[candidates[0]].append(row)
+
+    for table, rows in orphaned_rows.items():
+        _, columns, insertable, _ = tables[table]
+        LOGGER.warning("Recovering %d orphaned rows into %s", len(rows), table)
+
+        sqlite3_insert_rows(
+            cursor,
+            table,
+            ["_rowid_", *[columns[i] for i in insertable]],
+            rows,
+            batch_size=batch_size,
+        )
+
+    for entry in late_schema:
+        LOGGER.debug("Schema: %s", entry.sql)
+
+        try:
+            cursor.execute(entry.sql)
+        except sqlite3.Error as e:
+            LOGGER.warning("Skipping %s %s: %r", entry.type, entry.name, e)
+
+    cursor.execute("COMMIT")
+
+
+def recover_sqlite3(input_path: pathlib.Path, cursor, *, batch_size: int) -> None:
+    """
+    Recovers a damaged database with the `sqlite3` command line tool's `.recover`.
+    """
+
+    # `.recover` emits tables and their unique indexes before any data, so statements
+    # can be executed as soon as they are read
+    statements = trace_iter(
+        "db.split", sqlite3_iter_statements(sqlite3_recover(input_path))
+    )
+    last_statements: collections.deque[str] = collections.deque(maxlen=2)
+
+    batch: list[str] = []
+    batch_prefix = None
+    batch_bytes = 0
+
+    for statement in statements:
+        last_statements.append(statement)
+
+        if not statement.startswith("INSERT"):
+            if batch:
+                sqlite3_insert_batch(cursor, batch)
+                batch.clear()
+
+            LOGGER.debug("Schema: %s", statement)
+            cursor.execute(statement)
+            continue
+
+        LOGGER.debug("Data: %s", statement)
+
+        # Ignore internal tables
+        if statement.startswith(
+            (
+                'INSERT INTO "sqlite_sequence"(',
+                "CREATE TABLE IF NOT EXISTS  sqlite_sequence(",
+            )
+        ):
+            continue
+
+        # Only consecutive rows for the same table and columns can be batched
+        prefix, sep, _ = statement.partition(" VALUES(")
+
+        if batch and (
+            not sep
+            or prefix != batch_prefix
+            or len(batch) >= batch_size
+            or batch_bytes >= RECOVER_BATCH_MAX_BYTES
+        ):
+            sqlite3_insert_batch(cursor, batch)
+            batch.clear()
+
+        if not batch:
+            batch_prefix = prefix if sep else None
+            batch_bytes = 0
+
+        batch.append(statement)
+        batch_bytes += len(statement)
+
+    if batch:
+        sqlite3_insert_batch(cursor, batch)
+
+    assert list(last_statements) == ["PRAGMA writable_schema = off;", "COMMIT;"]
+
+
+def recover_database(
+    input_path: pathlib.Path,
+    output_path: pathlib.Path,
+    *,
+    batch_size: int,
+    backend: str,
+) -> DatabaseReport:
+    """
+    Recovers a damaged database into a new one and loads the result with zigpy.
+    """
+
+    with contextlib.ExitStack() as stack:
+        if backend == "native":
+            input_file = stack.enter_context(open(input_path, "rb"))
+            wal_path = input_path.with_name(input_path.name + "-wal")
+
+            # Transactions that were not checkpointed are only in the write-ahead log
+            if wal_path.is_file():
+                wal_file = stack.enter_context(open(wal_path, "rb"))
+                wal = stack.enter_context(map_file(wal_file))
+            else:
+                wal = None
+
+            try:
+                damaged_db = DamagedDatabase(
+                    stack.enter_context(map_file(input_file)), wal
+                )
+            except CorruptDatabaseError as e:
+                raise click.ClickException(f"Cannot recover {input_path}: {e}")
+
+            pragma_user_version = damaged_db.user_version
+            table_versions = get_table_name_versions(
+                entry.name
+                for entry in damaged_db.read_schema()
+                if entry.type == "table"
+            )
+        else:
+            # Fetch the user version, it isn't dumped by `.recover`
+            with sqlite3.connect(input_path) as conn:
+                cur = conn.cursor()
+                cur.execute("PRAGMA user_version")
+                (pragma_user_version,) = cur.fetchone()
+
+                # Get the table suffix versions as well
+                table_versions = get_table_versions(cur)
+
+            conn.close()
+
+        LOGGER.info("Pragma user version is %d", pragma_user_version)
+
+        max_table_version = max(
+            int(v[2:], 10) for v in table_versions.values() if v.startswith("_v")
         )
+        LOGGER.info("Maximum table version is %d", max_table_version)
+
+        if max_table_version != pragma_user_version:
+            LOGGER.warning(
+                "Maximum table version is %d but the user_version is %d!",
+                max_table_version,
+                pragma_user_version,
+            )
+
+        if zigpy.appdb.DB_VERSION != max_table_version:
+            LOGGER.warning(
+                "Zigpy's current DB version is %s but the maximum table version is %s!",
+                zigpy.appdb.DB_VERSION,
+                max_table_version,
+            )
+
+        # The database is written under a temporary name and only renamed once
+        # recovery succeeds, so a failure never leaves a partial database behind
+        temp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
 
-        await app.shutdown()
+        try:
+            conn = sqlite3.connect(temp_path)
 
-    return app
+            try:
+                cur = conn.cursor()
+                cur.execute(f"PRAGMA user_version={max_table_version};")
+
+                # The output database is new, there is nothing to protect from a
+                # crash. The journal is kept in memory instead of being disabled to
+                # allow batch rollback.
+                cur.execute("PRAGMA journal_mode=MEMORY")
+                cur.execute("PRAGMA synchronous=OFF")
+
+                with trace_span("db.recover"):
+                    if backend == "native":
+                        recover_native(damaged_db, cur, batch_size=batch_size)
+                    else:
+                        recover_sqlite3(input_path, cur, batch_size=batch_size)
+
+                conn.commit()
+            finally:
+                conn.close()
+
+            os.replace(temp_path, output_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+    LOGGER.info("Finished writing database")
+
+    # Load the database with zigpy and test it
+    with trace_span("db.load"):
+        report = asyncio.run(test_database(output_path))
+
+    log_database_report(report)
+
+    return report
+
+
+RECOVER_BATCH_SIZE_OPTION = click.option(
+    "--batch-size", type=click.IntRange(min=1), default=1000
+)
+RECOVER_BACKEND_OPTION = click.option(
+    "--backend",
+    type=click.Choice(["native", "sqlite3"]),
+    default="native",
+    show_default=True,
+)
 
 
 @db.command()
 @click.argument("input_path", type=click.Path(exists=True))
 @click.argument("output_path", type=click.Path())
-def recover(input_path, output_path):
+@RECOVER_BATCH_SIZE_OPTION
+@RECOVER_BACKEND_OPTION
+def recover(input_path, output_path, batch_size, backend):
     if pathlib.Path(output_path).exists():
         LOGGER.error("Output database already exists: %s", output_path)
         return
 
-    # Fetch the user version, it isn't dumped by `.recover`
-    with sqlite3.connect(input_path) as conn:
-        cur = conn.cursor()
-        cur.execute("PRAGMA user_version")
-        (pragma_user_version,) = cur.fetchone()
+    recover_database(
+        pathlib.Path(input_path),
+        pathlib.Path(output_path),
+        batch_size=batch_size,
+        backend=backend,
+    )
 
-        # Get the table suffix versions as well
-        table_versions = get_table_versions(cur)
 
-    LOGGER.info("Pragma user version is %d", pragma_user_version)
+class RecoveryLogHandler(logging.Handler):
+    """
+    Collects the warnings logged while recovering a database.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(logging.WARNING)
+        self.warnings: list[str] = []
+        self.warning_count = 0
+        self.skipped_rows = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.warning_count += 1
+
+        if getattr(record, "skipped_row", False):
+            self.skipped_rows += 1
+
+        # Thousands of rows can be skipped, only the first warnings are kept
+        if len(self.warnings) < RECOVER_SUMMARY_MAX_WARNINGS:
+            self.warnings.append(self.format(record))
+
+
+def recover_database_job(
+    paths: tuple[pathlib.Path, pathlib.Path], *, batch_size: int, backend: str
+) -> dict[str, typing.Any]:
+    """
+    Recovers one database of a batch, summarizing the result instead of failing.
+    """
+
+    input_path, output_path = paths
+    summary: dict[str, typing.Any] = {
+        "input": str(input_path),
+        "output": str(output_path),
+    }
+
+    handler = RecoveryLogHandler()
+    ROOT_LOGGER.addHandler(handler)
+    start = time.monotonic()
+
+    try:
+        report = recover_database(
+            input_path, output_path, batch_size=batch_size, backend=backend
+        )
+    except Exception as e:
+        LOGGER.error("Failed to recover %s: %r", input_path, e)
+        summary["error"] = str(e) or repr(e)
+    else:
+        summary["error"] = None
+        summary["devices"] = len(report.devices)
+        summary["uninitialized_devices"] = len(report.uninitialized_devices)
+        summary["endpoints"] = report.endpoints
+        summary["attributes"] = report.attributes
+        summary["integrity_errors"] = report.integrity_errors
+        summary["foreign_key_errors"] = report.foreign_key_errors
+    finally:
+        ROOT_LOGGER.removeHandler(handler)
+
+    summary["time"] = round(time.monotonic() - start, 3)
+    summary["skipped_rows"] = handler.skipped_rows
+    summary["warning_count"] = handler.warning_count
+    summary["warnings"] = handler.warnings
+
+    return summary
+
+
+def find_databases(patterns: typing.Iterable[str]) -> list[pathlib.Path]:
+    """
+    Expands directories and glob patterns into a sorted list of database files.
+    """
+
+    paths = set()
+
+    for pattern in patterns:
+        path = pathlib.Path(pattern)
+
+        if path.is_dir():
+            paths.update(p for p in path.rglob("*.db") if p.is_file())
+        elif glob.has_magic(pattern):
+            paths.update(
+                pathlib.Path(p)
+                for p in glob.glob(pattern, recursive=True)
+                if pathlib.Path(p).is_file()
+            )
+        elif path.is_file():
+            paths.add(path)
+        else:
+            raise click.BadParameter(f"{pattern!r} does not exist", param_hint="INPUTS")
+
+    return sorted(paths)
+
+
+@db.command()
+@click.argument("inputs", nargs=-1, required=True)
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False, path_type=pathlib.Path),
+    required=True,
+)
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=1)
+@RECOVER_BATCH_SIZE_OPTION
+@RECOVER_BACKEND_OPTION
+def recover_many(inputs, output_dir, jobs, batch_size, backend):
+    input_paths = [p.absolute() for p in find_databases(inputs)]
+
+    if not input_paths:
+        raise click.ClickException("No databases were found")
+
+    # Databases are often all named `zigbee.db`, so the outputs mirror the directory
+    # layout of the inputs
+    root = pathlib.Path(os.path.commonpath([p.parent for p in input_paths]))
+    jobs_paths = []
+    summaries = []
+
+    for input_path in input_paths:
+        output_path = output_dir / input_path.relative_to(root)
+
+        if output_path.exists():
+            LOGGER.error("Output database already exists: %s", output_path)
+            summaries.append(
+                {
+                    "input": str(input_path),
+                    "output": str(output_path),
+                    "error": "Output database already exists",
+                }
+            )
+            continue
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        jobs_paths.append((input_path, output_path))
+
+    job = functools.partial(
+        recover_database_job, batch_size=batch_size, backend=backend
+    )
+
+    for summary in parallel_map(job, jobs_paths, jobs=jobs):
+        if summary["error"] is None:
+            print(
+                f"{summary['input']}: recovered {summary['devices']} devices,"
+                f" skipped {summary['skipped_rows']} rows"
+            )
+        else:
+            print(f"{summary['input']}: failed: {summary['error']}")
+
+        summaries.append(summary)
+
+    summaries.sort(key=lambda summary: summary["input"])
+    failed = sum(summary["error"] is not None for summary in summaries)
 
-    max_table_version = max(
-        int(v[2:], 10) for v in table_versions.values() if v.startswith("_v")
+    (output_dir / "summary.json").write_text(
+        json.dumps(
+            {
+                "databases": summaries,
+                "recovered": len(summaries) - failed,
+                "failed": failed,
+            },
+            indent=4,
+        )
     )
-    LOGGER.info("Maximum table version is %d", max_table_version)
 
-    if max_table_version != pragma_user_version:
-        LOGGER.warning(
-            "Maximum table version is %d but the user_version is %d!",
-            max_table_version,
-            pragma_user_version,
+    if failed:
+        raise click.ClickException(
+            f"Failed to recover {failed} of {len(summaries)} databases"
         )
 
-    if zigpy.appdb.DB_VERSION != max_table_version:
-        LOGGER.warning(
-            "Zigpy's current DB version is %s but the maximum table version is %s!",
-            zigpy.appdb.DB_VERSION,
-            max_table_version,
+
+@db.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def verify(path):
+    report = asyncio.run(test_database(pathlib.Path(path)))
+    log_database_report(report)
+
+    if report.integrity_errors:
+        raise click.ClickException("Database failed its integrity check")
+
+
+def get_database_size(path: pathlib.Path) -> int:
+    """
+    Computes the size of a database, including its write-ahead log.
+    """
+
+    wal_path = path.with_name(path.name + "-wal")
+
+    return path.stat().st_size + (wal_path.stat().st_size if wal_path.exists() else 0)
+
+
+def get_table_sizes(cursor) -> dict[str, tuple[int, int | None]]:
+    """
+    Counts the rows of every table and the bytes used by it and its indexes. Sizes are
+    `None` if SQLite was built without the `dbstat` virtual table.
+    """
+
+    cursor.execute(
+        "SELECT name FROM sqlite_master"
+        " WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )
+    tables = [name for (name,) in cursor]
+
+    try:
+        cursor.execute(
+            "SELECT m.tbl_name, SUM(s.pgsize) FROM dbstat AS s"
+            " JOIN sqlite_master AS m ON m.name = s.name GROUP BY m.tbl_name"
         )
+        sizes = dict(cursor.fetchall())
+    except sqlite3.OperationalError:
+        sizes = {}
 
-    sql = sqlite3_recover(input_path)
-    statements = sqlite3_split_statements(sql)
+    result = {}
 
-    # Perform the `INSERT` statements separately
-    data_sql = []
-    schema_sql = [f"PRAGMA user_version={max_table_version};"]
+    for table in tables:
+        cursor.execute(f"SELECT COUNT(*) FROM {quote_identifier(table)}")
+        (rows,) = cursor.fetchone()
+        result[table] = (rows, sizes.get(table))
 
-    for statement in statements:
-        if statement.startswith("INSERT"):
-            data_sql.append(statement)
-        else:
-            schema_sql.append(statement)
+    return result
 
-    assert schema_sql[-2:] == ["PRAGMA writable_schema = off;", "COMMIT;"]
 
-    # Finally, perform the recovery
-    with sqlite3.connect(output_path) as conn:
-        cur = conn.cursor()
+def get_obsolete_tables(table_versions: dict[str, str], version: int) -> list[str]:
+    """
+    Finds tables left behind by migrations to the database's `user_version`. Newer
+    tables are kept, zigpy migrates from them again once it is upgraded after a
+    downgrade. Unversioned tables predate versioning and are older than any other.
+    Tables that zigpy never created are kept.
+    """
 
-        # First create the schema
-        for statement in schema_sql[:-2]:
-            LOGGER.debug("Schema: %s", statement)
-            cur.execute(statement)
+    obsolete = []
 
-        # Then insert data, logging errors
-        for statement in data_sql:
-            LOGGER.debug("Data: %s", statement)
+    for name, suffix in table_versions.items():
+        if name[: len(name) - len(suffix)] not in ZIGPY_TABLES:
+            continue
 
-            # Ignore internal tables
-            if statement.startswith(
-                (
-                    'INSERT INTO "sqlite_sequence"(',
-                    "CREATE TABLE IF NOT EXISTS  sqlite_sequence(",
-                )
-            ):
-                continue
+        if (int(suffix[2:]) if suffix else 0) < version:
+            obsolete.append(name)
 
-            try:
-                cur.execute(statement)
-            except sqlite3.IntegrityError as e:
-                LOGGER.warning("Skipping %s: %r", statement, e)
+    return sorted(obsolete)
 
-        # And finally commit
-        for statement in ["PRAGMA writable_schema = off;", "COMMIT;"]:
-            LOGGER.debug("Postamble: %s", statement)
-            cur.execute(statement)
 
-    LOGGER.info("Finished writing database")
+def prune_orphaned_rows(cursor, version: int) -> dict[str, int]:
+    """
+    Deletes rows of the current tables that refer to devices, endpoints or groups that
+    no longer exist. Returns the number of rows deleted from each table.
+    """
 
-    # Load the database with zigpy and test it
-    app = asyncio.run(test_database(pathlib.Path(output_path)))
-    uninitialized_devices = [d for d in app.devices.values() if not d.is_initialized]
+    devices = f"devices_v{version}"
+    pruned: collections.Counter[str] = collections.Counter()
 
-    LOGGER.info(
-        "Recovered %d devices (%d uninitialized)",
-        len(app.devices),
-        len(uninitialized_devices),
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE ?",
+        (f"%_v{version}",),
     )
+    tables = [name for (name,) in cursor]
 
-    for device in app.devices.values():
-        LOGGER.info("%s", device)
+    # Some tables refer to devices without a foreign key
+    for table in tables:
+        cursor.execute(f"PRAGMA table_info({quote_identifier(table)})")
+        columns = {row[1] for row in cursor}
+        cursor.execute(f"PRAGMA foreign_key_list({quote_identifier(table)})")
+        foreign_keys = {row[3] for row in cursor}
+
+        if "device_ieee" in columns and "device_ieee" not in foreign_keys:
+            cursor.execute(
+                f"DELETE FROM {quote_identifier(table)}"
+                f" WHERE device_ieee NOT IN (SELECT ieee FROM {devices})"
+            )
+
+            if cursor.rowcount > 0:
+                pruned[table] += cursor.rowcount
+
+    # Deleting a row can orphan rows referring to it, so repeat until nothing changes
+    while True:
+        cursor.execute("PRAGMA foreign_key_check")
+        violations = collections.defaultdict(set)
+
+        for table, rowid, _, _ in cursor.fetchall():
+            if table in tables and rowid is not None:
+                violations[table].add(rowid)
+
+        if not violations:
+            break
+
+        for table, rowids in violations.items():
+            cursor.executemany(
+                f"DELETE FROM {quote_identifier(table)} WHERE _rowid_ = ?",
+                [(rowid,) for rowid in rowids],
+            )
+            pruned[table] += len(rowids)
+
+    return dict(pruned)
+
+
+def try_load_time(path: pathlib.Path) -> str:
+    """
+    Measures how long zigpy takes to load a database, which can fail before it is
+    optimized.
+    """
+
+    try:
+        report = asyncio.run(test_database(path))
+    except Exception as e:
+        LOGGER.warning("zigpy failed to load %s: %r", path, e)
+        return "failed"
+
+    return f"{report.load_time:0.2f}s"
+
+
+def print_table_sizes(sizes: dict[str, tuple[int, int | None]]) -> None:
+    width = max((len(name) for name in sizes), default=0)
+
+    for name, (rows, size) in sizes.items():
+        size_text = "unknown size" if size is None else f"{size:>12,} bytes"
+        print(f"{name:<{width}}  {rows:>10,} rows  {size_text}")
+
+
+@db.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--dry-run", is_flag=True, default=False)
+def optimize(path, dry_run):
+    path = pathlib.Path(path)
+
+    before_size = get_database_size(path)
+    before_load_time = try_load_time(path)
+
+    conn = sqlite3.connect(path, isolation_level=None)
+
+    try:
+        cur = conn.cursor()
+        print(f"Size:       {before_size:,} bytes")
+        print(f"Load time:  {before_load_time}")
+        print()
+        print("Tables:")
+        print_table_sizes(get_table_sizes(cur))
+        print()
+
+        table_versions = get_table_versions(cur)
+        max_table_version = max(
+            (int(v[2:], 10) for v in table_versions.values() if v.startswith("_v")),
+            default=0,
+        )
+        (version,) = cur.execute("PRAGMA user_version").fetchone()
+
+        # Tables are only dropped relative to the version zigpy says it migrated to
+        if version > max_table_version:
+            raise click.ClickException(
+                f"The user_version is {version} but the maximum table version is"
+                f" {max_table_version}, refusing to optimize"
+            )
+
+        if version > zigpy.appdb.DB_VERSION:
+            raise click.ClickException(
+                f"The user_version is {version} but zigpy only supports up to"
+                f" {zigpy.appdb.DB_VERSION}, upgrade zigpy to optimize this database"
+            )
+
+        # Changes are made in a transaction that is rolled back for a dry run
+        cur.execute("BEGIN")
+
+        for table in get_obsolete_tables(table_versions, version):
+            LOGGER.info("Dropping obsolete table %s", table)
+            cur.execute(f"DROP TABLE {quote_identifier(table)}")
+
+        for table, count in prune_orphaned_rows(cur, version).items():
+            LOGGER.info("Pruning %d orphaned rows from %s", count, table)
+
+        if dry_run:
+            cur.execute("ROLLBACK")
+            LOGGER.info("Dry run, no changes were made")
+            return
+
+        cur.execute("COMMIT")
+
+        LOGGER.info("Analyzing")
+        cur.execute("ANALYZE")
+
+        LOGGER.info("Vacuuming")
+        cur.execute("VACUUM")
+        cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+
+    after_size = get_database_size(path)
+    after_load_time = try_load_time(path)
+
+    print()
+    print(f"Size:       {before_size:,} bytes -> {after_size:,} bytes")
+    print(f"Load time:  {before_load_time} -> {after_load_time}")
@@ -0,0 +1,336 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import csv
+import dataclasses
+import functools
+import json
+import logging
+import pathlib
+import re
+import time
+import typing
+
+import click
+
+from zigpy_cli.cli import cli, click_coroutine
+from zigpy_cli.const import RADIO_TO_PACKAGE
+from zigpy_cli.profiling import trace_span
+from zigpy_cli.radio import (
+    ChannelEnergyStats,
+    backup_to_json,
+    create_app,
+    parse_channels,
+    setup_radio_logging,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# Written next to the output of every radio, which cannot have the same name
+SUMMARY_NAME = "summary"
+
+
+@dataclasses.dataclass(frozen=True)
+class FleetRadio:
+    name: str
+    radio: str
+    port: str
+    baudrate: int | None = None
+    database: str | None = None
+
+
+@dataclasses.dataclass(frozen=True)
+class Fleet:
+    radios: list[FleetRadio]
+    output_dir: pathlib.Path
+    jobs: int
+    timeout: float
+
+
+def radio_name_from_port(port: str) -> str:
+    """
+    Derives a file name from a port, like `socket_192.168.1.5_6638`.
+    """
+
+    return re.sub(r"[^A-Za-z0-9.-]+", "_", port).strip("_")
+
+
+def read_inventory(file: typing.TextIO) -> list[FleetRadio]:
+    """
+    Reads a CSV inventory of radios. The `radio` and `port` columns are required,
+    `name`, `baudrate` and `database` are optional.
+    """
+
+    reader = csv.DictReader(file)
+    missing = {"radio", "port"} - set(reader.fieldnames or [])
+
+    if missing:
+        raise click.BadParameter(
+            f"Inventory is missing columns: {', '.join(sorted(missing))}",
+            param_hint="INVENTORY",
+        )
+
+    radios = []
+    names = set()
+
+    for row in reader:
+        # Rows are numbered like lines, after the header
+        line_number = reader.line_num
+        port = (row["port"] or "").strip()
+        radio = (row["radio"] or "").strip()
+        name = (row.get("name") or "").strip() or radio_name_from_port(port)
+        baudrate = (row.get("baudrate") or "").strip()
+
+        if not port:
+            raise click.BadParameter(
+                f"Line {line_number}: port is empty", param_hint="INVENTORY"
+            )
+
+        if radio not in RADIO_TO_PACKAGE:
+            raise click.BadParameter(
+                f"Line {line_number}: {radio!r} is not a radio type",
+                param_hint="INVENTORY",
+            )
+
+        if not baudrate.isdigit() and baudrate:
+            raise click.BadParameter(
+                f"Line {line_number}: {baudrate!r} is not a valid baudrate",
+                param_hint="INVENTORY",
+            )
+
+        # Every radio has its own output file in the output directory, names are
+        # compared like a case-insensitive file system would
+        if name in ("", ".", "..") or "/" in name or "\\" in name:
+            raise click.BadParameter(
+                f"Line {line_number}: radio name {name!r} is not a valid file name",
+                param_hint="INVENTORY",
+            )
+
+        if name.casefold() == SUMMARY_NAME:
+            raise click.BadParameter(
+                f"Line {line_number}: radio name {name!r} is reserved",
+                param_hint="INVENTORY",
+            )
+
+        if name.casefold() in names:
+            raise click.BadParameter(
+                f"Line {line_number}: radio name {name!r} is not unique",
+                param_hint="INVENTORY",
+            )
+
+        names.add(name.casefold())
+        radios.append(
+            FleetRadio(
+                name=name,
+                radio=radio,
+                port=port,
+                baudrate=int(baudrate) if baudrate else None,
+                database=(row.get("database") or "").strip() or None,
+            )
+        )
+
+    return radios
+
+
+async def shutdown_app(app, *, timeout: float) -> None:
+    try:
+        with trace_span("radio.shutdown"):
+            await asyncio.wait_for(app.shutdown(), timeout)
+    except Exception:
+        LOGGER.warning("Caught an exception when shutting down app", exc_info=True)
+
+
+async def run_radio(
+    fleet: Fleet,
+    fleet_radio: FleetRadio,
+    operation: typing.Callable[[typing.Any], typing.Awaitable[dict]],
+    *,
+    semaphore: asyncio.Semaphore,
+) -> dict[str, typing.Any]:
+    """
+    Runs an operation against one radio of the fleet, summarizing the result instead
+    of failing.
+    """
+
+    output_path = fleet.output_dir / f"{fleet_radio.name}.json"
+    summary: dict[str, typing.Any] = {
+        "name": fleet_radio.name,
+        "radio": fleet_radio.radio,
+        "port": fleet_radio.port,
+        "output": None,
+    }
+
+    async with semaphore:
+        start = time.monotonic()
+
+        try:
+            app = create_app(
+                fleet_radio.radio,
+                fleet_radio.port,
+                baudrate=fleet_radio.baudrate,
+                database=fleet_radio.database,
+            )
+
+            try:
+                # The timeout covers connecting too, unreachable bridges often hang
+                obj = await asyncio.wait_for(operation(app), fleet.timeout)
+            finally:
+                await shutdown_app(app, timeout=fleet.timeout)
+        except asyncio.TimeoutError:
+            LOGGER.error("%s timed out after %ss", fleet_radio.name, fleet.timeout)
+            summary["error"] = f"Timed out after {fleet.timeout}s"
+        except Exception as e:
+            LOGGER.error("%s failed: %r", fleet_radio.name, e)
+            summary["error"] = str(e) or repr(e)
+        else:
+            output_path.write_text(json.dumps(obj, indent=4) + "\n")
+            summary["output"] = str(output_path)
+            summary["error"] = None
+
+    summary["time"] = round(time.monotonic() - start, 3)
+
+    if summary["error"] is None:
+        print(f"{fleet_radio.name}: done in {summary['time']}s")
+    else:
+        print(f"{fleet_radio.name}: failed: {summary['error']}")
+
+    return summary
+
+
+async def run_fleet(
+    fleet: Fleet, operation: typing.Callable[[typing.Any], typing.Awaitable[dict]]
+) -> None:
+    """
+    Runs an operation against every radio of the fleet on one event loop, with at
+    most `fleet.jobs` radios at a time, and writes a summary of the results.
+    """
+
+    fleet.output_dir.mkdir(parents=True, exist_ok=True)
+    semaphore = asyncio.Semaphore(fleet.jobs)
+
+    summaries = await asyncio.gather(
+        *(
+            run_radio(fleet, fleet_radio, operation, semaphore=semaphore)
+            for fleet_radio in fleet.radios
+        )
+    )
+    failed = sum(summary["error"] is not None for summary in summaries)
+
+    (fleet.output_dir / f"{SUMMARY_NAME}.json").write_text(
+        json.dumps(
+            {
+                "radios": summaries,
+                "succeeded": len(summaries) - failed,
+                "failed": failed,
+            },
+            indent=4,
+        )
+    )
+
+    if failed:
+        raise click.ClickException(f"Failed on {failed} of {len(summaries)} radios")
+
+
+@cli.group()
+@click.pass_context
+@click.argument("inventory", type=click.File("r"))
+@click.argument("output_dir", type=click.Path(file_okay=False, path_type=pathlib.Path))
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=8)
+@click.option("-t", "--timeout", type=click.FloatRange(min=0), default=300.0)
+def fleet(ctx, inventory, output_dir, jobs, timeout):
+    """
+    Runs a radio command against every radio in the INVENTORY CSV file concurrently,
+    writing the output of each radio and a summary to OUTPUT_DIR.
+    """
+
+    radios = read_inventory(inventory)
+
+    if not radios:
+        raise click.BadParameter("Inventory has no radios", param_hint="INVENTORY")
+
+    for radio in {fleet_radio.radio for fleet_radio in radios}:
+        setup_radio_logging(radio, ctx.parent.params["verbose"])
+
+    ctx.obj = Fleet(radios=radios, output_dir=output_dir, jobs=jobs, timeout=timeout)
+
+
+async def backup_radio(app, *, zigpy_format: bool) -> dict:
+    with trace_span("radio.connect"):
+        await app.connect()
+
+    with trace_span("radio.create_backup"):
+        backup = await app.backups.create_backup(load_devices=True)
+
+    return backup_to_json(backup, zigpy_format=zigpy_format)
+
+
+async def info_radio(app) -> dict:
+    with trace_span("radio.connect"):
+        await app.connect()
+
+    with trace_span("radio.load_network_info"):
+        await app.load_network_info(load_devices=False)
+
+    return {
+        "node_info": app.state.node_info.as_dict(),
+        "network_info": app.state.network_info.as_dict(),
+    }
+
+
+async def energy_scan_radio(
+    app, *, num_scans: int, duration_exp: int, channels
+) -> dict:
+    with trace_span("radio.startup"):
+        await app.startup()
+
+    channel_stats = collections.defaultdict(lambda: ChannelEnergyStats(num_scans))
+
+    for _ in range(num_scans):
+        results = await app.energy_scan(
+            channels=channels, duration_exp=duration_exp, count=1
+        )
+
+        for channel, energy in results.items():
+            channel_stats[channel].add(energy)
+
+    return {
+        "scans": num_scans,
+        "current_channel": app.state.network_info.channel,
+        "channels": {
+            str(channel): stats.as_dict() for channel, stats in channel_stats.items()
+        },
+    }
+
+
+@fleet.command()
+@click.option("-z", "--zigpy-format", is_flag=True, type=bool, default=False)
+@click.pass_obj
+@click_coroutine
+async def backup(fleet, zigpy_format):
+    await run_fleet(fleet, functools.partial(backup_radio, zigpy_format=zigpy_format))
+
+
+@fleet.command()
+@click.pass_obj
+@click_coroutine
+async def info(fleet):
+    await run_fleet(fleet, info_radio)
+
+
+@fleet.command()
+@click.option("-n", "--num-scans", type=click.IntRange(min=1), default=5)
+@click.option("-e", "--duration-exp", type=click.IntRange(min=0, max=14), default=2)
+@click.option("-C", "--channels", callback=parse_channels, default=None)
+@click.pass_obj
+@click_coroutine
+async def energy_scan(fleet, num_scans, duration_exp, channels):
+    await run_fleet(
+        fleet,
+        functools.partial(
+            energy_scan_radio,
+            num_scans=num_scans,
+            duration_exp=duration_exp,
+            channels=channels,
+        ),
+    )
@@ -0,0 +1,336 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import functools
+import logging
+import time
+import typing
+
+import zigpy.device
+import zigpy.exceptions
+import zigpy.serial
+import zigpy.types as t
+import zigpy.zcl.foundation as foundation
+
+LOGGER = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+# zigpy stops waiting for a response after this long, even for sleepy end devices
+PENDING_REQUEST_MAX_AGE = zigpy.device.APS_REPLY_TIMEOUT_EXTENDED
+
+# Devices are created by zigpy, so `Device.request` is patched once for every
+# instrumented application, until the last one is no longer instrumented
+INSTRUMENTED_APPS: list[tuple[typing.Any, RadioMetrics]] = []
+ORIGINAL_DEVICE_REQUEST: typing.Callable[..., typing.Any] | None = None
+
+
+def packet_tsn(packet: t.ZigbeePacket) -> int | None:
+    """
+    Reads the ZDO or ZCL transaction sequence number of a packet. Radio libraries fill
+    `packet.tsn` with their APS counter instead, if at all.
+    """
+
+    data = packet.data.serialize()
+
+    if packet.src_ep == 0 and packet.profile_id == 0:
+        return data[0] if data else None
+
+    try:
+        hdr, _ = foundation.ZCLHeader.deserialize(data)
+    except ValueError:
+        return None
+
+    return hdr.tsn
+
+
+class LatencyHistogram:
+    """
+    Counts latencies in fixed buckets, so any number of them take constant memory.
+    """
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency: float) -> None:
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, 1000 * latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, p: float) -> float | None:
+        """
+        Returns the upper bound of the bucket containing a percentile, in milliseconds.
+        Percentiles in the last bucket are bounded by the maximum latency instead.
+        """
+
+        if not self.count:
+            return None
+
+        rank = p / 100 * self.count
+        total = 0
+
+        for index, count in enumerate(self.buckets[:-1]):
+            total += count
+
+            if total >= rank:
+                return min(LATENCY_BUCKETS_MS[index], round(1000 * self.max, 3))
+
+        return round(1000 * self.max, 3)
+
+    def as_dict(self) -> dict[str, typing.Any]:
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS]
+        labels.append(f">{LATENCY_BUCKETS_MS[-1]}ms")
+
+        return {
+            "count": self.count,
+            "mean_ms": (
+                round(1000 * self.total / self.count, 3) if self.count else None
+            ),
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "max_ms": round(1000 * self.max, 3) if self.count else None,
+            "buckets": dict(zip(labels, self.buckets)),
+        }
+
+
+class RadioMetrics:
+    """
+    Counts the traffic between zigpy and a radio. Bytes are counted on the serial
+    transport, Zigbee frames, retries and latencies on the controller application.
+    """
+
+    def __init__(self) -> None:
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.writes = 0
+        self.reads = 0
+
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.send_errors = 0
+
+        self.requests = 0
+        self.retries = 0
+        self.timeouts = 0
+
+        # Time taken by the radio to accept a frame, and by the device to respond
+        self.send_latency = LatencyHistogram()
+        self.response_latency = LatencyHistogram()
+
+        # Start times of requests awaiting a response by device NWK and TSN, oldest
+        # first
+        self._pending: dict[tuple[t.NWK, int], float] = {}
+
+    def _write(self, write, data) -> None:
+        self.writes += 1
+        self.bytes_sent += len(data)
+        write(data)
+
+    def _data_received(self, data_received, data) -> None:
+        self.reads += 1
+        self.bytes_received += len(data)
+        data_received(data)
+
+    def _connection_made(self, connection_made, transport) -> None:
+        # Radio libraries write frames with a single call, so every write is counted
+        transport.write = functools.partial(self._write, transport.write)
+        connection_made(transport)
+
+    def wrap_protocol(self, protocol):
+        protocol.connection_made = functools.partial(
+            self._connection_made, protocol.connection_made
+        )
+        protocol.data_received = functools.partial(
+            self._data_received, protocol.data_received
+        )
+
+        return protocol
+
+    def install_serial_hook(self) -> typing.Callable[[], None]:
+        """
+        Counts the traffic of every serial connection opened through zigpy, returning a
+        function that removes the hook.
+        """
+
+        # Radio libraries import zigpy's wrapper in different ways, but it always calls
+        # serialx through its module
+        original = getattr(zigpy.serial, "serialx_create_serial_connection", None)
+
+        if original is None:
+            LOGGER.warning("Serial traffic cannot be counted with this zigpy version")
+            return lambda: None
+
+        async def create_serial_connection(loop, protocol_factory, *args, **kwargs):
+            return await original(
+                loop, lambda: self.wrap_protocol(protocol_factory()), *args, **kwargs
+            )
+
+        zigpy.serial.serialx_create_serial_connection = create_serial_connection
+
+        def remove() -> None:
+            zigpy.serial.serialx_create_serial_connection = original
+
+        return remove
+
+    async def _send_packet(self, send_packet, packet: t.ZigbeePacket) -> None:
+        self.frames_sent += 1
+        start = time.perf_counter()
+
+        try:
+            await send_packet(packet)
+        except (zigpy.exceptions.DeliveryError, asyncio.TimeoutError):
+            self.send_errors += 1
+            raise
+
+        self.send_latency.add(time.perf_counter() - start)
+
+    def _expire_pending(self, now: float) -> None:
+        # Requests are kept in the order they were sent, so the oldest ones come first
+        while self._pending:
+            key, start = next(iter(self._pending.items()))
+
+            if now - start < PENDING_REQUEST_MAX_AGE:
+                break
+
+            del self._pending[key]
+
+    async def _request(self, request, *args, **kwargs):
+        device = kwargs.get("device")
+
+        # zigpy retries unicast requests with forced route discovery
+        if kwargs.get("force_route_discovery"):
+            self.retries += 1
+
+        if device is None or not kwargs.get("expect_reply", True):
+            return await request(*args, **kwargs)
+
+        self.requests += 1
+        key = (device.nwk, kwargs["sequence"])
+        now = time.perf_counter()
+
+        # The latency of a retried request is measured from its last attempt
+        self._expire_pending(now)
+        self._pending.pop(key, None)
+        self._pending[key] = now
+
+        try:
+            return await request(*args, **kwargs)
+        except Exception:
+            self._pending.pop(key, None)
+            raise
+
+    def _packet_received(self, packet_received, packet: t.ZigbeePacket) -> None:
+        self.frames_received += 1
+
+        if packet.src.addr_mode == t.AddrMode.NWK and self._pending:
+            key = (packet.src.address, packet_tsn(packet))
+            start = self._pending.pop(key, None)
+
+            if start is not None:
+                self.response_latency.add(time.perf_counter() - start)
+
+        packet_received(packet)
+
+    def instrument_app(self, app) -> typing.Callable[[], None]:
+        """
+        Counts the frames and requests of a controller application, returning a
+        function that stops counting the timeouts of its devices.
+        """
+
+        global ORIGINAL_DEVICE_REQUEST
+
+        app.send_packet = functools.partial(self._send_packet, app.send_packet)
+        app.request = functools.partial(self._request, app.request)
+        app.packet_received = functools.partial(
+            self._packet_received, app.packet_received
+        )
+
+        if not INSTRUMENTED_APPS:
+            ORIGINAL_DEVICE_REQUEST = zigpy.device.Device.request
+            zigpy.device.Device.request = instrumented_device_request
+
+        entry = (app, self)
+        INSTRUMENTED_APPS.append(entry)
+
+        def remove() -> None:
+            global ORIGINAL_DEVICE_REQUEST
+
+            if entry not in INSTRUMENTED_APPS:
+                return
+
+            INSTRUMENTED_APPS.remove(entry)
+
+            if not INSTRUMENTED_APPS:
+                zigpy.device.Device.request = ORIGINAL_DEVICE_REQUEST
+                ORIGINAL_DEVICE_REQUEST = None
+
+        return remove
+
+    def as_dict(self) -> dict[str, typing.Any]:
+        return {
+            "serial": {
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "writes": self.writes,
+                "reads": self.reads,
+            },
+            "frames": {
+                "sent": self.frames_sent,
+                "received": self.frames_received,
+                "send_errors": self.send_errors,
+            },
+            "requests": {
+                "count": self.requests,
+                "retries": self.retries,
+                "timeouts": self.timeouts,
+            },
+            "send_latency": self.send_latency.as_dict(),
+            "response_latency": self.response_latency.as_dict(),
+        }
+
+
+async def instrumented_device_request(device, *args, **kwargs):
+    assert ORIGINAL_DEVICE_REQUEST is not None
+    metrics = [m for app, m in INSTRUMENTED_APPS if device.application is app]
+
+    # zigpy only starts waiting for the response once the request has been sent, so
+    # timeouts are only known to the device
+    try:
+        return await ORIGINAL_DEVICE_REQUEST(device, *args, **kwargs)
+    except asyncio.TimeoutError:
+        for radio_metrics in metrics:
+            radio_metrics.timeouts += 1
+
+        raise
+
+
+def print_radio_metrics(metrics: RadioMetrics, file: typing.TextIO) -> None:
+    summary = metrics.as_dict()
+
+    print("Radio metrics:", file=file)
+    print("------------------------------------------------", file=file)
+
+    for section in ["serial", "frames", "requests"]:
+        for name, value in summary[section].items():
+            print(f" - {section} {name.replace('_', ' ')}: {value}", file=file)
+
+    for name in ["send_latency", "response_latency"]:
+        latency = summary[name]
+        print(
+            f" - {name.replace('_', ' ')}: count={latency['count']}"
+            f" mean={latency['mean_ms']}ms p50<={latency['p50_ms']}ms"
+            f" p95<={latency['p95_ms']}ms p99<={latency['p99_ms']}ms"
+            f" max={latency['max_ms']}ms",
+            file=file,
+        )
+
+        for bucket, count in latency["buckets"].items():
+            if count:
+                print(f"     {bucket:>9}: {count}", file=file)
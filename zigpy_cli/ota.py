@@ -1,24 +1,81 @@
 from __future__ import annotations
 
+import bisect
 import collections
+import concurrent.futures
+import functools
+import gzip
 import hashlib
 import json
 import logging
+import os
 import pathlib
+import re
+import sqlite3
 import subprocess
+import typing
 
 import click
 import zigpy.types as t
-from zigpy.ota.image import ElementTagId, HueSBLOTAImage, parse_ota_image
+import zigpy.zcl.foundation as foundation
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESCCM
+from zigpy.ota.image import (
+    BaseOTAImage,
+    ElementTagId,
+    HueSBLOTAImage,
+    OTAImage,
+    OTAImageHeader,
+    SubElement,
+    parse_ota_image,
+)
 from zigpy.ota.validators import validate_ota_image
 from zigpy.types.named import _hex_string_to_bytes
 from zigpy.util import convert_install_code as zigpy_convert_install_code
+from zigpy.zcl.clusters.general import Ota
 
 from zigpy_cli.cli import cli
-from zigpy_cli.common import HEX_OR_DEC_INT
+from zigpy_cli.common import HEX_OR_DEC_INT, map_file, parallel_map
+from zigpy_cli.profiling import trace_iter, trace_span
+
+if typing.TYPE_CHECKING:
+    from scapy.layers.zigbee import ZigbeeAppDataPayload
+    from scapy.packet import Packet
 
 LOGGER = logging.getLogger(__name__)
 
+# Zigbee PRO always uses AES-CCM* with a 32-bit MIC
+ZIGBEE_SECURITY_LEVEL = 0b101
+ZIGBEE_MIC_LENGTH = 4
+
+QUERY_NEXT_IMAGE_RSP = Ota.ClientCommandDefs.query_next_image_response
+IMAGE_BLOCK_RSP = Ota.ClientCommandDefs.image_block_response
+
+OTA_IMAGE_MAGIC = OTAImageHeader.MAGIC_VALUE.to_bytes(4, "little")
+HUE_MANUFACTURER_ID = 4107
+
+# Base header plus every optional field
+OTA_HEADER_MAX_LENGTH = 56 + 1 + 8 + 2 + 2
+OTA_HASH_CHUNK_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+OTA_INDEX_MANIFEST_NAME = "index.json"
+OTA_INDEX_SHARD_REGEX = re.compile(r"^\d+\.json(?:\.gz)?$")
+
+# `(file_version, image_type, manufacturer_code)`
+OTAImageKey = typing.Tuple[int, int, int]
+
+# Only the OTA fields we need are printed by tshark, in this order
+TSHARK_OTA_FIELDS = {
+    "status": "zbee_zcl_general.ota.status",
+    "file_version": "zbee_zcl_general.ota.file.version",
+    "image_type": "zbee_zcl_general.ota.image.type",
+    "manufacturer_code": "zbee_zcl_general.ota.manufacturer_code",
+    "image_size": "zbee_zcl_general.ota.image.size",
+    "file_offset": "zbee_zcl_general.ota.file.offset",
+    "image_data": "zbee_zcl_general.ota.image.data",
+}
+
 
 def convert_install_code(text: str) -> t.KeyData:
     code = _hex_string_to_bytes(text)
@@ -30,40 +87,797 @@ def convert_install_code(text: str) -> t.KeyData:
     return key
 
 
-@cli.group()
-def ota():
-    pass
+def parse_tshark_int(text: str) -> int:
+    """
+    Parses an integer field printed by tshark, which may be in hex or decimal.
+    """
 
+    if text[:2].lower() == "0x":
+        return int(text[2:], 16)
 
-@ota.command()
-@click.argument("files", nargs=-1, type=pathlib.Path)
-def info(files):
-    for f in files:
-        if not f.is_file():
+    return int(text, 10)
+
+
+def iter_tshark_ota_packets(
+    path: pathlib.Path, keys: str
+) -> typing.Iterator[dict[str, str]]:
+    """
+    Dissects a packet capture with tshark and yields the OTA fields of every OTA cluster
+    packet as it is read, without buffering the capture in memory.
+    """
+
+    command = [
+        "tshark",
+        "-o",
+        f"uat:zigbee_pc_keys:{keys}",
+        "-r",
+        str(path),
+        "-Y",
+        "zbee_zcl && zbee_aps.cluster == 0x0019",
+        "-T",
+        "fields",
+        "-E",
+        "occurrence=f",
+    ]
+
+    for field in TSHARK_OTA_FIELDS.values():
+        command.extend(["-e", field])
+
+    with subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        encoding="utf-8",
+    ) as proc:
+        for line in proc.stdout:
+            values = line.rstrip("\n").split("\t")
+
+            # Fields occurring more than once are separated by commas, only the first
+            # occurrence belongs to the OTA command
+            yield {
+                name: value.split(",", 1)[0]
+                for name, value in zip(TSHARK_OTA_FIELDS, values)
+            }
+
+    # tshark also fails on captures that were cut short, whose packets are still useful
+    if proc.returncode != 0:
+        LOGGER.warning("tshark exited with code %d for %s", proc.returncode, path)
+
+
+class OTAImageAssembler:
+    """
+    Assembles an OTA image from possibly overlapping and out of order chunks.
+
+    Data is stored in a single `bytearray` and the covered byte ranges are tracked as a
+    sorted list of disjoint intervals, so merging chunks and finding gaps takes time
+    proportional to the number of chunks instead of the size of the image.
+    """
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+
+        # Sorted, disjoint and non-adjacent `[start, end)` intervals
+        self._starts: list[int] = []
+        self._ends: list[int] = []
+
+    @property
+    def size(self) -> int:
+        """
+        Offset one past the last received byte.
+        """
+
+        return self._ends[-1] if self._ends else 0
+
+    @property
+    def intervals(self) -> list[tuple[int, int]]:
+        """
+        Received byte ranges, as `(start, end)` pairs.
+        """
+
+        return list(zip(self._starts, self._ends))
+
+    def add_chunk(self, offset: int, chunk: bytes) -> list[tuple[int, bytes, bytes]]:
+        """
+        Adds a chunk of data, overwriting any previously received data. Returns a list
+        of `(offset, old, new)` for every previously received range that differs.
+        """
+
+        end = offset + len(chunk)
+
+        if not chunk:
+            return []
+
+        # Intervals `i:j` either overlap or are adjacent to the new chunk
+        i = bisect.bisect_left(self._ends, offset)
+        j = bisect.bisect_right(self._starts, end)
+
+        conflicts = []
+
+        for start, stop in zip(self._starts[i:j], self._ends[i:j]):
+            overlap_start = max(start, offset)
+            overlap_end = min(stop, end)
+
+            if overlap_start >= overlap_end:
+                continue
+
+            old = bytes(self.data[overlap_start:overlap_end])
+            new = chunk[overlap_start - offset : overlap_end - offset]
+
+            if old != new:
+                conflicts.append((overlap_start, old, new))
+
+        if i < j:
+            self._starts[i:j] = [min(self._starts[i], offset)]
+            self._ends[i:j] = [max(self._ends[j - 1], end)]
+        else:
+            self._starts.insert(i, offset)
+            self._ends.insert(i, end)
+
+        if len(self.data) < end:
+            self.data.extend(bytes(end - len(self.data)))
+
+        self.data[offset:end] = chunk
+
+        return conflicts
+
+    def merge(self, other: OTAImageAssembler) -> list[tuple[int, bytes, bytes]]:
+        """
+        Adds all data received by another assembler.
+        """
+
+        conflicts = []
+
+        for start, end in other.intervals:
+            conflicts.extend(self.add_chunk(start, bytes(other.data[start:end])))
+
+        return conflicts
+
+    def missing_ranges(self, size: int) -> list[tuple[int, int]]:
+        """
+        Returns a list of `(offset, count)` ranges within the first `size` bytes that
+        have not been received.
+        """
+
+        missing = []
+        position = 0
+
+        for start, end in self.intervals:
+            if start >= size:
+                break
+
+            if start > position:
+                missing.append((position, start - position))
+
+            position = end
+
+        if position < size:
+            missing.append((position, size - position))
+
+        return missing
+
+    def assemble(self, size: int, *, fill_byte: int) -> bytes:
+        """
+        Returns the first `size` bytes of the image, with missing ranges filled in.
+        """
+
+        image = bytearray(self.data[:size])
+        image.extend(bytes(size - len(image)))
+
+        for start, count in self.missing_ranges(size):
+            image[start : start + count] = bytes([fill_byte]) * count
+
+        return bytes(image)
+
+
+def log_ota_conflicts(conflicts: list[tuple[int, bytes, bytes]]) -> None:
+    for offset, old, new in conflicts:
+        LOGGER.error(
+            f"Inconsistent {len(new)} bytes starting at offset"
+            f" 0x{offset:08X}: was {old!r}, now {new!r}"
+        )
+
+
+def extract_ota_images_tshark(
+    path: pathlib.Path, keys: str
+) -> tuple[dict[OTAImageKey, int], dict[OTAImageKey, OTAImageAssembler]]:
+    """
+    Extracts the OTA image sizes and chunks sent in a single packet capture, keyed by
+    `(file_version, image_type, manufacturer_code)`.
+    """
+
+    ota_sizes = {}
+    ota_images = collections.defaultdict(OTAImageAssembler)
+
+    # Packets are folded into the per-image state as tshark emits them, so memory
+    # usage depends on the size of the images and not on the size of the capture
+    for fields in trace_iter("ota.tshark", iter_tshark_ota_packets(path, keys)):
+        if not fields["status"] or parse_tshark_int(fields["status"]) != 0x00:
             continue
 
+        image_key = (
+            parse_tshark_int(fields["file_version"]),
+            parse_tshark_int(fields["image_type"]),
+            parse_tshark_int(fields["manufacturer_code"]),
+        )
+
+        if fields["image_size"]:
+            ota_sizes[image_key] = parse_tshark_int(fields["image_size"])
+        elif fields["image_data"]:
+            offset = parse_tshark_int(fields["file_offset"])
+            data = bytes.fromhex(fields["image_data"].replace(":", ""))
+
+            log_ota_conflicts(ota_images[image_key].add_chunk(offset, data))
+
+    return ota_sizes, dict(ota_images)
+
+
+def zigbee_decrypt(
+    header: bytes,
+    aux_header: bytes,
+    source: bytes,
+    payload: bytes,
+    ciphers: list[AESCCM],
+) -> bytes | None:
+    """
+    Decrypts and authenticates a secured NWK or APS payload, trying every key.
+    """
+
+    # The security level is zeroed over the air but is still part of the nonce and MIC
+    aux_header = (
+        bytes([aux_header[0] & ~0b111 | ZIGBEE_SECURITY_LEVEL]) + aux_header[1:]
+    )
+    nonce = source + aux_header[1:5] + aux_header[:1]
+
+    for cipher in ciphers:
         try:
-            image, rest = parse_ota_image(f.read_bytes())
-        except Exception as e:
-            LOGGER.warning("Failed to parse %s: %s", f, e)
+            return cipher.decrypt(nonce, payload, header + aux_header)
+        except InvalidTag:
+            continue
+
+    return None
+
+
+def decrypt_zigbee_layer(
+    layer: Packet, ciphers: list[AESCCM], source: bytes | None = None
+) -> bytes | None:
+    """
+    Decrypts the payload of a dissected NWK or APS layer followed by a security header.
+    """
+
+    secured = layer.payload
+    layer_raw = bytes(layer.original)
+    secured_raw = bytes(secured.original)
+    payload = secured.data + secured.mic
+
+    header = layer_raw[: len(layer_raw) - len(secured_raw)]
+    aux_header = secured_raw[: len(secured_raw) - len(payload)]
+
+    if secured.extended_nonce:
+        source = aux_header[5:13]
+
+    if source is None or len(payload) < ZIGBEE_MIC_LENGTH:
+        return None
+
+    return zigbee_decrypt(header, aux_header, source, payload, ciphers)
+
+
+def iter_zigbee_aps_data_frames(
+    path: pathlib.Path, ciphers: list[AESCCM]
+) -> typing.Iterator[tuple[ZigbeeAppDataPayload, bytes]]:
+    """
+    Reads a packet capture and yields every APS data frame along with its payload,
+    decrypting NWK and APS security with the first matching key.
+    """
+
+    # scapy is slow to import and only needed to dissect captures
+    from scapy.config import conf as scapy_conf
+    from scapy.layers.zigbee import ZigbeeAppDataPayload, ZigbeeNWK
+    from scapy.utils import PcapReader
+
+    scapy_conf.dot15d4_protocol = "zigbee"
+
+    packets = 0
+    zigbee_frames = 0
+
+    for packet in PcapReader(str(path)):
+        packets += 1
+        nwk = packet.getlayer(ZigbeeNWK)
+
+        if nwk is None:
+            continue
+
+        zigbee_frames += 1
+
+        if nwk.frametype != 0:
             continue
 
-        if rest:
-            LOGGER.warning("Image has trailing data %s: %r", f, rest)
+        source = None
+
+        if nwk.flags.security:
+            source = nwk.payload.source if nwk.payload.extended_nonce else None
+            source = None if source is None else source.to_bytes(8, "little")
+            plaintext = decrypt_zigbee_layer(nwk, ciphers)
 
-        print(f)
-        print(f"Type: {type(image)}")
-        print(f"Header: {image.header}")
+            if plaintext is None:
+                continue
+
+            aps = ZigbeeAppDataPayload(plaintext)
+        else:
+            aps = nwk.getlayer(ZigbeeAppDataPayload)
 
-        if hasattr(image, "subelements"):
-            print(f"Number of subelements: {len(image.subelements)}")
+            if aps is None:
+                continue
+
+        if aps.aps_frametype != 0:
+            continue
+
+        if aps.frame_control.security:
+            aps_payload = decrypt_zigbee_layer(aps, ciphers, source=source)
+
+            if aps_payload is None:
+                continue
+        else:
+            aps_payload = bytes(aps.payload.original or b"")
+
+        yield aps, aps_payload
+
+    # scapy only dissects link types it maps to IEEE 802.15.4, everything else is
+    # silently skipped
+    if packets and not zigbee_frames:
+        LOGGER.warning(
+            "None of the %d packets in %s are Zigbee frames, its link type may not be"
+            " supported by the native backend: try `--backend tshark`",
+            packets,
+            path,
+        )
+
+
+def extract_ota_images_native(
+    path: pathlib.Path, keys: list[t.KeyData]
+) -> tuple[dict[OTAImageKey, int], dict[OTAImageKey, OTAImageAssembler]]:
+    """
+    Extracts the OTA image sizes and chunks sent in a single packet capture without
+    tshark, keyed by `(file_version, image_type, manufacturer_code)`.
+    """
+
+    ciphers = [AESCCM(key.serialize(), tag_length=ZIGBEE_MIC_LENGTH) for key in keys]
+
+    ota_sizes = {}
+    ota_images = collections.defaultdict(OTAImageAssembler)
+
+    for aps, payload in trace_iter(
+        "ota.pcap_parse", iter_zigbee_aps_data_frames(path, ciphers)
+    ):
+        if aps.cluster != Ota.cluster_id:
+            continue
+
+        # Image blocks are never large enough to require APS fragmentation
+        if aps.frame_control.extended_hdr and aps.fragmentation:
+            continue
 
         try:
-            result = validate_ota_image(image)
-        except Exception as e:
-            LOGGER.warning("Image is invalid %s: %s", f, e)
+            hdr, data = foundation.ZCLHeader.deserialize(payload)
+        except (ValueError, KeyError):
+            continue
+
+        if (
+            not hdr.frame_control.is_cluster
+            or hdr.direction != foundation.Direction.Server_to_Client
+            or hdr.command_id not in (QUERY_NEXT_IMAGE_RSP.id, IMAGE_BLOCK_RSP.id)
+        ):
+            continue
+
+        try:
+            command, _ = Ota.client_commands[hdr.command_id].schema.deserialize(data)
+        except (ValueError, KeyError):
+            LOGGER.debug("Failed to parse OTA command %s: %r", hdr, data)
+            continue
+
+        if command.status != foundation.Status.SUCCESS:
+            continue
+
+        image_key = (
+            int(command.file_version),
+            int(command.image_type),
+            int(command.manufacturer_code),
+        )
+
+        if hdr.command_id == QUERY_NEXT_IMAGE_RSP.id:
+            ota_sizes[image_key] = int(command.image_size)
         else:
-            print(f"Validation result: {result}")
+            log_ota_conflicts(
+                ota_images[image_key].add_chunk(
+                    command.file_offset, bytes(command.image_data)
+                )
+            )
+
+    return ota_sizes, dict(ota_images)
+
+
+def hash_view(view: memoryview) -> str:
+    """
+    Computes the SHA3-256 checksum of a buffer without copying it.
+    """
+
+    digest = hashlib.sha3_256()
+
+    with trace_span("ota.hash"):
+        for offset in range(0, len(view), OTA_HASH_CHUNK_SIZE):
+            digest.update(view[offset : offset + OTA_HASH_CHUNK_SIZE])
+
+    return f"sha3-256:{digest.hexdigest()}"
+
+
+def read_ota_image_layout(
+    view: memoryview,
+) -> tuple[type, OTAImageHeader, list[tuple[ElementTagId | None, int, int]]] | None:
+    """
+    Reads only the header and subelement table of a Zigbee OTA image, returning the
+    image type, header, and the `(tag_id, start, end)` offsets of every subelement. Hue
+    SBL images have a single untagged section. Returns `None` for containers and other
+    layouts that need to be parsed with `parse_ota_image`.
+    """
+
+    size = len(view)
+
+    # Mirror the container detection in `parse_ota_image`
+    if (
+        view[:4] != OTA_IMAGE_MAGIC
+        or int.from_bytes(view[0:4], "little") + 21 == size
+        or (size > 152 and int.from_bytes(view[68:72], "little") + 64 == size)
+    ):
+        return None
+
+    try:
+        header, _ = OTAImageHeader.deserialize(bytes(view[:OTA_HEADER_MAX_LENGTH]))
+    except ValueError:
+        return None
+
+    if size < header.image_size:
+        return None
+
+    start = len(header.serialize())
+
+    if (
+        header.manufacturer_id == HUE_MANUFACTURER_ID
+        and view[start : start + 3] == HueSBLOTAImage.SUBELEMENTS_MAGIC
+    ):
+        return HueSBLOTAImage, header, [(None, start, header.image_size)]
+
+    end = start + header.image_size - header.header_length
+    subelements = []
+
+    while start < end:
+        if start + 6 > end:
+            return None
+
+        tag_id = int.from_bytes(view[start : start + 2], "little")
+        length = int.from_bytes(view[start + 2 : start + 6], "little")
+
+        if start + 6 + length > end:
+            return None
+
+        subelements.append((ElementTagId(tag_id), start + 6, start + 6 + length))
+        start += 6 + length
+
+    return OTAImage, header, subelements
+
+
+def parse_ota_image_view(view: memoryview) -> tuple[BaseOTAImage, bytes]:
+    """
+    Parses an OTA image like `parse_ota_image` but copies only the image contents out
+    of the buffer, instead of the whole buffer and then every subelement.
+    """
+
+    with trace_span("ota.parse"):
+        return _parse_ota_image_view(view)
+
+
+def _parse_ota_image_view(view: memoryview) -> tuple[BaseOTAImage, bytes]:
+    layout = read_ota_image_layout(view)
+
+    if layout is None:
+        return parse_ota_image(bytes(view))
+
+    image_cls, header, sections = layout
+    rest = bytes(view[header.image_size :])
+
+    if image_cls is HueSBLOTAImage:
+        ((_, start, end),) = sections
+        return HueSBLOTAImage(header=header, data=bytes(view[start:end])), rest
+
+    subelements = [
+        SubElement(tag_id=tag_id, data=view[start:end])
+        for tag_id, start, end in sections
+    ]
+
+    return OTAImage(header=header, subelements=subelements), rest
+
+
+def parse_ota_index_metadata(path: pathlib.Path) -> tuple[dict, str | None] | None:
+    """
+    Parses and validates an OTA image, returning its index metadata (without a URL) and
+    the validation error, if any. Returns `None` if the image cannot be indexed.
+    """
+
+    LOGGER.info("Parsing %s", path)
+
+    with path.open("rb") as f, map_file(f) as view:
+        checksum = hash_view(view)
+
+        try:
+            image, rest = parse_ota_image_view(view)
+        except Exception as e:
+            LOGGER.error("Failed to parse %s: %s", path, e)
+            return None
+
+    if rest:
+        LOGGER.error("Image %s has trailing data: %r", path, rest)
+        return None
+
+    validation_error = None
+
+    try:
+        validate_ota_image(image)
+    except Exception as e:
+        LOGGER.error("Image %s is invalid: %s", path, e)
+        validation_error = str(e)
+
+    metadata = {
+        "file_version": int(image.header.file_version),
+        "image_type": int(image.header.image_type),
+        "manufacturer_id": int(image.header.manufacturer_id),
+        "changelog": "",
+        "checksum": checksum,
+    }
+
+    if image.header.hardware_versions_present:
+        metadata["min_hardware_version"] = int(image.header.minimum_hardware_version)
+        metadata["max_hardware_version"] = int(image.header.maximum_hardware_version)
+
+    return metadata, validation_error
+
+
+def ota_index_key(metadata: dict) -> tuple[int, int, int, str]:
+    return (
+        metadata["manufacturer_id"],
+        metadata["image_type"],
+        metadata["file_version"],
+        metadata["checksum"],
+    )
+
+
+def read_ota_index_key(path: pathlib.Path) -> tuple[int, int, int, str] | None:
+    """
+    Reads the index key of an OTA image from its header and checksum, without parsing
+    or validating the rest of it. Returns `None` for layouts that must be parsed.
+    """
+
+    with path.open("rb") as f, map_file(f) as view:
+        layout = read_ota_image_layout(view)
+
+        if layout is None:
+            return None
+
+        _, header, _ = layout
+
+        return (
+            int(header.manufacturer_id),
+            int(header.image_type),
+            int(header.file_version),
+            hash_view(view),
+        )
+
+
+def load_ota_index(path: pathlib.Path) -> dict[tuple[int, int, int, str], dict]:
+    """
+    Loads an existing OTA index, keyed by manufacturer ID, image type, file version and
+    checksum. A missing index is treated as empty.
+    """
+
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return {}
+
+    if data.startswith(GZIP_MAGIC):
+        data = gzip.decompress(data)
+
+    entries = json.loads(data)
+
+    return {ota_index_key(entry): entry for entry in entries}
+
+
+def serialize_ota_index(entries: list[dict], *, compact: bool, compress: bool) -> bytes:
+    if compact:
+        text = json.dumps(entries, separators=(",", ":"))
+    else:
+        text = json.dumps(entries, indent=4)
+
+    data = (text + "\n").encode("utf-8")
+
+    if compress:
+        # A fixed timestamp keeps the output reproducible
+        data = gzip.compress(data, mtime=0)
+
+    return data
+
+
+def write_file_atomic(path: pathlib.Path, data: bytes) -> None:
+    """
+    Writes a file by replacing it with a complete temporary file in the same directory,
+    so readers never see a partially written file.
+    """
+
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+
+    try:
+        with temp_path.open("wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def write_sharded_ota_index(
+    shard_dir: pathlib.Path, entries: list[dict], *, compact: bool, compress: bool
+) -> None:
+    """
+    Writes one index file per manufacturer ID and a manifest listing them, so consumers
+    only need to download the images relevant to them.
+    """
+
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    suffix = ".json.gz" if compress else ".json"
+
+    shards = collections.defaultdict(list)
+
+    for entry in entries:
+        shards[entry["manufacturer_id"]].append(entry)
+
+    manifest = []
+
+    for manufacturer_id, shard in sorted(shards.items()):
+        data = serialize_ota_index(shard, compact=compact, compress=compress)
+        path = shard_dir / f"{manufacturer_id}{suffix}"
+        write_file_atomic(path, data)
+
+        manifest.append(
+            {
+                "manufacturer_id": manufacturer_id,
+                "path": path.name,
+                "images": len(shard),
+                "checksum": f"sha3-256:{hashlib.sha3_256(data).hexdigest()}",
+            }
+        )
+
+    # The manifest is replaced last, after every shard it references exists
+    write_file_atomic(
+        shard_dir / OTA_INDEX_MANIFEST_NAME,
+        serialize_ota_index(manifest, compact=compact, compress=False),
+    )
+
+    written = {entry["path"] for entry in manifest}
+
+    for path in shard_dir.iterdir():
+        if OTA_INDEX_SHARD_REGEX.match(path.name) and path.name not in written:
+            LOGGER.info("Removing stale shard %s", path)
+            path.unlink()
+
+
+class OTAMetadataCache:
+    """
+    SQLite cache of OTA index metadata, keyed by file path, size, modification time and
+    inode. An entry is only used if none of them have changed since it was stored.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ota_metadata (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                metadata TEXT NOT NULL,
+                validation_error TEXT
+            )
+            """)
+
+    def get(
+        self, path: pathlib.Path, stat: os.stat_result
+    ) -> tuple[dict, str | None] | None:
+        row = self._conn.execute(
+            "SELECT metadata, validation_error FROM ota_metadata"
+            " WHERE path=? AND size=? AND mtime_ns=? AND inode=?",
+            (str(path.absolute()), stat.st_size, stat.st_mtime_ns, stat.st_ino),
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        metadata, validation_error = row
+
+        return json.loads(metadata), validation_error
+
+    def set(
+        self,
+        path: pathlib.Path,
+        stat: os.stat_result,
+        metadata: dict,
+        validation_error: str | None,
+    ) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO ota_metadata VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                str(path.absolute()),
+                stat.st_size,
+                stat.st_mtime_ns,
+                stat.st_ino,
+                json.dumps(metadata),
+                validation_error,
+            ),
+        )
+
+    def close(self) -> None:
+        self._conn.commit()
+        self._conn.close()
+
+
+@cli.group()
+def ota():
+    pass
+
+
+def describe_ota_image(path: pathlib.Path) -> list[str] | None:
+    """
+    Parses and validates an OTA image, returning the lines printed by `ota info`.
+    """
+
+    try:
+        with path.open("rb") as f, map_file(f) as view:
+            image, rest = parse_ota_image_view(view)
+    except Exception as e:
+        LOGGER.warning("Failed to parse %s: %s", path, e)
+        return None
+
+    if rest:
+        LOGGER.warning("Image has trailing data %s: %r", path, rest)
+
+    lines = [
+        f"{path}",
+        f"Type: {type(image)}",
+        f"Header: {image.header}",
+    ]
+
+    if hasattr(image, "subelements"):
+        lines.append(f"Number of subelements: {len(image.subelements)}")
+
+    try:
+        result = validate_ota_image(image)
+    except Exception as e:
+        LOGGER.warning("Image is invalid %s: %s", path, e)
+    else:
+        lines.append(f"Validation result: {result}")
+
+    return lines
+
+
+@ota.command()
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=1)
+@click.argument("files", nargs=-1, type=pathlib.Path)
+def info(files, jobs=1):
+    files = [f for f in files if f.is_file()]
+
+    for lines in parallel_map(describe_ota_image, files, jobs=jobs):
+        if lines is None:
+            continue
+
+        for line in lines:
+            print(line)
 
         print()
 
@@ -72,7 +886,23 @@ def info(files):
 @click.argument("input", type=click.File("rb"))
 @click.argument("output", type=click.File("wb"))
 def dump_firmware(input, output):
-    image, _ = parse_ota_image(input.read())
+    with map_file(input) as view:
+        layout = read_ota_image_layout(view)
+
+        # The firmware is written straight out of the mapped file
+        if layout is not None:
+            image_cls, _, sections = layout
+
+            for tag_id, start, end in sections:
+                if image_cls is HueSBLOTAImage or tag_id == ElementTagId.UPGRADE_IMAGE:
+                    output.write(view[start:end])
+                    break
+            else:
+                LOGGER.warning("Image has no UPGRADE_IMAGE subelements")
+
+            return
+
+        image, _ = parse_ota_image(bytes(view))
 
     if isinstance(image, HueSBLOTAImage):
         output.write(image.data)
@@ -88,59 +918,188 @@ def dump_firmware(input, output):
 @ota.command()
 @click.pass_context
 @click.option("--ota-url-root", type=str, default=None)
-@click.option("--output", type=click.File("w"), default="-")
+@click.option("--output", type=click.File("wb"), default="-")
+@click.option(
+    "--shard-dir",
+    type=click.Path(file_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="Write one index per manufacturer ID and a manifest into a directory",
+)
+@click.option("--compact", is_flag=True, default=False, help="Omit JSON whitespace")
+@click.option(
+    "--gzip", "compress", is_flag=True, default=False, help="Compress with gzip"
+)
+@click.option(
+    "--cache",
+    "cache_path",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="Cache parsed metadata, defaults to `<index>.cache` with `--update`",
+)
+@click.option(
+    "--update",
+    "update_path",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="Update an existing index in place instead of writing to `--output`",
+)
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=1)
 @click.argument("files", nargs=-1, type=pathlib.Path)
-def generate_index(ctx, ota_url_root, output, files):
+def generate_index(
+    ctx,
+    ota_url_root,
+    output,
+    shard_dir,
+    compact,
+    compress,
+    cache_path,
+    update_path,
+    jobs,
+    files,
+):
     if ctx.parent.parent.params["verbose"] == 0:
         cli.callback(verbose=1)
 
+    output_is_default = (
+        ctx.get_parameter_source("output") == click.core.ParameterSource.DEFAULT
+    )
+
+    if update_path is not None and not output_is_default:
+        raise click.UsageError("`--output` cannot be used with `--update`")
+
+    if shard_dir is not None and (update_path is not None or not output_is_default):
+        raise click.UsageError(
+            "`--shard-dir` cannot be used with `--output` or `--update`"
+        )
+
+    # Updates always use a cache, so unchanged images are not read on every run
+    if update_path is not None and cache_path is None:
+        cache_path = update_path.with_name(f"{update_path.name}.cache")
+
+    cache = OTAMetadataCache(cache_path) if cache_path is not None else None
+    files = [f for f in files if f.is_file()]
+    stats = {f: f.stat() for f in files}
+    results = {}
+
+    if cache is not None:
+        for f in files:
+            cached = cache.get(f, stats[f])
+
+            if cached is None:
+                continue
+
+            LOGGER.info("Using cached metadata for %s", f)
+            results[f] = cached
+            _, validation_error = cached
+
+            if validation_error is not None:
+                LOGGER.error("Image %s is invalid: %s", f, validation_error)
+
+    # Images already in the index being updated are matched by their header and
+    # checksum, they do not need to be parsed or validated again and keep any edits
+    # made to their entry
+    if update_path is not None:
+        existing = load_ota_index(update_path)
+
+        for f, (metadata, validation_error) in results.items():
+            entry = existing.get(ota_index_key(metadata))
+
+            if entry is not None:
+                results[f] = entry, validation_error
+
+        # Images missing from the cache only have their header read and are hashed
+        pending = list(dict.fromkeys(f for f in files if f not in results))
+        keys = list(parallel_map(read_ota_index_key, pending, jobs=jobs))
+
+        for f, key in zip(pending, keys):
+            entry = existing.get(key)
+
+            if entry is None:
+                continue
+
+            LOGGER.info("Image %s is unchanged", f)
+            results[f] = entry, None
+
+            metadata = {k: v for k, v in entry.items() if k != "binary_url"}
+            cache.set(f, stats[f], metadata, None)
+
+        used = {ota_index_key(metadata) for metadata, _ in results.values()}
+
+        for key, entry in existing.items():
+            if key not in used:
+                LOGGER.info(
+                    "Dropping image with manufacturer_id=%s, image_type=%s,"
+                    " file_version=%s and checksum %s",
+                    *key,
+                )
+
+    # Parsing, validation and hashing are independent for every file
+    pending = list(dict.fromkeys(f for f in files if f not in results))
+    parsed = list(parallel_map(parse_ota_index_metadata, pending, jobs=jobs))
+
+    for f, result in zip(pending, parsed):
+        if result is None:
+            continue
+
+        results[f] = result
+
+        if cache is not None:
+            cache.set(f, stats[f], *result)
+
     ota_metadata = []
+    image_checksums = {}
 
     for f in files:
-        if not f.is_file():
+        if f not in results:
             continue
 
-        LOGGER.info("Parsing %s", f)
-        contents = f.read_bytes()
+        metadata, _ = results[f]
+        image_key = (
+            metadata["manufacturer_id"],
+            metadata["image_type"],
+            metadata["file_version"],
+        )
 
-        try:
-            image, rest = parse_ota_image(contents)
-        except Exception as e:
-            LOGGER.error("Failed to parse: %s", e)
-            continue
+        checksum = image_checksums.setdefault(image_key, metadata["checksum"])
 
-        if rest:
-            LOGGER.error("Image has trailing data: %r", rest)
-            continue
+        if checksum != metadata["checksum"]:
+            LOGGER.warning(
+                "Image %s has the same manufacturer_id=%s, image_type=%s and"
+                " file_version=%s as a different image",
+                f,
+                *image_key,
+            )
 
-        try:
-            validate_ota_image(image)
-        except Exception as e:
-            LOGGER.error("Image is invalid: %s", e)
+        LOGGER.info("Writing %s", f)
+
+        # Entries of the index being updated keep their URL, which may not be derived
+        # from the file name or `--ota-url-root`
+        if "binary_url" in metadata:
+            ota_metadata.append(metadata)
+            continue
 
         if ota_url_root is not None:
             url = f"{ota_url_root.rstrip('/')}/{f.name}"
         else:
             url = None
 
-        metadata = {
-            "binary_url": url,
-            "file_version": image.header.file_version,
-            "image_type": image.header.image_type,
-            "manufacturer_id": image.header.manufacturer_id,
-            "changelog": "",
-            "checksum": f"sha3-256:{hashlib.sha3_256(contents).hexdigest()}",
-        }
+        ota_metadata.append({"binary_url": url, **metadata})
 
-        if image.header.hardware_versions_present:
-            metadata["min_hardware_version"] = image.header.minimum_hardware_version
-            metadata["max_hardware_version"] = image.header.maximum_hardware_version
+    if cache is not None:
+        cache.close()
 
-        LOGGER.info("Writing %s", f)
-        ota_metadata.append(metadata)
+    if shard_dir is not None:
+        write_sharded_ota_index(
+            shard_dir, ota_metadata, compact=compact, compress=compress
+        )
+        return
 
-    json.dump(ota_metadata, output, indent=4)
-    output.write("\n")
+    data = serialize_ota_index(ota_metadata, compact=compact, compress=compress)
+
+    if update_path is not None:
+        write_file_atomic(update_path, data)
+    else:
+        output.write(data)
 
 
 @ota.command()
@@ -157,9 +1116,11 @@ def generate_index(ctx, ota_url_root, output, files):
     type=click.Path(file_okay=False, dir_okay=True, path_type=pathlib.Path),
     required=True,
 )
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=1)
+@click.option("--backend", type=click.Choice(["native", "tshark"]), default="native")
 @click.argument("files", nargs=-1, type=pathlib.Path)
 def reconstruct_from_pcaps(
-    ctx, network_keys, install_codes, fill_byte, output_root, files
+    ctx, network_keys, install_codes, fill_byte, output_root, jobs, backend, files
 ):
     for code in install_codes:
         print(f"Using key derived from install code: {code}")
@@ -175,71 +1136,42 @@ def reconstruct_from_pcaps(
         + list(install_codes)
     )
 
-    keys = "\n".join(
-        [f'"{k}","Normal","Network Key {i + 1}"' for i, k in enumerate(network_keys)]
-    )
-    packets = []
-
-    for f in files:
-        proc = subprocess.run(
+    if backend == "tshark":
+        keys = "\n".join(
             [
-                "tshark",
-                "-o",
-                f"uat:zigbee_pc_keys:{keys}",
-                "-r",
-                str(f),
-                "-T",
-                "json",
-            ],
-            capture_output=True,
+                f'"{k}","Normal","Network Key {i + 1}"'
+                for i, k in enumerate(network_keys)
+            ]
         )
 
-        obj = json.loads(proc.stdout)
-        packets.extend(p["_source"]["layers"] for p in obj)
+        # tshark does the heavy lifting in its own process, threads are enough to keep
+        # several of them busy
+        extract = functools.partial(extract_ota_images_tshark, keys=keys)
+        executor_cls = concurrent.futures.ThreadPoolExecutor
+    else:
+        extract = functools.partial(extract_ota_images_native, keys=network_keys)
+        executor_cls = concurrent.futures.ProcessPoolExecutor
 
     ota_sizes = {}
-    ota_chunks = collections.defaultdict(set)
+    ota_images = collections.defaultdict(OTAImageAssembler)
 
-    for packet in packets:
-        if "zbee_zcl" not in packet:
-            continue
+    # Results are merged in file order to stay deterministic
+    results = parallel_map(extract, files, jobs=jobs, executor_cls=executor_cls)
 
-        # Ignore non-OTA packets
-        if packet["zbee_aps"]["zbee_aps.cluster"] != "0x0019":
-            continue
-
-        if (
-            packet.get("zbee_zcl", {})
-            .get("Payload", {})
-            .get("zbee_zcl_general.ota.status")
-            == "0x00"
-        ):
-            zcl = packet["zbee_zcl"]["Payload"]
-            image_version = zcl["zbee_zcl_general.ota.file.version"]
-            image_type = zcl["zbee_zcl_general.ota.image.type"]
-            image_manuf_code = zcl["zbee_zcl_general.ota.manufacturer_code"]
-
-            image_key = (image_version, image_type, image_manuf_code)
-
-            if "zbee_zcl_general.ota.image.size" in zcl:
-                image_size = int(zcl["zbee_zcl_general.ota.image.size"])
-                ota_sizes[image_key] = image_size
-            elif "zbee_zcl_general.ota.image.data" in zcl:
-                offset = int(zcl["zbee_zcl_general.ota.file.offset"])
-                data = bytes.fromhex(
-                    zcl["zbee_zcl_general.ota.image.data"].replace(":", "")
-                )
+    for file_sizes, file_images in results:
+        ota_sizes.update(file_sizes)
 
-                ota_chunks[image_key].add((offset, data))
+        for image_key, assembler in file_images.items():
+            log_ota_conflicts(ota_images[image_key].merge(assembler))
 
     unknown_sizes = set()
 
-    for key in ota_chunks:
+    for key, assembler in ota_images.items():
         if key in ota_sizes:
             continue
 
         unknown_sizes.add(key)
-        ota_sizes[key] = max(offset + len(data) for offset, data in ota_chunks[key])
+        ota_sizes[key] = assembler.size
         LOGGER.error(
             "Image size for %s not captured, assuming size %s", key, ota_sizes[key]
         )
@@ -247,59 +1179,26 @@ def reconstruct_from_pcaps(
     for image_key, image_size in ota_sizes.items():
         image_version, image_type, image_manuf_code = image_key
         print(
-            f"Constructing image type={image_type}, version={image_version}"
-            f", manuf_code={image_manuf_code}: {image_size} bytes"
+            f"Constructing image type=0x{image_type:04x}, version=0x{image_version:08x}"
+            f", manuf_code=0x{image_manuf_code:04x}: {image_size} bytes"
         )
 
-        buffer = [None] * image_size
-
-        for offset, chunk in sorted(ota_chunks[image_key]):
-            current_value = buffer[offset : offset + len(chunk)]
-
-            if (
-                all(c is not None for c in buffer[offset : offset + len(chunk)])
-                and current_value != chunk
-            ):
-                LOGGER.error(
-                    f"Inconsistent {len(chunk)} bytes starting at offset"
-                    f" 0x{offset:08X}: was {current_value}, now {chunk}"
-                )
-
-            buffer[offset : offset + len(chunk)] = chunk
-
-        missing_indices = [o for o, v in enumerate(buffer) if v is None]
-        missing_ranges = []
-
-        # For readability, combine the list of missing indices into a list of ranges
-        if missing_indices:
-            start = missing_indices[0]
-            count = 0
-
-            for i in missing_indices[1:]:
-                if i == start + count + 1:
-                    count += 1
-                else:
-                    missing_ranges.append((start, count + 1))
-                    start = i
-                    count = 0
-
-            if count > 0:
-                missing_ranges.append((start, count + 1))
+        assembler = ota_images[image_key]
+        missing_ranges = assembler.missing_ranges(image_size)
 
         for start, count in missing_ranges:
             LOGGER.error(
                 f"Missing {count} bytes starting at offset 0x{start:08X}:"
                 f" filling with 0x{fill_byte:02X}"
             )
-            buffer[start : start + count] = [fill_byte] * count
 
         filename = output_root / (
-            f"ota_t{image_type}_m{image_manuf_code}_v{image_version}"
+            f"ota_t0x{image_type:04x}_m0x{image_manuf_code:04x}_v0x{image_version:08x}"
             f"{'_unk_size' if image_key in unknown_sizes else ''}"
             f"{'_partial' if missing_ranges else ''}.ota"
         )
 
         output_root.mkdir(exist_ok=True)
-        filename.write_bytes(bytes(buffer))
+        filename.write_bytes(assembler.assemble(image_size, fill_byte=fill_byte))
 
         info.callback([filename])
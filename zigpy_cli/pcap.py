@@ -1,18 +1,315 @@
 from __future__ import annotations
 
+import binascii
+import io
 import logging
+import struct
+import typing
 
 import click
-from scapy.config import conf as scapy_conf
-from scapy.layers.dot15d4 import Dot15d4  # NOQA: F401
-from scapy.utils import PcapReader, PcapWriter
 
 from zigpy_cli.cli import cli
 
-scapy_conf.dot15d4_protocol = "zigbee"
-
 LOGGER = logging.getLogger(__name__)
 
+LINKTYPE_IEEE802_15_4_WITHFCS = 195
+LINKTYPE_IEEE802_15_4_NOFCS = 230
+
+# Link types whose records can be copied without scapy, along with whether they end in
+# an FCS that needs to be recomputed
+RAW_LINKTYPES = {
+    LINKTYPE_IEEE802_15_4_WITHFCS: True,
+    LINKTYPE_IEEE802_15_4_NOFCS: False,
+}
+
+PCAP_MAGICS = {
+    b"\xa1\xb2\xc3\xd4": ">",
+    b"\xd4\xc3\xb2\xa1": "<",
+    # Nanosecond timestamps
+    b"\xa1\xb2\x3c\x4d": ">",
+    b"\x4d\x3c\xb2\xa1": "<",
+}
+
+PCAPNG_SECTION_HEADER_BLOCK = 0x0A0D0D0A
+PCAPNG_SECTION_HEADER_BLOCK_BYTES = b"\x0a\x0d\x0d\x0a"
+PCAPNG_INTERFACE_DESCRIPTION_BLOCK = 0x00000001
+PCAPNG_SIMPLE_PACKET_BLOCK = 0x00000003
+PCAPNG_ENHANCED_PACKET_BLOCK = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+FCS_CHUNK_SIZE = 4 * 1024 * 1024
+
+# CRC-16/KERMIT is the bit-reflected form of CRC-16/XMODEM, which `binascii` computes in
+# C. Reflecting every input byte and then the result turns one into the other.
+_REFLECTED_BYTES = bytes(int(f"{b:08b}"[::-1], 2) for b in range(256))
+
+
+def ieee802154_fcs(data: bytes) -> bytes:
+    """
+    Computes the IEEE 802.15.4 FCS (CRC-16/KERMIT) of a frame, in over-the-air order.
+    """
+
+    return reflected_fcs(data.translate(_REFLECTED_BYTES))
+
+
+def reflected_fcs(reflected_data: bytes | memoryview) -> bytes:
+    """
+    Computes the IEEE 802.15.4 FCS of a frame whose bytes have already been reflected.
+    """
+
+    crc = binascii.crc_hqx(reflected_data, 0)
+
+    # The reflected CRC is transmitted little endian, which is the same as the
+    # unreflected CRC with its bytes swapped and reflected
+    return bytes([_REFLECTED_BYTES[crc >> 8], _REFLECTED_BYTES[crc & 0xFF]])
+
+
+def fix_frame_fcs(
+    buffer: bytearray, reflected: memoryview, start: int, length: int
+) -> None:
+    """
+    Recomputes the FCS of the `length` byte frame at `start`, in place. `reflected` is
+    the bit-reflected copy of `buffer` that the CRC is computed over.
+    """
+
+    if length < 2:
+        return
+
+    end = start + length
+    buffer[end - 2 : end] = reflected_fcs(reflected[start : end - 2])
+
+
+def read_exactly(file: typing.BinaryIO, size: int) -> bytes:
+    data = file.read(size)
+
+    if len(data) != size:
+        raise click.ClickException(
+            f"Capture is truncated: expected {size} bytes, got {len(data)}"
+        )
+
+    return data
+
+
+class PrefixedReader(io.RawIOBase):
+    """
+    Reads from a stream as if already consumed bytes had not been read.
+    """
+
+    def __init__(self, prefix: bytes, file: typing.BinaryIO) -> None:
+        self._prefix = prefix
+        self._file = file
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self._prefix:
+            data = self._prefix[: len(buffer)]
+            self._prefix = self._prefix[len(data) :]
+        else:
+            data = self._file.read(len(buffer))
+
+        buffer[: len(data)] = data
+
+        return len(data)
+
+
+def fix_records_fcs(
+    fix_chunk: typing.Callable[[bytearray, memoryview], int],
+    input: typing.BinaryIO,
+    output: typing.BinaryIO,
+) -> None:
+    """
+    Streams `input` to `output` in large chunks. `fix_chunk` fixes every complete record
+    at the start of a chunk in place and returns the offset of the first incomplete one.
+    """
+
+    buffer = bytearray()
+
+    while True:
+        chunk = input.read(FCS_CHUNK_SIZE)
+        buffer += chunk
+
+        # Reflecting the whole chunk at once is much faster than per frame
+        offset = fix_chunk(buffer, memoryview(buffer.translate(_REFLECTED_BYTES)))
+        output.write(memoryview(buffer)[:offset])
+        del buffer[:offset]
+
+        if not chunk:
+            break
+
+    if buffer:
+        raise click.ClickException(
+            f"Capture is truncated: {len(buffer)} bytes of an incomplete record remain"
+        )
+
+
+def fix_pcap_fcs(
+    header: bytes, input: typing.BinaryIO, output: typing.BinaryIO, *, has_fcs: bool
+) -> None:
+    """
+    Copies pcap records from `input` to `output`, recomputing the FCS of every frame.
+    """
+
+    unpack_record_header = struct.Struct(f"{PCAP_MAGICS[header[:4]]}IIII").unpack_from
+    crc_hqx = binascii.crc_hqx
+
+    def fix_chunk(buffer: bytearray, reflected: memoryview) -> int:
+        size = len(buffer)
+        offset = 0
+
+        # This runs once per frame so the FCS computation is inlined
+        while offset + 16 <= size:
+            _, _, captured_length, original_length = unpack_record_header(
+                buffer, offset
+            )
+            start = offset + 16
+            end = start + captured_length
+
+            if end > size:
+                break
+
+            # Truncated frames cannot have their FCS recomputed
+            if has_fcs and captured_length == original_length and captured_length >= 2:
+                crc = crc_hqx(reflected[start : end - 2], 0)
+                buffer[end - 2] = _REFLECTED_BYTES[crc >> 8]
+                buffer[end - 1] = _REFLECTED_BYTES[crc & 0xFF]
+
+            offset = end
+
+        return offset
+
+    output.write(header)
+    fix_records_fcs(fix_chunk, input, output)
+
+
+def fix_pcapng_fcs(
+    magic: bytes, input: typing.BinaryIO, output: typing.BinaryIO
+) -> None:
+    """
+    Copies pcapng blocks from `input` to `output`, recomputing the FCS of every frame
+    captured on an interface with FCS.
+    """
+
+    endian = "<"
+    interfaces = []
+    warned_linktypes = set()
+
+    def fix_chunk(buffer: bytearray, reflected: memoryview) -> int:
+        nonlocal endian
+
+        offset = 0
+
+        while offset + 12 <= len(buffer):
+            # The section header block type reads the same in either byte order, which
+            # is only known after reading its byte order magic
+            if buffer[offset : offset + 4] == PCAPNG_SECTION_HEADER_BLOCK_BYTES:
+                block_type = PCAPNG_SECTION_HEADER_BLOCK
+                byte_order_magic = buffer[offset + 8 : offset + 12]
+
+                if byte_order_magic == PCAPNG_BYTE_ORDER_MAGIC.to_bytes(4, "little"):
+                    endian = "<"
+                elif byte_order_magic == PCAPNG_BYTE_ORDER_MAGIC.to_bytes(4, "big"):
+                    endian = ">"
+                else:
+                    raise click.ClickException(
+                        f"Invalid pcapng byte order magic: {byte_order_magic.hex()}"
+                    )
+
+                interfaces.clear()
+            else:
+                (block_type,) = struct.unpack_from(f"{endian}I", buffer, offset)
+
+            (length,) = struct.unpack_from(f"{endian}I", buffer, offset + 4)
+
+            # Blocks are padded to 32 bits and hold at least their type and two lengths
+            if length < 12 or length % 4 != 0:
+                raise click.ClickException(
+                    f"Invalid pcapng block length {length} for block type"
+                    f" {block_type:#010x}"
+                )
+
+            # The block is only complete once more data has been read
+            if offset + length > len(buffer):
+                break
+
+            (trailing_length,) = struct.unpack_from(
+                f"{endian}I", buffer, offset + length - 4
+            )
+
+            if trailing_length != length:
+                raise click.ClickException(
+                    f"Invalid pcapng block: lengths {length} and {trailing_length}"
+                    f" differ"
+                )
+
+            if block_type == PCAPNG_SECTION_HEADER_BLOCK:
+                pass
+            elif block_type == PCAPNG_INTERFACE_DESCRIPTION_BLOCK:
+                linktype, _, snaplen = struct.unpack_from(
+                    f"{endian}HHI", buffer, offset + 8
+                )
+                interfaces.append((linktype, snaplen))
+
+                if linktype not in RAW_LINKTYPES and linktype not in warned_linktypes:
+                    LOGGER.warning("Copying unsupported link type %d as-is", linktype)
+                    warned_linktypes.add(linktype)
+            elif block_type == PCAPNG_ENHANCED_PACKET_BLOCK:
+                interface, _, _, captured_length, original_length = struct.unpack_from(
+                    f"{endian}IIIII", buffer, offset + 8
+                )
+                if interface >= len(interfaces):
+                    raise click.ClickException(
+                        f"Packet references unknown pcapng interface {interface}"
+                    )
+
+                linktype, _ = interfaces[interface]
+
+                if (
+                    RAW_LINKTYPES.get(linktype, False)
+                    and captured_length == original_length
+                ):
+                    fix_frame_fcs(buffer, reflected, offset + 28, captured_length)
+            elif block_type == PCAPNG_SIMPLE_PACKET_BLOCK:
+                (original_length,) = struct.unpack_from(
+                    f"{endian}I", buffer, offset + 8
+                )
+                if not interfaces:
+                    raise click.ClickException(
+                        "Simple packet block precedes any pcapng interface"
+                    )
+
+                linktype, snaplen = interfaces[0]
+
+                if RAW_LINKTYPES.get(linktype, False) and (
+                    snaplen == 0 or original_length <= snaplen
+                ):
+                    fix_frame_fcs(buffer, reflected, offset + 12, original_length)
+
+            offset += length
+
+        return offset
+
+    fix_records_fcs(fix_chunk, PrefixedReader(magic, input), output)
+
+
+def fix_scapy_fcs(input: typing.BinaryIO, output: typing.BinaryIO) -> None:
+    # scapy is slow to import and only needed for unusual link types
+    from scapy.config import conf as scapy_conf
+    from scapy.layers.dot15d4 import Dot15d4  # NOQA: F401
+    from scapy.utils import PcapReader, PcapWriter
+
+    scapy_conf.dot15d4_protocol = "zigbee"
+
+    reader = PcapReader(input)
+    writer = PcapWriter(output)
+
+    for packet in reader:
+        packet.fcs = None
+        writer.write(packet)
+
+    writer.flush()
+
 
 @cli.group()
 def pcap():
@@ -23,9 +320,22 @@ def pcap():
 @click.argument("input", type=click.File("rb"))
 @click.argument("output", type=click.File("wb"))
 def fix_fcs(input, output):
-    reader = PcapReader(input.raw)
-    writer = PcapWriter(output.raw)
+    magic = input.read(4)
 
-    for packet in reader:
-        packet.fcs = None
-        writer.write(packet)
+    if int.from_bytes(magic, "little") == PCAPNG_SECTION_HEADER_BLOCK:
+        fix_pcapng_fcs(magic, input, output)
+        return
+
+    if magic in PCAP_MAGICS:
+        header = magic + read_exactly(input, 20)
+        (linktype,) = struct.unpack(f"{PCAP_MAGICS[magic]}I", header[20:24])
+
+        if linktype in RAW_LINKTYPES:
+            fix_pcap_fcs(header, input, output, has_fcs=RAW_LINKTYPES[linktype])
+            return
+    else:
+        header = magic
+
+    # Let scapy handle anything else
+    LOGGER.debug("Falling back to scapy")
+    fix_scapy_fcs(io.BufferedReader(PrefixedReader(header, input)), output)
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import contextlib
+import cProfile
+import dataclasses
+import json
+import logging
+import math
+import pathlib
+import pstats
+import sys
+import time
+import tracemalloc
+import typing
+
+LOGGER = logging.getLogger(__name__)
+
+T = typing.TypeVar("T")
+
+# Number of entries printed when profiling results are not written to a file
+PROFILE_TOP_ENTRIES = 30
+
+# Frames kept for every allocation traced by tracemalloc
+TRACEMALLOC_FRAMES = 25
+
+
+@dataclasses.dataclass
+class Span:
+    """
+    Wall clock time spent in one phase of a command, over every time it ran.
+    """
+
+    name: str
+    count: int = 0
+    total: float = 0.0
+    min: float = math.inf
+    max: float = 0.0
+
+    def add(self, duration: float) -> None:
+        self.count += 1
+        self.total += duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+
+    def as_dict(self) -> dict[str, typing.Any]:
+        return {
+            "name": self.name,
+            "count": self.count,
+            "total_s": round(self.total, 6),
+            "mean_ms": round(1000 * self.total / self.count, 3),
+            "min_ms": round(1000 * self.min, 3),
+            "max_ms": round(1000 * self.max, 3),
+        }
+
+
+# Spans by name, in the order they first ran. Nothing is recorded until tracing is
+# enabled, so spans cost next to nothing otherwise.
+SPANS: dict[str, Span] | None = None
+
+
+def enable_spans() -> dict[str, Span]:
+    global SPANS
+
+    SPANS = {}
+
+    return SPANS
+
+
+def record_span(name: str, duration: float) -> None:
+    if SPANS is None:
+        return
+
+    if name not in SPANS:
+        SPANS[name] = Span(name)
+
+    SPANS[name].add(duration)
+
+
+@contextlib.contextmanager
+def trace_span(name: str) -> typing.Iterator[None]:
+    """
+    Records the time spent in a block as a span. Spans with the same name are added
+    up, including ones that overlap in concurrent tasks.
+    """
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def trace_iter(name: str, iterable: typing.Iterable[T]) -> typing.Iterator[T]:
+    """
+    Records the time spent producing the items of an iterable as a single span, which
+    excludes the time spent by the consumer on each item.
+    """
+
+    if SPANS is None:
+        yield from iterable
+        return
+
+    iterator = iter(iterable)
+    elapsed = 0.0
+
+    try:
+        while True:
+            start = time.perf_counter()
+
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+
+            yield item
+    finally:
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+        record_span(name, elapsed)
+
+
+def print_spans(spans: typing.Iterable[Span], file: typing.TextIO) -> None:
+    print(
+        f"{'Span':<32} {'Calls':>8} {'Total (s)':>12} {'Mean (ms)':>12}"
+        f" {'Max (ms)':>12}",
+        file=file,
+    )
+
+    for span in spans:
+        print(
+            f"{span.name:<32} {span.count:>8} {span.total:>12.3f}"
+            f" {1000 * span.total / span.count:>12.3f} {1000 * span.max:>12.3f}",
+            file=file,
+        )
+
+
+def start_spans(output: pathlib.Path | None) -> typing.Callable[[], None]:
+    """
+    Starts recording spans, returning a function that stops and reports them.
+    """
+
+    spans = enable_spans()
+
+    def stop() -> None:
+        global SPANS
+
+        SPANS = None
+
+        if output is None:
+            print_spans(spans.values(), file=sys.stderr)
+        else:
+            output.write_text(
+                json.dumps(
+                    {"spans": [span.as_dict() for span in spans.values()]}, indent=4
+                )
+                + "\n"
+            )
+
+    return stop
+
+
+def start_profile(kind: str, output: pathlib.Path | None) -> typing.Callable[[], None]:
+    """
+    Starts profiling with cProfile or tracemalloc, returning a function that stops and
+    reports the results. Results are written to `output` in the profiler's own format
+    or summarized on stderr.
+    """
+
+    if kind == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def stop() -> None:
+            profiler.disable()
+
+            if output is not None:
+                profiler.dump_stats(output)
+                LOGGER.info("Wrote profile to %s", output)
+            else:
+                stats = pstats.Stats(profiler, stream=sys.stderr)
+                stats.sort_stats(pstats.SortKey.CUMULATIVE)
+                stats.print_stats(PROFILE_TOP_ENTRIES)
+
+    elif kind == "tracemalloc":
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+        def stop() -> None:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            # Allocations made by tracemalloc itself are not interesting
+            snapshot = snapshot.filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)]
+            )
+
+            if output is not None:
+                snapshot.dump(str(output))
+                LOGGER.info("Wrote memory snapshot to %s", output)
+                return
+
+            print(f"Current memory: {current / 1024:.1f} KiB", file=sys.stderr)
+            print(f"Peak memory:    {peak / 1024:.1f} KiB", file=sys.stderr)
+
+            for stat in snapshot.statistics("lineno")[:PROFILE_TOP_ENTRIES]:
+                print(stat, file=sys.stderr)
+
+    else:
+        raise ValueError(f"Unknown profiler: {kind!r}")
+
+    return stop
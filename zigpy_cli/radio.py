@@ -2,40 +2,78 @@ from __future__ import annotations
 
 import asyncio
 import collections
+import csv
+import datetime
+import enum
 import importlib
 import importlib.util
 import itertools
 import json
 import logging
+import math
+import shlex
+import sys
+import time
+import typing
 
 import click
+import zigpy.backups
+import zigpy.device
+import zigpy.exceptions
 import zigpy.state
 import zigpy.types
 import zigpy.zdo
 import zigpy.zdo.types
+from zigpy.zcl.clusters.general import Basic
 
 from zigpy_cli.cli import cli, click_coroutine
 from zigpy_cli.const import RADIO_LOGGING_CONFIGS, RADIO_TO_PACKAGE, RADIO_TO_PYPI
+from zigpy_cli.metrics import RadioMetrics, print_radio_metrics
+from zigpy_cli.profiling import trace_span
 
 LOGGER = logging.getLogger(__name__)
 
+# Key of the radio connection state in `click.Context.meta`, which is shared by every
+# command of a `batch`
+RADIO_STATE_META_KEY = "zigpy_cli.radio.state"
 
-@cli.group()
-@click.pass_context
-@click.argument("radio", type=click.Choice(list(RADIO_TO_PACKAGE.keys())))
-@click.argument("port", type=str)
-@click.option("--baudrate", type=int, default=None)
-@click.option("--database", type=str, default=None)
-@click_coroutine
-async def radio(ctx, radio, port, baudrate=None, database=None):
-    # Setup logging for the radio
-    verbose = ctx.parent.params["verbose"]
+# Key of the radio's `RadioMetrics` in `click.Context.meta`, when they are enabled
+RADIO_METRICS_META_KEY = "zigpy_cli.radio.metrics"
+
+
+# Routers and the coordinator have neighbor and routing tables worth scanning
+ROUTER_DEVICE_TYPES = {
+    zigpy.zdo.types.Neighbor.DeviceType.Coordinator,
+    zigpy.zdo.types.Neighbor.DeviceType.Router,
+}
+
+# Placeholder addresses reported for unknown neighbors
+INVALID_NEIGHBOR_IEEES = {
+    zigpy.types.EUI64.convert("00:00:00:00:00:00:00:00"),
+    zigpy.types.EUI64.convert("ff:ff:ff:ff:ff:ff:ff:ff"),
+}
+
+
+class RadioState(enum.Enum):
+    CONNECTED = "connected"
+    STARTED = "started"
+
+
+def setup_radio_logging(radio: str, verbose: int) -> None:
     logging_configs = RADIO_LOGGING_CONFIGS[radio]
     logging_config = logging_configs[min(verbose, len(logging_configs) - 1)]
 
     for logger, level in logging_config.items():
         logging.getLogger(logger).setLevel(level)
 
+
+def create_app(
+    radio: str, port: str, *, baudrate: int | None = None, database: str | None = None
+):
+    """
+    Creates the controller application of a radio, without connecting to it.
+    """
+
     module = RADIO_TO_PACKAGE[radio] + ".zigbee.application"
 
     # Catching just `ImportError` masks dependency errors and is annoying
@@ -48,11 +86,16 @@ async def radio(ctx, radio, port, baudrate=None, database=None):
     # Import the radio library
     radio_module = importlib.import_module(module)
 
-    # Start the radio
+    # Start the radio, the config is validated by the application
     app_cls = radio_module.ControllerApplication
-    config = app_cls.SCHEMA(
+    device_config = {"path": port}
+
+    if baudrate is not None:
+        device_config["baudrate"] = baudrate
+
+    return app_cls(
         {
-            "device": {"path": port},
+            "device": device_config,
             "backup_enabled": False,
             "startup_energy_scan": False,
             "database_path": database,
@@ -60,10 +103,32 @@ async def radio(ctx, radio, port, baudrate=None, database=None):
         }
     )
 
-    if baudrate is not None:
-        config["device"]["baudrate"] = baudrate
 
-    app = app_cls(config)
+@cli.group()
+@click.pass_context
+@click.argument("radio", type=click.Choice(list(RADIO_TO_PACKAGE.keys())))
+@click.argument("port", type=str)
+@click.option("--baudrate", type=int, default=None)
+@click.option("--database", type=str, default=None)
+@click.option(
+    "--metrics",
+    is_flag=True,
+    default=False,
+    help="Print statistics of the radio's traffic when the command finishes",
+)
+@click_coroutine
+async def radio(ctx, radio, port, baudrate=None, database=None, metrics=False):
+    # Setup logging for the radio
+    setup_radio_logging(radio, ctx.parent.params["verbose"])
+
+    app = create_app(radio, port, baudrate=baudrate, database=database)
+
+    if metrics:
+        radio_metrics = RadioMetrics()
+
+        ctx.meta[RADIO_METRICS_META_KEY] = radio_metrics
+        ctx.call_on_close(radio_metrics.instrument_app(app))
+        ctx.call_on_close(radio_metrics.install_serial_hook())
 
     ctx.obj = app
     ctx.call_on_close(radio_cleanup)
@@ -73,17 +138,60 @@ async def radio(ctx, radio, port, baudrate=None, database=None):
 @click_coroutine
 async def radio_cleanup(app):
     try:
-        await app.shutdown()
+        with trace_span("radio.shutdown"):
+            await app.shutdown()
     except RuntimeError:
         LOGGER.warning("Caught an exception when shutting down app", exc_info=True)
 
+    metrics = click.get_current_context().meta.get(RADIO_METRICS_META_KEY)
+
+    # Printed to stderr, commands like `backup` may write to stdout
+    if metrics is not None:
+        print_radio_metrics(metrics, file=sys.stderr)
+
+
+async def connect_app(app) -> None:
+    """
+    Connects to the radio, unless an earlier command of the session already has.
+    """
+
+    meta = click.get_current_context().meta
+
+    if meta.get(RADIO_STATE_META_KEY) is None:
+        with trace_span("radio.connect"):
+            await app.connect()
+
+        meta[RADIO_STATE_META_KEY] = RadioState.CONNECTED
+
+
+async def startup_app(app, *, auto_form: bool = False) -> None:
+    """
+    Starts the network, unless an earlier command of the session already has.
+    """
+
+    meta = click.get_current_context().meta
+    state = meta.get(RADIO_STATE_META_KEY)
+
+    if state is RadioState.STARTED:
+        return
+    elif state is RadioState.CONNECTED:
+        with trace_span("radio.initialize"):
+            await app.initialize(auto_form=auto_form)
+    else:
+        with trace_span("radio.startup"):
+            await app.startup(auto_form=auto_form)
+
+    meta[RADIO_STATE_META_KEY] = RadioState.STARTED
+
 
 @radio.command()
 @click.pass_obj
 @click_coroutine
 async def info(app):
-    await app.connect()
-    await app.load_network_info(load_devices=False)
+    await connect_app(app)
+
+    with trace_span("radio.load_network_info"):
+        await app.load_network_info(load_devices=False)
 
     print(f"PAN ID:                0x{app.state.network_info.pan_id:04X}")
     print(f"Extended PAN ID:       {app.state.network_info.extended_pan_id}")
@@ -97,6 +205,13 @@ async def info(app):
     print(f"Network key counter:   {app.state.network_info.network_key.tx_counter}")
 
 
+def backup_to_json(backup: zigpy.backups.NetworkBackup, *, zigpy_format: bool) -> dict:
+    if zigpy_format:
+        return backup.as_dict()
+    else:
+        return backup.as_open_coordinator_json()
+
+
 @radio.command()
 @click.option("-z", "--zigpy-format", is_flag=True, type=bool, default=False)
 @click.option(
@@ -114,21 +229,19 @@ async def backup(
     i_understand_i_can_update_eui64_only_once_and_i_still_want_to_do_it,
     output,
 ):
-    await app.connect()
+    await connect_app(app)
 
-    backup = await app.backups.create_backup(load_devices=True)
+    with trace_span("radio.create_backup"):
+        backup = await app.backups.create_backup(load_devices=True)
 
     if i_understand_i_can_update_eui64_only_once_and_i_still_want_to_do_it:
         backup.network_info.stack_specific.setdefault("ezsp", {})[
             "i_understand_i_can_update_eui64_only_once_and_i_still_want_to_do_it"
         ] = True
 
-    if zigpy_format:
-        obj = backup.as_dict()
-    else:
-        obj = backup.as_open_coordinator_json()
-
-    output.write(json.dumps(obj, indent=4) + "\n")
+    output.write(
+        json.dumps(backup_to_json(backup, zigpy_format=zigpy_format), indent=4) + "\n"
+    )
 
 
 @radio.command()
@@ -140,15 +253,19 @@ async def restore(app, frame_counter_increment, input):
     obj = json.load(input)
     backup = zigpy.backups.NetworkBackup.from_dict(obj)
 
-    await app.connect()
-    await app.backups.restore_backup(backup, counter_increment=frame_counter_increment)
+    await connect_app(app)
+
+    with trace_span("radio.restore_backup"):
+        await app.backups.restore_backup(
+            backup, counter_increment=frame_counter_increment
+        )
 
 
 @radio.command()
 @click.pass_obj
 @click_coroutine
 async def form(app):
-    await app.connect()
+    await connect_app(app)
     await app.form_network()
 
 
@@ -156,7 +273,7 @@ async def form(app):
 @click.pass_obj
 @click_coroutine
 async def reset(app):
-    await app.connect()
+    await connect_app(app)
     await app.reset_network_info()
 
 
@@ -165,66 +282,214 @@ async def reset(app):
 @click.option("-t", "--join-time", type=int, default=250)
 @click_coroutine
 async def permit(app, join_time):
-    await app.startup(auto_form=True)
+    await startup_app(app, auto_form=True)
     await app.permit(join_time)
     await asyncio.sleep(join_time)
 
 
+class ChannelEnergyStats:
+    """
+    Running statistics of the energy measured on a channel. Energies are between 0 and
+    255, so a histogram gives exact percentiles in constant memory.
+    """
+
+    def __init__(self, window: int) -> None:
+        self.histogram = [0] * 256
+        self.count = 0
+        self.total = 0.0
+        self.min: float | None = None
+        self.max: float | None = None
+        self.recent: collections.deque[float] = collections.deque(maxlen=window)
+
+    def add(self, energy: float) -> None:
+        self.histogram[min(max(round(energy), 0), 255)] += 1
+        self.count += 1
+        self.total += energy
+        self.min = energy if self.min is None else min(self.min, energy)
+        self.max = energy if self.max is None else max(self.max, energy)
+        self.recent.append(energy)
+
+    def percentile(self, p: float) -> int:
+        """
+        Computes a nearest-rank percentile of all energies, rounded to integers.
+        """
+
+        rank = max(1, math.ceil(p / 100 * self.count))
+
+        for energy, total in enumerate(itertools.accumulate(self.histogram)):
+            if total >= rank:
+                return energy
+
+        raise ValueError("No energies have been added")
+
+    @property
+    def window_mean(self) -> float:
+        return sum(self.recent) / len(self.recent)
+
+    def as_dict(self) -> dict[str, float]:
+        return {
+            "energy": self.recent[-1],
+            "window_mean": round(self.window_mean, 2),
+            "min": self.min,
+            "mean": round(self.total / self.count, 2),
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+ENERGY_SCAN_CSV_FIELDS = [
+    "time",
+    "scan",
+    "channel",
+    "energy",
+    "window_mean",
+    "min",
+    "mean",
+    "max",
+    "p50",
+    "p95",
+    "p99",
+]
+
+
+def parse_channels(ctx, param, value: str | None) -> zigpy.types.Channels:
+    """
+    Parses a list of channels and channel ranges, like `11,15,20-25`.
+    """
+
+    if value is None:
+        return zigpy.types.Channels.ALL_CHANNELS
+
+    channels = []
+
+    try:
+        for part in value.split(","):
+            first, _, last = part.partition("-")
+            channels.extend(range(int(first), int(last or first) + 1))
+
+        return zigpy.types.Channels.from_channel_list(channels)
+    except ValueError as e:
+        raise click.BadParameter(f"{value!r} is not a valid channel list: {e}")
+
+
+def print_energy_scan_text(
+    output: typing.TextIO,
+    channel_stats: dict[int, ChannelEnergyStats],
+    current_channel: int,
+) -> None:
+    window = next(iter(channel_stats.values())).recent
+
+    print(f"Channel energy (mean of {len(window)} / {window.maxlen}):", file=output)
+    print("------------------------------------------------", file=output)
+    print(" ! Different radios compute channel energy differently", file=output)
+    print(file=output)
+    print(" + Lower energy is better", file=output)
+    print(
+        " + Active Zigbee networks on a channel may still cause congestion", file=output
+    )
+    print(
+        " + TX on 26 in North America may be with lower power due to regulations",
+        file=output,
+    )
+    print(
+        " + Zigbee channels 15, 20, 25 fall between WiFi channels 1, 6, 11", file=output
+    )
+    print(
+        " + Some Zigbee devices only join networks on channels 15, 20, and 25",
+        file=output,
+    )
+    print(" + Current channel is enclosed in [square brackets]", file=output)
+    print("------------------------------------------------", file=output)
+
+    for channel, stats in channel_stats.items():
+        fraction = stats.window_mean / 0xFF
+        asterisk = "*" if channel == 26 else " "
+
+        if channel == current_channel:
+            bracket_open = "["
+            bracket_close = "]"
+        else:
+            bracket_open = " "
+            bracket_close = " "
+
+        print(
+            f" - {bracket_open}{channel:>02}{asterisk}{bracket_close}"
+            + f"   {fraction:>7.2%}  "
+            + "#" * int(100 * fraction),
+            file=output,
+        )
+
+    print(file=output)
+
+
 @radio.command()
 @click.pass_obj
 @click.option("-n", "--num-scans", type=int, default=-1)
+@click.option("-e", "--duration-exp", type=click.IntRange(min=0, max=14), default=2)
+@click.option("-C", "--channels", callback=parse_channels, default=None)
+@click.option("-w", "--window", type=click.IntRange(min=1), default=5)
+@click.option(
+    "-f",
+    "--format",
+    "output_format",
+    type=click.Choice(["text", "jsonl", "csv"]),
+    default="text",
+)
+@click.option("-o", "--output", type=click.File("w"), default="-")
 @click_coroutine
-async def energy_scan(app, num_scans):
-    await app.startup()
+async def energy_scan(
+    app, num_scans, duration_exp, channels, window, output_format, output
+):
+    await startup_app(app)
     LOGGER.info("Running scan...")
 
-    # We compute an average over the last 5 scans
-    channel_energies = collections.defaultdict(lambda: collections.deque([], maxlen=5))
+    # Statistics are kept per channel in constant memory, however long the scan runs
+    channel_stats = collections.defaultdict(lambda: ChannelEnergyStats(window))
+    current_channel = app.state.network_info.channel
+
+    if output_format == "csv":
+        writer = csv.DictWriter(output, fieldnames=ENERGY_SCAN_CSV_FIELDS)
+        writer.writeheader()
 
     for scan in itertools.count():
         if num_scans != -1 and scan > num_scans:
             break
 
         results = await app.energy_scan(
-            channels=zigpy.types.Channels.ALL_CHANNELS, duration_exp=2, count=1
+            channels=channels, duration_exp=duration_exp, count=1
         )
+        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
 
         for channel, energy in results.items():
-            energies = channel_energies[channel]
-            energies.append(energy)
-
-        total = 0xFF * len(energies)
-
-        print(f"Channel energy (mean of {len(energies)} / {energies.maxlen}):")
-        print("------------------------------------------------")
-        print(" ! Different radios compute channel energy differently")
-        print()
-        print(" + Lower energy is better")
-        print(" + Active Zigbee networks on a channel may still cause congestion")
-        print(" + TX on 26 in North America may be with lower power due to regulations")
-        print(" + Zigbee channels 15, 20, 25 fall between WiFi channels 1, 6, 11")
-        print(" + Some Zigbee devices only join networks on channels 15, 20, and 25")
-        print(" + Current channel is enclosed in [square brackets]")
-        print("------------------------------------------------")
-
-        for channel, energies in channel_energies.items():
-            count = sum(energies)
-            asterisk = "*" if channel == 26 else " "
-
-            if channel == app.state.network_info.channel:
-                bracket_open = "["
-                bracket_close = "]"
-            else:
-                bracket_open = " "
-                bracket_close = " "
-
-            print(
-                f" - {bracket_open}{channel:>02}{asterisk}{bracket_close}"
-                + f"   {count / total:>7.2%}  "
-                + "#" * int(100 * count / total)
-            )
-
-        print()
+            channel_stats[channel].add(energy)
+
+        if output_format == "text":
+            print_energy_scan_text(output, channel_stats, current_channel)
+        elif output_format == "jsonl":
+            record = {
+                "time": timestamp,
+                "scan": scan,
+                "current_channel": current_channel,
+                "channels": {
+                    str(channel): stats.as_dict()
+                    for channel, stats in channel_stats.items()
+                },
+            }
+            output.write(json.dumps(record) + "\n")
+        else:
+            for channel, stats in channel_stats.items():
+                writer.writerow(
+                    {
+                        "time": timestamp,
+                        "scan": scan,
+                        "channel": channel,
+                        **stats.as_dict(),
+                    }
+                )
+
+        output.flush()
 
 
 @radio.command()
@@ -232,8 +497,426 @@ async def energy_scan(app, num_scans):
 @click.option("-c", "--channel", type=int)
 @click_coroutine
 async def change_channel(app, channel):
-    await app.startup()
+    await startup_app(app)
 
     LOGGER.info("Current channel is %s", app.state.network_info.channel)
 
     await app.move_network_to_channel(channel)
+
+
+class TableScanError(Exception):
+    pass
+
+
+async def scan_table(
+    request,
+    entries_attr: str,
+    *,
+    semaphore: asyncio.Semaphore,
+    timeout: float,
+    retries: int,
+) -> list:
+    """
+    Reads a neighbor or routing table one page at a time. Each page is retried on its
+    own, with at most one request in flight per `semaphore` slot.
+    """
+
+    table: list = []
+
+    while True:
+        for attempt in range(retries + 1):
+            try:
+                async with semaphore:
+                    # zigpy's own timeout is much longer for devices without a node
+                    # descriptor, which is every device discovered by the scan
+                    status, rsp = await asyncio.wait_for(
+                        request(len(table), retries=0), timeout
+                    )
+            except asyncio.TimeoutError as e:
+                if attempt == retries:
+                    raise TableScanError(f"No response after {attempt + 1} attempts")
+
+                LOGGER.debug("Retrying request (attempt %d): %r", attempt + 1, e)
+            except (zigpy.exceptions.ZigbeeException, ValueError) as e:
+                # Send failures and responses that cannot be parsed only fail the
+                # table of this device, not the whole scan
+                if attempt == retries:
+                    raise TableScanError(f"Request failed: {e!r}") from e
+
+                LOGGER.debug("Retrying request (attempt %d): %r", attempt + 1, e)
+            else:
+                break
+
+        if status != zigpy.zdo.types.Status.SUCCESS:
+            raise TableScanError(f"Request failed: {status!r}")
+
+        entries = getattr(rsp, entries_attr)
+        table.extend(entries)
+
+        if not entries or len(table) >= rsp.Entries:
+            return table
+
+
+def neighbor_to_json(neighbor: zigpy.zdo.types.Neighbor) -> dict:
+    return {
+        "ieee": str(neighbor.ieee),
+        "nwk": f"0x{neighbor.nwk:04X}",
+        "device_type": neighbor.device_type.name,
+        "rx_on_when_idle": neighbor.rx_on_when_idle.name,
+        "relationship": neighbor.relationship.name,
+        "permit_joining": neighbor.permit_joining.name,
+        "depth": neighbor.depth,
+        "lqi": neighbor.lqi,
+    }
+
+
+def route_to_json(route: zigpy.zdo.types.Route) -> dict:
+    return {
+        "destination": f"0x{route.DstNWK:04X}",
+        "status": route.RouteStatus.name,
+        "next_hop": f"0x{route.NextHop:04X}",
+        "many_to_one": bool(route.ManyToOne),
+        "memory_constrained": bool(route.MemoryConstrained),
+        "route_record_required": bool(route.RouteRecordRequired),
+    }
+
+
+async def scan_device_topology(
+    device, **kwargs
+) -> tuple[dict, list[zigpy.zdo.types.Neighbor]]:
+    """
+    Scans the neighbor and routing tables of a router, returning a JSON record of both
+    along with its neighbors.
+    """
+
+    record: dict = {
+        "ieee": str(device.ieee),
+        "nwk": f"0x{device.nwk:04X}",
+        "neighbors": None,
+        "routes": None,
+        "errors": {},
+    }
+    neighbors: list[zigpy.zdo.types.Neighbor] = []
+
+    try:
+        neighbors = await scan_table(
+            device.zdo.Mgmt_Lqi_req, "NeighborTableList", **kwargs
+        )
+    except TableScanError as e:
+        record["errors"]["neighbors"] = str(e)
+    else:
+        neighbors = [n for n in neighbors if n.ieee not in INVALID_NEIGHBOR_IEEES]
+        record["neighbors"] = [neighbor_to_json(n) for n in neighbors]
+
+    try:
+        routes = await scan_table(device.zdo.Mgmt_Rtg_req, "RoutingTableList", **kwargs)
+    except TableScanError as e:
+        record["errors"]["routes"] = str(e)
+    else:
+        record["routes"] = [route_to_json(r) for r in routes]
+
+    return record, neighbors
+
+
+@radio.command()
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), default=4)
+@click.option("-t", "--timeout", type=click.FloatRange(min=0), default=10.0)
+@click.option("-r", "--retries", type=click.IntRange(min=0), default=2)
+@click.argument("output", type=click.File("w"), default="-")
+@click.pass_obj
+@click_coroutine
+async def topology(app, concurrency, timeout, retries, output):
+    await startup_app(app)
+
+    scan_kwargs = {
+        "semaphore": asyncio.Semaphore(concurrency),
+        "timeout": timeout,
+        "retries": retries,
+    }
+
+    scanned = set()
+    tasks = set()
+
+    # Routers missing from the database are scanned through devices zigpy does not
+    # know about, so that they are neither interviewed nor stored. Their responses
+    # are delivered to them directly.
+    unknown_devices: dict[zigpy.types.NWK, zigpy.device.Device] = {}
+    packet_received = app.packet_received
+
+    def unknown_packet_received(packet: zigpy.types.ZigbeePacket) -> None:
+        device = None
+
+        if packet.src.addr_mode == zigpy.types.AddrMode.NWK and packet.dst_ep == 0:
+            device = unknown_devices.get(packet.src.address)
+
+        if device is not None:
+            device.packet_received(packet)
+        else:
+            packet_received(packet)
+
+    def scan(ieee: zigpy.types.EUI64, nwk: zigpy.types.NWK) -> None:
+        if ieee in scanned:
+            return
+
+        scanned.add(ieee)
+
+        try:
+            device = app.get_device(ieee=ieee)
+        except KeyError:
+            try:
+                device = app.get_device(nwk=nwk)
+            except KeyError:
+                device = zigpy.device.Device(app, ieee, nwk)
+                unknown_devices[nwk] = device
+
+        tasks.add(asyncio.create_task(scan_device_topology(device, **scan_kwargs)))
+
+    scan(app.state.node_info.ieee, app.state.node_info.nwk)
+
+    # Routers already in the database are scanned even if no neighbor reports them
+    for device in list(app.devices.values()):
+        if device.node_desc is not None and device.node_desc.is_router:
+            scan(device.ieee, device.nwk)
+
+    failed = 0
+    app.packet_received = unknown_packet_received
+
+    try:
+        # Routers are scanned as soon as they are discovered and every result is
+        # written immediately, so an interrupted scan keeps everything found so far
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                record, neighbors = task.result()
+                failed += bool(record["errors"])
+
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+
+                for neighbor in neighbors:
+                    if neighbor.device_type in ROUTER_DEVICE_TYPES:
+                        scan(neighbor.ieee, neighbor.nwk)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        app.packet_received = packet_received
+
+    LOGGER.info("Scanned %d routers, %d did not fully respond", len(scanned), failed)
+
+
+def summarize_latencies(
+    latencies: list[float], *, errors: int, elapsed: float
+) -> dict[str, typing.Any]:
+    """
+    Summarizes request latencies in milliseconds, with nearest-rank percentiles.
+    """
+
+    latencies = sorted(latencies)
+
+    def percentile(p: float) -> float | None:
+        if not latencies:
+            return None
+
+        index = max(0, math.ceil(p / 100 * len(latencies)) - 1)
+
+        return round(1000 * latencies[index], 3)
+
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "min_ms": percentile(0),
+        "mean_ms": (
+            round(1000 * sum(latencies) / len(latencies), 3) if latencies else None
+        ),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": percentile(100),
+        "requests_per_second": round(len(latencies) / elapsed, 3) if elapsed else None,
+    }
+
+
+async def benchmark_requests(
+    send: typing.Callable[[int], typing.Awaitable[bool]],
+    count: int,
+    *,
+    concurrency: int,
+    timeout: float,
+) -> dict[str, typing.Any]:
+    """
+    Sends `count` requests with up to `concurrency` in flight and summarizes them.
+    `send` is given the request number and returns whether the request succeeded.
+    """
+
+    latencies = []
+    errors = 0
+    request_numbers = iter(range(count))
+
+    async def worker() -> None:
+        nonlocal errors
+
+        # Workers share the iterator, so exactly `count` requests are sent
+        for number in request_numbers:
+            start = time.perf_counter()
+
+            try:
+                success = await asyncio.wait_for(send(number), timeout)
+            except (asyncio.TimeoutError, zigpy.exceptions.ZigbeeException) as e:
+                LOGGER.debug("Request %d failed: %r", number, e)
+                success = False
+
+            if success:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return summarize_latencies(latencies, errors=errors, elapsed=elapsed)
+
+
+async def read_network_info(app) -> bool:
+    # zigpy has no single-frame command common to every radio library, but every one
+    # reads the network settings from the radio itself. Device tables are not read.
+    await app.load_network_info(load_devices=False)
+
+    return True
+
+
+async def send_zdo_request(device) -> bool:
+    status, _, _ = await device.zdo.Node_Desc_req(device.nwk, retries=0)
+
+    return status == zigpy.zdo.types.Status.SUCCESS
+
+
+async def send_zcl_request(device) -> bool:
+    for endpoint_id, endpoint in device.endpoints.items():
+        if endpoint_id != 0 and Basic.cluster_id in endpoint.in_clusters:
+            break
+    else:
+        raise click.ClickException(f"Device {device.ieee} has no Basic cluster")
+
+    success, _ = await endpoint.in_clusters[Basic.cluster_id].read_attributes(
+        ["zcl_version"], allow_cache=False
+    )
+
+    return "zcl_version" in success
+
+
+@radio.command()
+@click.option("-n", "--requests", type=click.IntRange(min=1), default=100)
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), default=8)
+@click.option("-t", "--timeout", type=click.FloatRange(min=0), default=10.0)
+@click.option(
+    "-d", "--device", "devices", type=zigpy.types.EUI64.convert, multiple=True
+)
+@click.option(
+    "--request", "request_type", type=click.Choice(["zdo", "zcl"]), default="zdo"
+)
+@click.argument("output", type=click.File("w"), default="-")
+@click.pass_obj
+@click_coroutine
+async def benchmark(app, requests, concurrency, timeout, devices, request_type, output):
+    """
+    Measures request latencies and throughput, written to OUTPUT as JSON.
+
+    `network_info_read` is the time taken to read the network settings from the radio,
+    which is one or several serial commands depending on the radio library and cannot
+    be compared between radio types. `unicast` and `throughput` are requests sent to
+    devices.
+    """
+
+    await startup_app(app)
+
+    report = {
+        "network_info_read": await benchmark_requests(
+            lambda _: read_network_info(app),
+            requests,
+            concurrency=1,
+            timeout=timeout,
+        )
+    }
+
+    if devices:
+        try:
+            targets = [app.get_device(ieee=ieee) for ieee in devices]
+        except KeyError as e:
+            raise click.ClickException(f"Unknown device: {e}")
+    else:
+        targets = [
+            device
+            for device in app.devices.values()
+            if device.nwk != app.state.node_info.nwk
+            and device.node_desc is not None
+            and device.node_desc.is_router
+        ]
+
+    if not targets:
+        LOGGER.warning("There are no devices to send requests to")
+    else:
+        send_request = send_zdo_request if request_type == "zdo" else send_zcl_request
+
+        report["unicast"] = {}
+
+        for device in targets:
+            LOGGER.info("Measuring the latency of %s", device)
+            report["unicast"][str(device.ieee)] = await benchmark_requests(
+                lambda _, device=device: send_request(device),
+                requests,
+                concurrency=1,
+                timeout=timeout,
+            )
+
+        LOGGER.info("Measuring throughput with %d concurrent requests", concurrency)
+        report["throughput"] = {
+            "concurrency": concurrency,
+            **await benchmark_requests(
+                lambda number: send_request(targets[number % len(targets)]),
+                requests,
+                concurrency=concurrency,
+                timeout=timeout,
+            ),
+        }
+
+    output.write(json.dumps(report, indent=4) + "\n")
+
+
+@radio.command()
+@click.argument("script", type=click.File("r"))
+@click.pass_context
+def batch(ctx, script):
+    """
+    Runs the radio commands in SCRIPT, one per line, over a single connection.
+    """
+
+    commands = []
+
+    # Every line is parsed before anything runs, so mistakes are caught early
+    for line_number, line in enumerate(script, start=1):
+        args = shlex.split(line, comments=True)
+
+        if not args:
+            continue
+
+        name, *args = args
+        command = radio.get_command(ctx, name)
+
+        if command is None or command is batch:
+            raise click.UsageError(
+                f"Line {line_number}: {name!r} is not a radio command", ctx=ctx
+            )
+
+        commands.append(
+            (line_number, command, command.make_context(name, args, parent=ctx.parent))
+        )
+
+    for line_number, command, sub_ctx in commands:
+        LOGGER.info("Running line %d: %s", line_number, sub_ctx.command_path)
+
+        with sub_ctx:
+            command.invoke(sub_ctx)
@@ -0,0 +1,482 @@
+"""
+A simulated radio with a synthetic network, for testing and benchmarking commands
+without hardware. Its settings are passed as the query string of the port, e.g.
+`sim://?devices=100&latency=0.005&seed=1`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import logging
+import random
+import urllib.parse
+
+import zigpy.application
+import zigpy.config
+import zigpy.endpoint
+import zigpy.exceptions
+import zigpy.state
+import zigpy.types as t
+import zigpy.zcl.foundation as foundation
+import zigpy.zdo.types as zdo_t
+from zigpy.zcl.clusters.general import Basic
+
+LOGGER = logging.getLogger(__name__)
+
+COORDINATOR_NWK = t.NWK(0x0000)
+
+# Tables are sent a few entries at a time, like real devices do
+TABLE_PAGE_SIZE = 3
+
+
+@dataclasses.dataclass
+class SimSettings:
+    # Number of devices in the synthetic network, besides the coordinator
+    devices: int = 10
+    # Delay of every serial command and of every response from a device, in seconds
+    latency: float = 0.0
+    # Seed of the synthetic network
+    seed: int = 0
+
+    @classmethod
+    def from_path(cls, path: str) -> SimSettings:
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        settings = cls()
+
+        for field in dataclasses.fields(cls):
+            if field.name in query:
+                setattr(
+                    settings, field.name, type(field.default)(query[field.name][-1])
+                )
+
+        return settings
+
+
+@dataclasses.dataclass
+class SimDevice:
+    ieee: t.EUI64
+    nwk: t.NWK
+    logical_type: zdo_t.LogicalType
+    parent: SimDevice | None = None
+    children: list[SimDevice] = dataclasses.field(default_factory=list)
+
+    @property
+    def is_router(self) -> bool:
+        return self.logical_type != zdo_t.LogicalType.EndDevice
+
+    def neighbors(self) -> list[zdo_t.Neighbor]:
+        neighbors = []
+
+        for relationship, neighbor in [
+            (zdo_t.Neighbor.Relationship.Parent, self.parent),
+            *((zdo_t.Neighbor.Relationship.Child, c) for c in self.children),
+        ]:
+            if neighbor is None:
+                continue
+
+            neighbors.append(
+                zdo_t.Neighbor(
+                    extended_pan_id=t.ExtendedPanId.convert("00:00:00:00:00:00:00:01"),
+                    ieee=neighbor.ieee,
+                    nwk=neighbor.nwk,
+                    device_type=zdo_t.Neighbor.DeviceType(neighbor.logical_type),
+                    rx_on_when_idle=(
+                        zdo_t.Neighbor.RxOnWhenIdle.On
+                        if neighbor.is_router
+                        else zdo_t.Neighbor.RxOnWhenIdle.Off
+                    ),
+                    relationship=relationship,
+                    reserved1=0,
+                    permit_joining=zdo_t.Neighbor.PermitJoins.NotAccepting,
+                    reserved2=0,
+                    depth=0,
+                    lqi=200,
+                )
+            )
+
+        return neighbors
+
+    def routes(self) -> list[zdo_t.Route]:
+        routes = []
+
+        for child in self.children:
+            descendants = [child]
+
+            while descendants:
+                descendant = descendants.pop()
+                descendants.extend(descendant.children)
+
+                routes.append(
+                    zdo_t.Route(
+                        DstNWK=descendant.nwk,
+                        RouteStatus=zdo_t.RouteStatus.Active,
+                        MemoryConstrained=0,
+                        ManyToOne=0,
+                        RouteRecordRequired=0,
+                        Reserved=0,
+                        NextHop=child.nwk,
+                    )
+                )
+
+        return routes
+
+    def node_descriptor(self) -> zdo_t.NodeDescriptor:
+        flags = zdo_t.NodeDescriptor.MACCapabilityFlags.AllocateAddress
+
+        if self.is_router:
+            flags |= (
+                zdo_t.NodeDescriptor.MACCapabilityFlags.FullFunctionDevice
+                | zdo_t.NodeDescriptor.MACCapabilityFlags.MainsPowered
+                | zdo_t.NodeDescriptor.MACCapabilityFlags.RxOnWhenIdle
+            )
+
+        return zdo_t.NodeDescriptor(
+            logical_type=self.logical_type,
+            complex_descriptor_available=0,
+            user_descriptor_available=0,
+            reserved=0,
+            aps_flags=0,
+            frequency_band=zdo_t.NodeDescriptor.FrequencyBand.Freq2400MHz,
+            mac_capability_flags=flags,
+            manufacturer_code=0x1234,
+            maximum_buffer_size=82,
+            maximum_incoming_transfer_size=82,
+            server_mask=0,
+            maximum_outgoing_transfer_size=82,
+            descriptor_capability_field=zdo_t.NodeDescriptor.DescriptorCapability.NONE,
+        )
+
+
+def build_network(coordinator_ieee: t.EUI64, settings: SimSettings) -> list[SimDevice]:
+    """
+    Builds a random tree of routers and end devices rooted at the coordinator.
+    """
+
+    rng = random.Random(settings.seed)
+    coordinator = SimDevice(
+        ieee=coordinator_ieee,
+        nwk=COORDINATOR_NWK,
+        logical_type=zdo_t.LogicalType.Coordinator,
+    )
+    devices = [coordinator]
+    routers = [coordinator]
+    nwks = {COORDINATOR_NWK}
+
+    for index in range(settings.devices):
+        nwk = COORDINATOR_NWK
+
+        while nwk in nwks:
+            nwk = t.NWK(rng.randint(0x0001, 0xFFF7))
+
+        nwks.add(nwk)
+
+        # Most mains powered devices are routers
+        if rng.random() < 0.6:
+            logical_type = zdo_t.LogicalType.Router
+        else:
+            logical_type = zdo_t.LogicalType.EndDevice
+
+        parent = rng.choice(routers)
+        device = SimDevice(
+            ieee=t.EUI64.convert(
+                "00:00:00:ff:fe:"
+                + ":".join(f"{b:02x}" for b in index.to_bytes(3, "big"))
+            ),
+            nwk=nwk,
+            logical_type=logical_type,
+            parent=parent,
+        )
+        parent.children.append(device)
+        devices.append(device)
+
+        if device.is_router:
+            routers.append(device)
+
+    return devices
+
+
+class ControllerApplication(zigpy.application.ControllerApplication):
+    def __init__(self, config: dict) -> None:
+        super().__init__(config)
+
+        self._settings = SimSettings.from_path(
+            self.config[zigpy.config.CONF_DEVICE][zigpy.config.CONF_DEVICE_PATH]
+        )
+        self._connected = False
+        self._formed = True
+        self._aps_counter = 0
+
+        # The simulated radio's own copy of the network settings
+        rng = random.Random(self._settings.seed)
+        self._rng = rng
+        self._node_info = zigpy.state.NodeInfo(
+            nwk=COORDINATOR_NWK,
+            ieee=t.EUI64(rng.getrandbits(64).to_bytes(8, "little")),
+            logical_type=zdo_t.LogicalType.Coordinator,
+            model="Simulated radio",
+            manufacturer="zigpy-cli",
+            version="1.0",
+        )
+        self._network_info = zigpy.state.NetworkInfo(
+            extended_pan_id=t.ExtendedPanId(rng.getrandbits(64).to_bytes(8, "little")),
+            pan_id=t.PanId(rng.randint(0x0001, 0xFFF7)),
+            nwk_update_id=0,
+            nwk_manager_id=COORDINATOR_NWK,
+            channel=15,
+            channel_mask=t.Channels.ALL_CHANNELS,
+            security_level=5,
+            network_key=zigpy.state.Key(
+                key=t.KeyData(rng.getrandbits(128).to_bytes(16, "little"))
+            ),
+            tc_link_key=zigpy.state.Key(
+                key=t.KeyData(b"ZigBeeAlliance09"), partner_ieee=self._node_info.ieee
+            ),
+        )
+
+        devices = build_network(self._node_info.ieee, self._settings)
+        self._network: dict[t.NWK, SimDevice] = {d.nwk: d for d in devices}
+
+        # Like real radios, only devices that joined through the coordinator are its
+        # children but every device has a link key and an address table entry
+        coordinator, *devices = devices
+        self._network_info.children = [d.ieee for d in coordinator.children]
+        self._network_info.nwk_addresses = {d.ieee: d.nwk for d in devices}
+        self._network_info.key_table = [
+            zigpy.state.Key(
+                key=t.KeyData(rng.getrandbits(128).to_bytes(16, "little")),
+                tx_counter=rng.randint(0, 10000),
+                rx_counter=rng.randint(0, 10000),
+                seq=0,
+                partner_ieee=d.ieee,
+            )
+            for d in devices
+        ]
+
+    async def _radio_command(self) -> None:
+        """
+        Simulates the round trip of a serial command to the radio.
+        """
+
+        if not self._connected:
+            raise zigpy.exceptions.ControllerException("Radio is not connected")
+
+        await asyncio.sleep(self._settings.latency)
+
+    async def connect(self) -> None:
+        self._connected = True
+        await self._radio_command()
+
+    async def disconnect(self) -> None:
+        self._connected = False
+
+    async def _watchdog_feed(self) -> None:
+        await self._radio_command()
+
+    async def load_network_info(self, *, load_devices: bool = False) -> None:
+        await self._radio_command()
+
+        if not self._formed:
+            raise zigpy.exceptions.NetworkNotFormed("Network is not formed")
+
+        if not load_devices:
+            network_info = self._network_info.replace(
+                children=[], key_table=[], nwk_addresses={}
+            )
+        else:
+            network_info = self._network_info.replace()
+
+            # Radios read their key and address tables one entry at a time
+            for _ in network_info.key_table:
+                await self._radio_command()
+
+        self.state.node_info = self._node_info.replace()
+        self.state.network_info = network_info
+
+    async def write_network_info(
+        self, *, network_info: zigpy.state.NetworkInfo, node_info: zigpy.state.NodeInfo
+    ) -> None:
+        await self._radio_command()
+
+        # Radios write their key table one entry at a time
+        for _ in network_info.key_table:
+            await self._radio_command()
+
+        self._network_info = network_info.replace()
+        self._node_info = self._node_info.replace(
+            ieee=node_info.ieee, nwk=node_info.nwk
+        )
+        self._formed = True
+
+    async def reset_network_info(self) -> None:
+        await self._radio_command()
+        self._formed = False
+
+    async def start_network(self) -> None:
+        await self._radio_command()
+
+        # The synthetic devices have already joined and been initialized
+        for sim_device in self._network.values():
+            device = self.add_device(sim_device.ieee, sim_device.nwk)
+            device.node_desc = sim_device.node_descriptor()
+
+            endpoint = device.add_endpoint(1)
+            endpoint.status = zigpy.endpoint.Status.ZDO_INIT
+            endpoint.profile_id = 260
+            endpoint.device_type = 0x0100
+            endpoint.add_input_cluster(Basic.cluster_id)
+
+    async def _move_network_to_channel(
+        self, new_channel: int, new_nwk_update_id: int
+    ) -> None:
+        await self._radio_command()
+
+        self._network_info = self._network_info.replace(
+            channel=new_channel, nwk_update_id=new_nwk_update_id
+        )
+
+    async def force_remove(self, dev) -> None:
+        await self._radio_command()
+
+    async def add_endpoint(self, descriptor) -> None:
+        await self._radio_command()
+
+    async def permit_ncp(self, time_s: int = 60) -> None:
+        await self._radio_command()
+
+    async def permit_with_link_key(
+        self, node: t.EUI64, link_key: t.KeyData, time_s: int = 60
+    ) -> None:
+        await self._radio_command()
+
+    async def energy_scan(
+        self, channels: t.Channels, duration_exp: int, count: int
+    ) -> dict[int, float]:
+        await self._radio_command()
+
+        # Scans take time proportional to their duration
+        await asyncio.sleep(self._settings.latency * count * (2**duration_exp))
+
+        return {channel: float(self._rng.randint(0, 255)) for channel in channels}
+
+    def _next_aps_counter(self) -> t.uint8_t:
+        # Like radio libraries, received packets carry the APS counter as their TSN,
+        # not the ZDO or ZCL TSN of the request they respond to
+        self._aps_counter = (self._aps_counter + 1) & 0xFF
+
+        return t.uint8_t(self._aps_counter)
+
+    def _reply(self, device: SimDevice, request: t.ZigbeePacket, data: bytes) -> None:
+        self.packet_received(
+            t.ZigbeePacket(
+                src=t.AddrModeAddress(addr_mode=t.AddrMode.NWK, address=device.nwk),
+                src_ep=request.dst_ep,
+                dst=t.AddrModeAddress(
+                    addr_mode=t.AddrMode.NWK, address=self.state.node_info.nwk
+                ),
+                dst_ep=request.src_ep,
+                tsn=self._next_aps_counter(),
+                profile_id=request.profile_id,
+                cluster_id=(
+                    request.cluster_id | 0x8000
+                    if request.dst_ep == 0
+                    else request.cluster_id
+                ),
+                data=t.SerializableBytes(data),
+                lqi=200,
+                rssi=-50,
+            )
+        )
+
+    def _zdo_response(self, device: SimDevice, cluster_id: int, data: bytes) -> bytes:
+        tsn, args = data[:1], data[1:]
+
+        if cluster_id == zdo_t.ZDOCmd.Node_Desc_req:
+            return (
+                tsn
+                + zdo_t.Status.SUCCESS.serialize()
+                + device.nwk.serialize()
+                + device.node_descriptor().serialize()
+            )
+        elif cluster_id in (zdo_t.ZDOCmd.Mgmt_Lqi_req, zdo_t.ZDOCmd.Mgmt_Rtg_req):
+            if not device.is_router:
+                return tsn + zdo_t.Status.NOT_SUPPORTED.serialize()
+
+            start = args[0]
+
+            if cluster_id == zdo_t.ZDOCmd.Mgmt_Lqi_req:
+                neighbors = device.neighbors()
+                table = zdo_t.Neighbors(
+                    Entries=len(neighbors),
+                    StartIndex=start,
+                    NeighborTableList=neighbors[start : start + TABLE_PAGE_SIZE],
+                )
+            else:
+                routes = device.routes()
+                table = zdo_t.Routes(
+                    Entries=len(routes),
+                    StartIndex=start,
+                    RoutingTableList=routes[start : start + TABLE_PAGE_SIZE],
+                )
+
+            return tsn + zdo_t.Status.SUCCESS.serialize() + table.serialize()
+
+        return tsn + zdo_t.Status.NOT_SUPPORTED.serialize()
+
+    def _zcl_response(self, request: t.ZigbeePacket, data: bytes) -> bytes | None:
+        hdr, payload = foundation.ZCLHeader.deserialize(data)
+
+        if hdr.frame_control.is_cluster or hdr.command_id != (
+            foundation.GeneralCommand.Read_Attributes
+        ):
+            return None
+
+        attribute_ids, _ = t.List[t.uint16_t].deserialize(payload)
+        records = [
+            foundation.ReadAttributeRecord(
+                attrid=attrid,
+                status=foundation.Status.UNSUPPORTED_ATTRIBUTE,
+            )
+            for attrid in attribute_ids
+        ]
+
+        for record in records:
+            if request.cluster_id == Basic.cluster_id and record.attrid == 0x0000:
+                record.status = foundation.Status.SUCCESS
+                record.value = foundation.TypeValue(
+                    type=foundation.DataTypeId.uint8, value=t.uint8_t(8)
+                )
+
+        rsp_hdr = foundation.ZCLHeader.general(
+            tsn=hdr.tsn,
+            command_id=foundation.GeneralCommand.Read_Attributes_rsp,
+            direction=foundation.Direction.Server_to_Client,
+        )
+
+        return rsp_hdr.serialize() + b"".join(r.serialize() for r in records)
+
+    async def send_packet(self, packet: t.ZigbeePacket) -> None:
+        await self._radio_command()
+
+        if packet.dst.addr_mode != t.AddrMode.NWK:
+            return
+
+        device = self._network.get(packet.dst.address)
+
+        if device is None:
+            raise zigpy.exceptions.DeliveryError(
+                f"Device {packet.dst.address!r} is not in the network"
+            )
+
+        data = packet.data.serialize()
+
+        if packet.dst_ep == 0:
+            rsp = self._zdo_response(device, packet.cluster_id, data)
+        else:
+            rsp = self._zcl_response(packet, data)
+
+        if rsp is not None:
+            # Devices take a while to respond after the radio has sent the request
+            asyncio.get_running_loop().call_later(
+                self._settings.latency, self._reply, device, packet, rsp
+            )
@@ -0,0 +1,556 @@
+from __future__ import annotations
+
+import dataclasses
+import logging
+import struct
+import typing
+
+LOGGER = logging.getLogger(__name__)
+
+SQLITE_HEADER_MAGIC = b"SQLite format 3\x00"
+SQLITE_HEADER_SIZE = 100
+
+# The least significant bit of the WAL magic selects the byte order of its checksums
+WAL_HEADER_MAGIC = {0x377F0682: "<", 0x377F0683: ">"}
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+
+PAGE_TYPE_INDEX_INTERIOR = 0x02
+PAGE_TYPE_TABLE_INTERIOR = 0x05
+PAGE_TYPE_INDEX_LEAF = 0x0A
+PAGE_TYPE_TABLE_LEAF = 0x0D
+
+TEXT_ENCODINGS = {
+    1: "utf-8",
+    2: "utf-16-le",
+    3: "utf-16-be",
+}
+
+# Serial types 1-6 are big endian signed integers of these sizes
+INTEGER_SERIAL_TYPE_SIZES = {1: 1, 2: 2, 3: 3, 4: 4, 5: 6, 6: 8}
+
+# Number of columns of the internal tables SQLite creates for itself
+INTERNAL_TABLE_COLUMNS = {"sqlite_sequence": 2, "sqlite_stat1": 3, "sqlite_stat4": 6}
+
+# Passed as `extra` when logging a row that could not be recovered, so that they can be
+# counted by log handlers
+SKIPPED_ROW = {"skipped_row": True}
+
+
+class CorruptDatabaseError(ValueError):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class SchemaEntry:
+    type: str
+    name: str
+    tbl_name: str
+    rootpage: int
+    sql: str | None
+
+
+def read_varint(data: bytes | memoryview, offset: int) -> tuple[int, int]:
+    """
+    Reads an SQLite varint, returning its value and the offset following it.
+    """
+
+    value = 0
+
+    try:
+        for i in range(8):
+            byte = data[offset + i]
+            value = (value << 7) | (byte & 0x7F)
+
+            if byte < 0x80:
+                return value, offset + i + 1
+
+        # The ninth byte contributes all eight bits
+        return (value << 8) | data[offset + 8], offset + 9
+    except IndexError:
+        raise CorruptDatabaseError(f"Varint at offset {offset} is truncated")
+
+
+def wal_checksum(
+    data: bytes | memoryview, s0: int, s1: int, byte_order: str
+) -> tuple[int, int]:
+    """
+    Continues the cumulative checksum of a write-ahead log over `data`.
+    """
+
+    words = struct.unpack(f"{byte_order}{len(data) // 4}I", data)
+
+    for i in range(0, len(words), 2):
+        s0 = (s0 + words[i] + s1) & 0xFFFFFFFF
+        s1 = (s1 + words[i + 1] + s0) & 0xFFFFFFFF
+
+    return s0, s1
+
+
+def decode_record(payload: bytes, encoding: str) -> list:
+    """
+    Decodes the columns of a record. Text that cannot be decoded is kept as bytes.
+    """
+
+    header_size, offset = read_varint(payload, 0)
+
+    if header_size > len(payload):
+        raise CorruptDatabaseError(f"Record header size {header_size} is too large")
+
+    serial_types = []
+
+    while offset < header_size:
+        serial_type, offset = read_varint(payload, offset)
+        serial_types.append(serial_type)
+
+    values: list = []
+    offset = header_size
+
+    for serial_type in serial_types:
+        if serial_type == 0:
+            values.append(None)
+            continue
+        elif serial_type in (8, 9):
+            values.append(serial_type - 8)
+            continue
+        elif serial_type in INTEGER_SERIAL_TYPE_SIZES:
+            size = INTEGER_SERIAL_TYPE_SIZES[serial_type]
+        elif serial_type == 7:
+            size = 8
+        elif serial_type >= 12:
+            size = (serial_type - 12) // 2
+        else:
+            raise CorruptDatabaseError(f"Invalid serial type {serial_type}")
+
+        value = payload[offset : offset + size]
+
+        if len(value) != size:
+            raise CorruptDatabaseError("Record body is truncated")
+
+        offset += size
+
+        if serial_type in INTEGER_SERIAL_TYPE_SIZES:
+            values.append(int.from_bytes(value, "big", signed=True))
+        elif serial_type == 7:
+            values.append(struct.unpack(">d", value)[0])
+        elif serial_type % 2 == 0:
+            values.append(bytes(value))
+        else:
+            try:
+                values.append(bytes(value).decode(encoding))
+            except UnicodeDecodeError:
+                values.append(bytes(value))
+
+    return values
+
+
+class DamagedDatabase:
+    """
+    Salvages rows from the b-tree pages of an SQLite database without trusting its
+    structure: every page and cell is bounds checked and damaged ones are skipped.
+    """
+
+    def __init__(
+        self, data: bytes | memoryview, wal: bytes | memoryview | None = None
+    ) -> None:
+        self._data = data
+
+        if bytes(data[:16]) != SQLITE_HEADER_MAGIC:
+            raise CorruptDatabaseError("File does not have an SQLite header")
+
+        (page_size,) = struct.unpack_from(">H", data, 16)
+
+        # A page size of 1 means 65536
+        self.page_size = 65536 if page_size == 1 else page_size
+
+        if self.page_size < 512 or self.page_size & (self.page_size - 1):
+            raise CorruptDatabaseError(f"Invalid page size {self.page_size}")
+
+        self.usable_size = self.page_size - data[20]
+        self.page_count = len(data) // self.page_size
+
+        # Offsets of the latest committed version of pages in the write-ahead log
+        self._wal = wal
+        self._wal_pages: dict[int, int] = {}
+
+        if wal:
+            self._read_wal(wal)
+
+        # Page 1 may itself have been updated by the write-ahead log
+        header = self.page(1)
+
+        (
+            self.first_freelist_trunk,
+            self.freelist_count,
+        ) = struct.unpack_from(">II", header, 32)
+        (encoding,) = struct.unpack_from(">I", header, 56)
+        (self.user_version,) = struct.unpack_from(">i", header, 60)
+
+        # Encoding 0 is only used by empty databases
+        self.encoding = TEXT_ENCODINGS.get(encoding, "utf-8")
+
+        # Pages that were reached by walking a b-tree, including overflow pages
+        self.visited_pages: set[int] = set()
+
+    def _read_wal(self, wal: bytes | memoryview) -> None:
+        """
+        Replays the frames of a write-ahead log up to its last valid commit frame, like
+        SQLite does when opening a database that was not checkpointed.
+        """
+
+        if len(wal) < WAL_HEADER_SIZE:
+            LOGGER.warning("Ignoring write-ahead log: header is truncated")
+            return
+
+        magic, _, page_size, _, salt1, salt2 = struct.unpack_from(">6I", wal, 0)
+        byte_order = WAL_HEADER_MAGIC.get(magic)
+
+        if byte_order is None:
+            LOGGER.warning("Ignoring write-ahead log: invalid magic %#010x", magic)
+            return
+
+        if page_size != self.page_size:
+            LOGGER.warning(
+                "Ignoring write-ahead log: page size %d does not match %d",
+                page_size,
+                self.page_size,
+            )
+            return
+
+        checksum = wal_checksum(wal[:24], 0, 0, byte_order)
+
+        if checksum != struct.unpack_from(">II", wal, 24):
+            LOGGER.warning("Ignoring write-ahead log: header checksum mismatch")
+            return
+
+        frame_size = WAL_FRAME_HEADER_SIZE + self.page_size
+        uncommitted: dict[int, int] = {}
+        offset = WAL_HEADER_SIZE
+
+        # Frames are only valid until the first one with stale salts or a bad checksum
+        while offset + frame_size <= len(wal):
+            pgno, db_size, frame_salt1, frame_salt2 = struct.unpack_from(
+                ">4I", wal, offset
+            )
+
+            if (frame_salt1, frame_salt2) != (salt1, salt2) or pgno == 0:
+                break
+
+            checksum = wal_checksum(wal[offset : offset + 8], *checksum, byte_order)
+            checksum = wal_checksum(
+                wal[offset + WAL_FRAME_HEADER_SIZE : offset + frame_size],
+                *checksum,
+                byte_order,
+            )
+
+            if checksum != struct.unpack_from(">II", wal, offset + 16):
+                break
+
+            uncommitted[pgno] = offset + WAL_FRAME_HEADER_SIZE
+            offset += frame_size
+
+            # Only frames of committed transactions are applied
+            if db_size != 0:
+                self._wal_pages.update(uncommitted)
+                uncommitted.clear()
+                self.page_count = db_size
+
+        if uncommitted:
+            LOGGER.warning(
+                "Ignoring %d uncommitted write-ahead log frames", len(uncommitted)
+            )
+
+        LOGGER.info("Replayed %d pages from the write-ahead log", len(self._wal_pages))
+
+    def page(self, pgno: int) -> bytes:
+        if not 1 <= pgno <= self.page_count:
+            raise CorruptDatabaseError(f"Page {pgno} is out of range")
+
+        # Pages are copied so that nothing references the file's memory map once they
+        # are no longer needed, even from the tracebacks of logged exceptions
+        if pgno in self._wal_pages:
+            assert self._wal is not None
+            start = self._wal_pages[pgno]
+
+            return bytes(self._wal[start : start + self.page_size])
+
+        start = (pgno - 1) * self.page_size
+        page = bytes(self._data[start : start + self.page_size])
+
+        # Pages added by the write-ahead log may be missing from the main file
+        if len(page) != self.page_size:
+            raise CorruptDatabaseError(f"Page {pgno} is truncated")
+
+        return page
+
+    def freelist_pages(self) -> set[int]:
+        """
+        Collects the trunk and leaf pages of the freelist.
+        """
+
+        pages: set[int] = set()
+        trunk = self.first_freelist_trunk
+
+        while trunk != 0 and trunk not in pages:
+            try:
+                page = self.page(trunk)
+            except CorruptDatabaseError as e:
+                LOGGER.warning("Freelist is damaged: %s", e)
+                break
+
+            pages.add(trunk)
+            next_trunk, count = struct.unpack_from(">II", page, 0)
+
+            # Leaf page numbers follow the count
+            count = min(count, (self.usable_size - 8) // 4)
+            pages.update(struct.unpack_from(f">{count}I", page, 8))
+
+            trunk = next_trunk
+
+        return pages
+
+    def _read_payload(
+        self, page: bytes, offset: int, payload_size: int, *, index: bool = False
+    ) -> bytes:
+        """
+        Reads a table leaf or index cell payload, following its overflow page chain.
+        """
+
+        if index:
+            max_local = ((self.usable_size - 12) * 64 // 255) - 23
+        else:
+            max_local = self.usable_size - 35
+
+        if payload_size <= max_local:
+            local_size = payload_size
+        else:
+            min_local = ((self.usable_size - 12) * 32 // 255) - 23
+            local_size = min_local + (payload_size - min_local) % (self.usable_size - 4)
+
+            if local_size > max_local:
+                local_size = min_local
+
+        if offset + local_size > self.usable_size:
+            raise CorruptDatabaseError("Cell extends past the end of the page")
+
+        parts = [page[offset : offset + local_size]]
+        remaining = payload_size - local_size
+
+        if remaining > 0:
+            (overflow,) = struct.unpack_from(">I", page, offset + local_size)
+            seen = set()
+
+            while remaining > 0:
+                if overflow in seen:
+                    raise CorruptDatabaseError(f"Overflow page {overflow} loops")
+
+                seen.add(overflow)
+                overflow_page = self.page(overflow)
+                self.visited_pages.add(overflow)
+
+                chunk = overflow_page[4 : 4 + min(remaining, self.usable_size - 4)]
+                parts.append(chunk)
+                remaining -= len(chunk)
+                (overflow,) = struct.unpack_from(">I", overflow_page, 0)
+
+        return b"".join(parts)
+
+    def _parse_page_header(self, pgno: int) -> tuple[bytes, int, list[int], int]:
+        """
+        Parses a b-tree page header, returning the page, its type, its cell offsets,
+        and its right-most child pointer.
+        """
+
+        page = self.page(pgno)
+        header = SQLITE_HEADER_SIZE if pgno == 1 else 0
+        page_type = page[header]
+
+        if page_type not in (
+            PAGE_TYPE_INDEX_INTERIOR,
+            PAGE_TYPE_TABLE_INTERIOR,
+            PAGE_TYPE_INDEX_LEAF,
+            PAGE_TYPE_TABLE_LEAF,
+        ):
+            raise CorruptDatabaseError(f"Page {pgno} has invalid type {page_type:#04x}")
+
+        (num_cells,) = struct.unpack_from(">H", page, header + 3)
+
+        if page_type in (PAGE_TYPE_INDEX_INTERIOR, PAGE_TYPE_TABLE_INTERIOR):
+            (right_child,) = struct.unpack_from(">I", page, header + 8)
+            header += 12
+        else:
+            right_child = 0
+            header += 8
+
+        if header + 2 * num_cells > self.usable_size:
+            raise CorruptDatabaseError(f"Page {pgno} has too many cells: {num_cells}")
+
+        cells = list(struct.unpack_from(f">{num_cells}H", page, header))
+
+        return page, page_type, cells, right_child
+
+    def _iter_leaf_rows(
+        self, pgno: int, page: bytes, cells: list[int]
+    ) -> typing.Iterator[tuple[int, list]]:
+        for cell in cells:
+            try:
+                payload_size, offset = read_varint(page, cell)
+                rowid, offset = read_varint(page, offset)
+                payload = self._read_payload(page, offset, payload_size)
+                values = decode_record(payload, self.encoding)
+            except (CorruptDatabaseError, struct.error) as e:
+                LOGGER.warning(
+                    "Skipping cell at %d on page %d: %s",
+                    cell,
+                    pgno,
+                    e,
+                    extra=SKIPPED_ROW,
+                )
+                continue
+
+            # Rowids are signed 64-bit integers
+            if rowid >= 2**63:
+                rowid -= 2**64
+
+            yield rowid, values
+
+    def iter_table_rows(self, rootpage: int) -> typing.Iterator[tuple[int, list]]:
+        """
+        Walks a table b-tree, yielding the rowid and column values of every row that
+        can be read.
+        """
+
+        stack = [rootpage]
+        seen = set()
+
+        while stack:
+            pgno = stack.pop()
+
+            if pgno in seen:
+                LOGGER.warning("Page %d is referenced more than once", pgno)
+                continue
+
+            seen.add(pgno)
+
+            try:
+                page, page_type, cells, right_child = self._parse_page_header(pgno)
+            except (CorruptDatabaseError, struct.error) as e:
+                LOGGER.warning("Skipping page %d: %s", pgno, e)
+                continue
+
+            self.visited_pages.add(pgno)
+
+            if page_type == PAGE_TYPE_TABLE_LEAF:
+                yield from self._iter_leaf_rows(pgno, page, cells)
+            elif page_type == PAGE_TYPE_TABLE_INTERIOR:
+                # Children are visited in order, so rows are yielded in rowid order
+                stack.append(right_child)
+                stack.extend(
+                    struct.unpack_from(">I", page, cell)[0]
+                    for cell in reversed(cells)
+                    if cell + 4 <= self.usable_size
+                )
+            else:
+                LOGGER.warning("Page %d is an index page in a table b-tree", pgno)
+
+    def mark_btree_pages(self, rootpage: int) -> None:
+        """
+        Walks a table or index b-tree without decoding its rows, only to mark its pages
+        as visited so that they are not mistaken for orphaned pages.
+        """
+
+        stack = [rootpage]
+
+        while stack:
+            pgno = stack.pop()
+
+            if pgno in self.visited_pages:
+                continue
+
+            try:
+                page, page_type, cells, right_child = self._parse_page_header(pgno)
+            except (CorruptDatabaseError, struct.error) as e:
+                LOGGER.warning("Skipping page %d: %s", pgno, e)
+                continue
+
+            self.visited_pages.add(pgno)
+            interior = page_type in (PAGE_TYPE_INDEX_INTERIOR, PAGE_TYPE_TABLE_INTERIOR)
+
+            if interior:
+                stack.append(right_child)
+
+            for cell in cells:
+                try:
+                    offset = cell
+
+                    if interior:
+                        (child,) = struct.unpack_from(">I", page, cell)
+                        stack.append(child)
+                        offset += 4
+
+                    # Interior table cells only hold a rowid, other cells a payload
+                    # that may continue on overflow pages
+                    if page_type == PAGE_TYPE_TABLE_INTERIOR:
+                        continue
+
+                    payload_size, offset = read_varint(page, offset)
+
+                    if page_type == PAGE_TYPE_TABLE_LEAF:
+                        _, offset = read_varint(page, offset)
+
+                    self._read_payload(
+                        page,
+                        offset,
+                        payload_size,
+                        index=page_type != PAGE_TYPE_TABLE_LEAF,
+                    )
+                except (CorruptDatabaseError, struct.error) as e:
+                    LOGGER.warning("Skipping cell at %d on page %d: %s", cell, pgno, e)
+
+    def iter_orphaned_rows(self) -> typing.Iterator[tuple[int, int, list]]:
+        """
+        Yields the page number, rowid and values of rows on table leaf pages that were
+        not reached by walking any b-tree and are not free. These belong to b-trees
+        whose interior pages are damaged.
+        """
+
+        free_pages = self.freelist_pages()
+
+        for pgno in range(1, self.page_count + 1):
+            if pgno in self.visited_pages or pgno in free_pages:
+                continue
+
+            try:
+                page, page_type, cells, _ = self._parse_page_header(pgno)
+            except (CorruptDatabaseError, struct.error):
+                continue
+
+            if page_type != PAGE_TYPE_TABLE_LEAF:
+                continue
+
+            self.visited_pages.add(pgno)
+
+            for rowid, values in self._iter_leaf_rows(pgno, page, cells):
+                yield pgno, rowid, values
+
+    def read_schema(self) -> list[SchemaEntry]:
+        """
+        Reads the `sqlite_schema` table, which is always rooted at page 1.
+        """
+
+        schema = []
+
+        for _, values in self.iter_table_rows(1):
+            if len(values) != 5:
+                LOGGER.warning("Skipping invalid schema row: %r", values)
+                continue
+
+            type_, name, tbl_name, rootpage, sql = values
+
+            if not isinstance(name, str) or not isinstance(rootpage, (int, type(None))):
+                LOGGER.warning("Skipping invalid schema row: %r", values)
+                continue
+
+            schema.append(SchemaEntry(type_, name, tbl_name, rootpage or 0, sql))
+
+        return schema